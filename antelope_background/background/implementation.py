@@ -7,6 +7,7 @@ from antelope_core.archives import ArchiveError
 from antelope_core.implementations.quantity import QuantityConversionError, NoFactorsFound, CO2QuantityConversion
 from antelope_core.lcia_results import LciaResult
 
+import numpy as np
 from scipy.sparse import csr_matrix
 
 
@@ -14,6 +15,21 @@ class InvalidRefFlow(Exception):
     pass
 
 
+def _contributions(node_weights, unit_scores):
+    """
+    Find the nodes that contribute to an LCIA result, i.e. those with both a nonzero activity level and a nonzero
+    unit score, from the nonzeros of their elementwise product.
+    :param node_weights: sparse 1 x n activity levels
+    :param unit_scores: sparse 1 x n unit scores
+    :return: indices, node_weights, unit_scores -- 1-d arrays for the contributing nodes only
+    """
+    node_weights = csr_matrix(node_weights)
+    unit_scores = csr_matrix(unit_scores)
+    _, nz = node_weights.multiply(unit_scores).nonzero()
+    nz = np.sort(nz)
+    return nz, node_weights[:, nz].toarray().flatten(), unit_scores[:, nz].toarray().flatten()
+
+
 class TarjanBackgroundImplementation(BackgroundImplementation):
     """
     This is the class that does the background interfacing work for partially-ordered databases.  The plumbing is
@@ -42,7 +58,7 @@ class TarjanBackgroundImplementation(BackgroundImplementation):
 
     The necessary conditions to CREATE a flat Tarjan Background are: a valid [invertible] database with complete working
     index and inventory implementations. This flat background then gets serialized using a numpy [matlab] format, along
-    with a separate index file as json.
+    with a separate binary ordering file.
 
     The necessary conditions to RESTORE a flat Tarjan Background are the serialization created above, and an index
     implementation for retrieving entities and contexts.
@@ -252,6 +268,21 @@ class TarjanBackgroundImplementation(BackgroundImplementation):
         for x in self._direct_exchanges(process, ref_flow, self._flat.lci(process, ref_flow, **kwargs)):
             yield x
 
+    def lci_many(self, terms, **kwargs):
+        """
+        Batched LCI for many nodes at once.  Bulk consumers receive a columnar result instead of exchanges.
+        :param terms: iterable of reference exchanges, or of (process, ref_flow) pairs
+        :param kwargs: passed to FlatBackground.lci_many()
+        :return: LciColumns(terms, exterior, matrix) with one column per term, as (process_ref, flow_ref) pairs
+        """
+        refs = []
+        for term in terms:
+            if isinstance(term, tuple):
+                refs.append(self._check_ref(*term))
+            else:
+                refs.append(self._check_ref(term, None))
+        return self._flat.lci_many(refs, **kwargs)
+
     def sys_lci(self, demand, **kwargs):
         self.check_bg()
         node = None
@@ -274,14 +305,22 @@ class TarjanBackgroundImplementation(BackgroundImplementation):
             return CO2QuantityConversion.copy(qr)
         return qr
 
-    def _add_lcia_component(self, res, term, node_weight, m_index, dense_qcs):
+    def _add_lcia_component(self, res, term, node_weight, batch, qcs):
+        """
+        :param res:
+        :param term:
+        :param node_weight:
+        :param batch: ExchDefBatch of the node's characterized exterior exchanges
+        :param qcs: dict mapping exterior index to quantity conversion
+        :return:
+        """
         key = term.term_ref, term.flow_ref
         comp = self[term.term_ref]
         sub_res = LciaResult(res.quantity)
         sub_res.add_component(term.term_ref, comp)
-        dense_exch_defs = self._flat.generate_ems_by_index(term.term_ref, term.flow_ref, m_index)
-        for i, x in enumerate(self._direct_exchanges(comp, term.flow_ref, dense_exch_defs)):
-            sub_res.add_score(comp.external_ref, x, dense_qcs[i])
+        exchs = self._direct_exchanges(comp, term.flow_ref, self._flat.exch_defs(batch))
+        for i, x in zip(batch.index, exchs):
+            sub_res.add_score(comp.external_ref, x, qcs[i])
         res.add_summary(key, comp, node_weight, sub_res)
 
     def _add_lcia_summary(self, res, term, node_weight, unit_score):
@@ -289,34 +328,87 @@ class TarjanBackgroundImplementation(BackgroundImplementation):
         comp = self[term.term_ref]
         res.add_summary(key, comp, node_weight, unit_score)
 
+    def _characterize(self, q_ref):
+        """
+        Obtain the characterization vector for the given quantity: the quantity conversion values for every exterior
+        flow.  Computed vectors are stored in the flat background, keyed to the current context map, and are saved
+        with it.
+        :param q_ref: canonical quantity
+        :return: a sparse 1 x mdim row
+        """
+        char_vector = self._flat.characterization(q_ref.link)
+        if char_vector is None:
+            char_vector = csr_matrix([self._get_quantity_conversion(q_ref, ex).value for ex in self._flat.ex])
+            self._flat.set_characterization(q_ref.link, char_vector)
+        return char_vector
+
+    def characterization_matrix(self, quantity_refs):
+        """
+        Stack the characterization vectors of several quantities into one sparse matrix
+        :param quantity_refs: iterable of quantities
+        :return: q_refs, C -- list of canonical quantities, and a sparse (len(q_refs) x mdim) matrix
+        """
+        self.check_bg()
+        q_refs = [self.get_canonical(q) for q in quantity_refs]
+        for q_ref in q_refs:
+            self._characterize(q_ref)
+        return q_refs, self._flat.characterization_matrix(q.link for q in q_refs)
+
+    def lcia_scores(self, process, quantity_refs, ref_flow=None, **kwargs):
+        """
+        Score a node's LCI against several quantities at once, with a single sparse product
+        :param process:
+        :param quantity_refs: iterable of quantities
+        :param ref_flow:
+        :param kwargs: passed to the solver
+        :return: dict mapping canonical quantity to score
+        """
+        process, ref_flow = self._check_ref(process, ref_flow)
+        q_refs, char_matrix = self.characterization_matrix(quantity_refs)
+        scores = self._flat.scores(process, ref_flow, char_matrix, **kwargs)
+        return {q: float(scores[i]) for i, q in enumerate(q_refs)}
+
+    def score_all(self, quantity_ref, **kwargs):
+        """
+        Compute the cumulative impact score of every foreground and background node for the given quantity, with a
+        single adjoint solve (rather than one solve per node).  Useful for ranking processes by an impact category.
+        :param quantity_ref:
+        :param kwargs: passed to FlatBackground.cumulative_scores()
+        :return: dict mapping (process_ref, flow_ref) to the cumulative score of a unit of the node's reference flow
+        """
+        self.check_bg()
+        q_ref = self.get_canonical(quantity_ref)
+        char_vector = self._characterize(q_ref)
+        sf, s = self._flat.cumulative_scores(char_vector, **kwargs)
+        scores = dict()
+        for i, term in enumerate(self._flat.fg):
+            scores[term.term_ref, term.flow_ref] = float(sf[i])
+        for i, term in enumerate(self._flat.bg):
+            scores[term.term_ref, term.flow_ref] = float(s[i])
+        return scores
+
     def deep_lcia(self, process, quantity_ref, ref_flow=None, detailed=False, **kwargs):
         process, ref_flow = self._check_ref(process, ref_flow)
         q_ref = self.get_canonical(quantity_ref)
-        qcs = [self._get_quantity_conversion(q_ref, ex) for ex in self._flat.ex]
-        char_vector = csr_matrix([k.value for k in qcs])
+        char_vector = self._characterize(q_ref)
         _, nzc = char_vector.nonzero()
-        dense_qcs = [qcs[k] for k in nzc]
+        if detailed:
+            qcs = {k: self._get_quantity_conversion(q_ref, self._flat.ex[k]) for k in nzc}
+        else:
+            qcs = None
         sf, s = self._flat.unit_scores(char_vector)
         xf, x = self._flat.activity_levels(process, ref_flow)
 
         res = LciaResult(q_ref)
-        for i in range(self._flat.pdim):
-            if xf[0, i] != 0:
-                if sf[0, i] != 0:
-                    term = self._flat.fg[i]
-                    if detailed:
-                        self._add_lcia_component(res, term, xf[0, i], nzc, dense_qcs)
-                    else:
-                        self._add_lcia_summary(res, term, xf[0, i], sf[0, i])
-
-        for i in range(self._flat.ndim):
-            if x[0, i] != 0:
-                if s[0, i] != 0:
-                    term = self._flat.bg[i]
-                    if detailed:
-                        self._add_lcia_component(res, term, x[0, i], nzc, dense_qcs)
-                    else:
-                        self._add_lcia_summary(res, term, x[0, i], s[0, i])
+        for terms, weights, scores, bg in ((self._flat.fg, xf, sf, False), (self._flat.bg, x, s, True)):
+            nz, node_weights, unit_scores = _contributions(weights, scores)
+            if detailed:
+                batches = self._flat.ems_by_index_batches(nzc, nz, background=bg)
+                for i, node_weight, batch in zip(nz, node_weights, batches):
+                    self._add_lcia_component(res, terms[i], node_weight, batch, qcs)
+            else:
+                for i, node_weight, unit_score in zip(nz, node_weights, unit_scores):
+                    self._add_lcia_summary(res, terms[i], node_weight, unit_score)
 
         return res
 
@@ -1,14 +1,115 @@
 import unittest
 import os
 from tempfile import TemporaryDirectory
+from threading import Thread
 
-from .. import FlatBackground, TermRef
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from antelope_core import to_json
+from antelope_core.archives import LcArchive
+from antelope_core.entities import LcQuantity, LcFlow, LcProcess
+
+from ...engine.background_layer import TermRef
+from ...engine.flat_background import FlatBackground, flatten, ORDERING_SUFFIX, BINARY_ORDERING_SUFFIX, \
+    AGGREGATED_SUFFIX
+from ...engine.solvers import ForegroundSolver
+from ...engine.hdf5_storage import h5py
 
 #  flow_ref, direction, term_ref, scc
 term_test = (('an_arbitrary_external_ref', 0, 'a_different_ref', None),
              ('zzxxcc00', 1, 'aabbcc11', 0),
              ('zzxxcc11', 'Input', 'aabbcc22', 'a_strongly_connected_component'))
 
+# a small complete system: two foreground nodes, three background nodes (two in a cycle), two exterior flows
+lci_fg = (('f_product', 'Output', 'f_model', 0), ('f_part', 'Output', 'f_assembly', 0))
+lci_bg = (('b_steel', 'Output', 'b_mill', 'b_mill'), ('b_power', 'Output', 'b_grid', 'b_mill'),
+          ('b_coal', 'Output', 'b_mine', 0))
+lci_ex = (('e_co2', 'Input', 'air', 0), ('e_water', 'Output', 'water', 0))
+
+lci_af = np.array([[0, 0], [2.0, 0]])
+lci_ad = np.array([[0.5, 0.1], [0, 1.5], [0, 0]])
+lci_bf = np.array([[0.2, 0], [0, 3.0]])
+lci_a = np.array([[0, 0.1, 0], [0.4, 0, 0], [0.2, 0.6, 0]])
+lci_b = np.array([[1.0, 0, 2.5], [0.3, 0.2, 0]])
+
+
+def _lci_test_background(**kwargs):
+    return FlatBackground(lci_fg, lci_bg, lci_ex, csr_matrix(lci_af), csr_matrix(lci_ad), csr_matrix(lci_bf),
+                          lci_db=(csr_matrix(lci_a), csr_matrix(lci_b)), **kwargs)
+
+
+def _dense_lci(index, background=False):
+    """
+    Reference result computed with dense linear algebra
+    """
+    if background:
+        y = np.zeros(len(lci_bg))
+        y[index] = 1.0
+        return lci_b.dot(np.linalg.solve(np.eye(len(lci_bg)) - lci_a, y))
+    y = np.zeros(len(lci_fg))
+    y[index] = 1.0
+    xf = np.linalg.solve(np.eye(len(lci_fg)) - lci_af, y)
+    x = np.linalg.solve(np.eye(len(lci_bg)) - lci_a, lci_ad.dot(xf))
+    return lci_bf.dot(xf) + lci_b.dot(x)
+
+
+def _lci_vector(fb, process, ref_flow, **kwargs):
+    return fb._compute_lci(process, ref_flow, **kwargs).toarray().flatten()
+
+
+def _new_foreground_archive():
+    """
+    An archive with two new foreground processes that depend on the lci test background: a widget maker
+    (reference value 2.0) uses steel, a foreground part, a new part, and emits a new exterior flow; the part maker
+    uses power.
+    """
+    ar = LcArchive(None, ref='test.new.foreground')
+    mass = LcQuantity.new('Mass', 'kg')
+    ar.add(mass)
+    flows = {k: LcFlow(k, Name=k, ReferenceQuantity=mass) for k in ('b_steel', 'b_power', 'f_part', 'n_widget',
+                                                                     'n_part', 'n_waste')}
+    for f in flows.values():
+        ar.add(f)
+    procs = {k: LcProcess(k, Name=k) for k in ('b_mill', 'b_grid', 'f_assembly', 'n_widget_maker', 'n_part_maker')}
+    for p in procs.values():
+        ar.add(p)
+    for p, f, v in (('b_mill', 'b_steel', 1.0), ('b_grid', 'b_power', 1.0), ('f_assembly', 'f_part', 1.0),
+                    ('n_widget_maker', 'n_widget', 2.0), ('n_part_maker', 'n_part', 1.0)):
+        procs[p].add_exchange(flows[f], 'Output', value=v)
+        procs[p].set_reference(flows[f], 'Output')
+    widget = procs['n_widget_maker']
+    widget.add_exchange(flows['b_steel'], 'Input', value=0.5, termination='b_mill')
+    widget.add_exchange(flows['f_part'], 'Input', value=1.0, termination='f_assembly')
+    widget.add_exchange(flows['n_part'], 'Input', value=3.0, termination='n_part_maker')
+    widget.add_exchange(flows['n_waste'], 'Output', value=0.1)
+    procs['n_part_maker'].add_exchange(flows['b_power'], 'Input', value=0.2, termination='b_grid')
+    return ar
+
+
+class _SccNode(object):
+    def __init__(self, index):
+        self.index = index
+
+
+class _FgSccStack(object):
+    """
+    Minimal stand-in for a TarjanStack whose foreground nodes 0 and 1 form an SCC
+    """
+    pdim = 3
+
+    def nontrivial_sccs(self):
+        yield 'fg'
+
+    def is_background_scc(self, k):
+        return False
+
+    def scc(self, k):
+        return [_SccNode(0), _SccNode(1)]
+
+    def fg_dict(self, index):
+        return index
+
 
 class FlatBackgroundTestCase(unittest.TestCase):
     def test_create_terms(self):
@@ -28,6 +129,15 @@ class FlatBackgroundTestCase(unittest.TestCase):
         for i, fg in enumerate(fb.fg):
             self.assertIs(fb.index_of(fg.term_ref, fg.flow_ref), i)
 
+    def test_term_index(self):
+        fb = FlatBackground(lci_fg, lci_bg, lci_ex, None, None, None)
+        self.assertTrue(fb.is_in_background('b_grid', 'b_power'))
+        self.assertFalse(fb.is_in_background('b_grid', 'b_steel'))
+        self.assertEqual(fb._ex_index['water', 'e_water', 'Output'], 1)
+        self.assertNotIn(('water', 'e_water', 'Input'), fb._ex_index)
+        with self.assertRaises(KeyError):
+            fb.index_of('f_model', 'no_such_flow')
+
     def test_store_term_mat(self):
         fb = FlatBackground(term_test, [], [], None, None, None)
         with TemporaryDirectory() as tmpdir:
@@ -39,5 +149,363 @@ class FlatBackgroundTestCase(unittest.TestCase):
                 self.assertTupleEqual(tuple(fb_load.fg[index]), tuple(fg))
 
 
+
+    def test_binary_ordering(self):
+        fb = FlatBackground(term_test, [], [], None, None, None)
+        with TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.mat')
+            fb.write_to_file(fname)
+            self.assertTrue(os.path.exists(fname + BINARY_ORDERING_SUFFIX))
+            os.remove(fname + BINARY_ORDERING_SUFFIX)
+            to_json({'foreground': [tuple(f) for f in fb.fg], 'background': [], 'exterior': []},
+                    fname + ORDERING_SUFFIX, gzip=True)  # legacy ordering
+            fb_load = FlatBackground.from_file(fname)
+            for fg in fb.fg:
+                self.assertTupleEqual(tuple(fb_load.fg[fb_load.index_of(fg.term_ref, fg.flow_ref)]), tuple(fg))
+
+
+class FlatBackgroundLciTestCase(unittest.TestCase):
+    def test_factorization_round_trip(self):
+        fb = _lci_test_background()
+        self.assertIsNone(fb.factorization)
+        with TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.mat')
+            fb.write_to_file(fname, factorize=True)
+            fb_load = FlatBackground.from_file(fname, lazy=False)
+        self.assertIsNotNone(fb_load.factorization)
+        for i, bg in enumerate(lci_bg):
+            lci = _lci_vector(fb_load, bg[2], bg[0])
+            self.assertTrue(np.allclose(lci, _dense_lci(i, background=True)))
+        lu = fb_load.factorization
+        y = np.array([[1.0, 0], [2.0, 1.0], [0, 3.0]])
+        ima = np.eye(len(lci_bg)) - lci_a
+        for trans in (False, True):
+            self.assertTrue(np.allclose(lu.solve(y, trans=trans), np.linalg.solve(ima.T if trans else ima, y)))
+            self.assertIs(lu._csr_factors(trans), lu._csr_factors(trans))  # converted once
+        for i, fg in enumerate(lci_fg):
+            lci = _lci_vector(fb_load, fg[2], fg[0])
+            self.assertTrue(np.allclose(lci, _dense_lci(i)))
+
+    def test_lazy_lci_db(self):
+        fb = _lci_test_background()
+        with TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.mat')
+            fb.write_to_file(fname, factorize=True)
+            fb_load = FlatBackground.from_file(fname)
+            self.assertTrue(fb_load._complete)
+            self.assertFalse(fb_load.lci_db_loaded)
+            self.assertEqual(len(fb_load.bf_batch('f_model', 'f_product').index), 2)
+            self.assertFalse(fb_load.lci_db_loaded)
+            lci = _lci_vector(fb_load, lci_fg[0][2], lci_fg[0][0])
+            self.assertTrue(fb_load.lci_db_loaded)
+            self.assertIsNotNone(fb_load.factorization)
+        self.assertTrue(np.allclose(lci, _dense_lci(0)))
+
+    @unittest.skipIf(h5py is None, 'h5py not installed')
+    def test_hdf5_round_trip(self):
+        fb = _lci_test_background()
+        with TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.hdf')
+            fb.write_to_file(fname, factorize=True)
+            fb_load = FlatBackground.from_file(fname, lazy=False)
+            fb_fg = FlatBackground.from_file(fname, complete=False)
+        for terms, loaded in ((fb.fg, fb_load.fg), (fb.bg, fb_load.bg), (fb.ex, fb_load.ex)):
+            self.assertListEqual([tuple(k) for k in terms], [tuple(k) for k in loaded])
+        self.assertIsNotNone(fb_load.factorization)
+        for i, bg in enumerate(lci_bg):
+            lci = _lci_vector(fb_load, bg[2], bg[0])
+            self.assertTrue(np.allclose(lci, _dense_lci(i, background=True)))
+        self.assertFalse(fb_fg._complete)
+        self.assertEqual(len(list(fb_fg.dependencies('f_model', 'f_product'))), 2)
+
+    def test_mmap_round_trip(self):
+        fb = _lci_test_background()
+        with TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.mmap')
+            fb.write_to_file(fname, factorize=True)
+            fb_load = FlatBackground.from_file(fname)
+            self.assertFalse(fb_load._A.data.flags.writeable)  # read-only memory map
+            for name in ('_A', '_B'):
+                self.assertFalse(fb_load._view(name, 'csc').data.flags.writeable)  # mapped, not a converted copy
+                self.assertTrue(np.allclose(fb_load._view(name, 'csc').toarray(), getattr(fb, name).toarray()))
+            self.assertListEqual([tuple(k) for k in fb.ex], [tuple(k) for k in fb_load.ex])
+            self.assertIsNotNone(fb_load.factorization)
+            for trans in (False, True):
+                for factor in fb_load.factorization._csr_factors(trans):
+                    self.assertFalse(factor.data.flags.writeable)  # mapped, not a converted copy
+            for i, fg in enumerate(lci_fg):
+                lci = _lci_vector(fb_load, fg[2], fg[0])
+                self.assertTrue(np.allclose(lci, _dense_lci(i)))
+            del fb_load  # release memory maps before the directory is removed
+
+    def test_mmap_rewrite(self):
+        fb = _lci_test_background()
+        a2 = lci_a * 0.5
+        fb2 = FlatBackground(lci_fg, lci_bg, lci_ex, csr_matrix(lci_af), csr_matrix(lci_ad), csr_matrix(lci_bf),
+                             lci_db=(csr_matrix(a2), csr_matrix(lci_b)))
+        with TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.mmap')
+            fb.write_to_file(fname, factorize=True)
+            fb2.write_to_file(fname)  # same path, changed A and no factorization
+            fb_load = FlatBackground.from_file(fname)
+            self.assertIsNone(fb_load.factorization)
+            for i, bg in enumerate(lci_bg):
+                y = np.zeros(len(lci_bg))
+                y[i] = 1.0
+                lci = _lci_vector(fb_load, bg[2], bg[0], solver='spsolve')
+                self.assertTrue(np.allclose(lci, lci_b.dot(np.linalg.solve(np.eye(len(lci_bg)) - a2, y))))
+            del fb_load  # release memory maps before the directory is removed
+
+    def test_from_file_kwargs(self):
+        fb = _lci_test_background()
+        for ext in ('.mat', '.hdf', '.mmap'):
+            if ext == '.hdf' and h5py is None:
+                continue
+            with self.subTest(ext=ext), TemporaryDirectory() as tmpdir:
+                fname = os.path.join(tmpdir, 'test' + ext)
+                fb.write_to_file(fname, factorize=True)
+                fb_eager = FlatBackground.from_file(fname, quiet=True, lazy=False)
+                self.assertTrue(fb_eager.lci_db_loaded)
+                self.assertIsNotNone(fb_eager.factorization)
+                self.assertTrue(np.allclose(_lci_vector(fb_eager, lci_fg[0][2], lci_fg[0][0]), _dense_lci(0)))
+                fb_fg = FlatBackground.from_file(fname, quiet=True, complete=False)
+                self.assertFalse(fb_fg._complete)
+                self.assertIsNone(fb_fg.factorization)
+                self.assertEqual(len(list(fb_fg.dependencies('f_model', 'f_product'))), 2)
+                del fb_eager, fb_fg  # release memory maps before the directory is removed
+
+    def test_lci_many(self):
+        fb = _lci_test_background()
+        terms = [(lci_fg[1][2], lci_fg[1][0]), (lci_bg[2][2], lci_bg[2][0]), (lci_fg[0][2], lci_fg[0][0])]
+        res = fb.lci_many(terms)
+        self.assertEqual(res.matrix.shape, (len(lci_ex), len(terms)))
+        self.assertTupleEqual(res.terms, tuple(terms))
+        lcis = res.matrix.toarray()
+        self.assertTrue(np.allclose(lcis[:, 0], _dense_lci(1)))
+        self.assertTrue(np.allclose(lcis[:, 1], _dense_lci(2, background=True)))
+        self.assertTrue(np.allclose(lcis[:, 2], _dense_lci(0)))
+
+    def test_aggregated_lci(self):
+        fb = _lci_test_background()
+        with TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.mat')
+            fb.write_to_file(fname, aggregate=True)
+            fb_load = FlatBackground.from_file(fname)
+            self.assertIsNotNone(fb_load.aggregated)
+            for i, bg in enumerate(lci_bg):
+                lci = _lci_vector(fb_load, bg[2], bg[0])
+                self.assertTrue(np.allclose(lci, _dense_lci(i, background=True)))
+            lci = _lci_vector(fb_load, lci_fg[0][2], lci_fg[0][0])
+            self.assertTrue(np.allclose(lci, _dense_lci(0)))
+            del fb_load  # release memory maps before the directory is removed
+
+    def test_aggregated_rewrite(self):
+        fb = _lci_test_background()
+        fb_new = FlatBackground(lci_fg, lci_bg[:2], lci_ex, csr_matrix(lci_af), csr_matrix(lci_ad[:2, :]),
+                                csr_matrix(lci_bf), lci_db=(csr_matrix(lci_a[:2, :2]), csr_matrix(lci_b[:, :2])))
+        with TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.mat')
+            fb.write_to_file(fname, aggregate=True)
+            fb_new.write_to_file(fname)  # same path, no aggregated matrix
+            fb_load = FlatBackground.from_file(fname)
+            self.assertIsNone(fb_load.aggregated)
+            self.assertFalse(os.path.exists(fname + AGGREGATED_SUFFIX))
+        self.assertIsNone(FlatBackground(lci_fg, lci_bg[:2], lci_ex, csr_matrix(lci_af), csr_matrix(lci_ad[:2, :]),
+                                         csr_matrix(lci_bf), aggregated=fb.aggregated).aggregated)  # wrong shape
+
+    def test_krylov_solvers(self):
+        fb = _lci_test_background()
+        for solver in ('gmres', 'bicgstab'):
+            for i, bg in enumerate(lci_bg):
+                lci = _lci_vector(fb, bg[2], bg[0], solver=solver, rtol=1e-10, quiet=True)
+                self.assertTrue(np.allclose(lci, _dense_lci(i, background=True)))
+                info = fb.last_solve[0]
+                self.assertEqual(info.solver, solver)
+                self.assertTrue(info.converged)
+                self.assertLess(info.residual, 1e-10)
+
+    def test_last_solve(self):
+        fb = _lci_test_background()
+        fb.context_map = dict()
+        process, ref_flow = lci_fg[0][2], lci_fg[0][0]
+        list(fb.lci(process, ref_flow, solver='gmres', quiet=True))
+        gmres = fb.last_solve
+        self.assertEqual(gmres[0].solver, 'gmres')
+        list(fb.lci(process, ref_flow, solver='bicgstab', quiet=True))
+        self.assertEqual(fb.last_solve[0].solver, 'bicgstab')
+        list(fb.lci(process, ref_flow, solver='gmres', quiet=True))  # cache hit reports the solve that produced it
+        self.assertEqual(fb.cache_info.hits, 1)
+        self.assertIs(fb.last_solve, gmres)
+        list(fb.lci(process, ref_flow))  # direct solve
+        self.assertIsNone(fb.last_solve)
+
+        seen = dict()
+
+        def _query(solver):
+            list(fb.lci(lci_bg[0][2], lci_bg[0][0], solver=solver, quiet=True))
+            seen[solver] = fb.last_solve
+
+        threads = [Thread(target=_query, args=(solver,)) for solver in ('gmres', 'bicgstab')]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        self.assertEqual(seen['gmres'][0].solver, 'gmres')
+        self.assertEqual(seen['bicgstab'][0].solver, 'bicgstab')
+        self.assertIsNone(fb.last_solve)  # other threads' solves are not reported here
+
+    def test_scc_solver(self):
+        fb = _lci_test_background()
+        blocks = fb.bg_blocks
+        self.assertEqual(blocks[0], blocks[1])  # b_mill and b_grid form a cycle
+        self.assertLess(blocks[0], blocks[2])  # b_mine is downstream of the cycle
+        self.assertEqual(fb.scc_solver().nontrivial, 1)
+        for i, bg in enumerate(lci_bg):
+            lci = _lci_vector(fb, bg[2], bg[0], solver='scc')
+            self.assertTrue(np.allclose(lci, _dense_lci(i, background=True)))
+        c = np.array([[1.0, 2.0]])
+        sf, s = fb.cumulative_scores(csr_matrix(c), solver='scc')
+        self.assertTrue(np.allclose(s, [c.dot(_dense_lci(i, background=True))[0] for i in range(len(lci_bg))]))
+        with TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.mat')
+            fb.write_to_file(fname)
+            fb_load = FlatBackground.from_file(fname)
+        self.assertTrue(np.array_equal(fb_load._bg_blocks, blocks))
+
+    def test_slice_views(self):
+        fb = _lci_test_background()
+        self.assertEqual(fb.views_nbytes, 0)
+        deps = list(fb.dependencies('b_grid', 'b_power'))
+        self.assertSetEqual({(d.term, d.value) for d in deps}, {('b_mill', 0.1), ('b_mine', 0.6)})
+        self.assertGreater(fb.views_nbytes, 0)
+        self.assertSetEqual({c.term_ref for c in fb.consumers('b_mine', 'b_coal')}, {'b_mill', 'b_grid'})
+        fb.drop_views()
+        self.assertEqual(fb.views_nbytes, 0)
+
+    def test_emitters(self):
+        fb = _lci_test_background()
+        self.assertSetEqual({x.term_ref for x in fb.emitters('e_co2', None)}, {'f_model', 'b_mill', 'b_mine'})
+        self.assertSetEqual({x.term_ref for x in fb.emitters('e_water', 'Output')}, {'f_assembly', 'b_mill', 'b_grid'})
+        self.assertListEqual(list(fb.emitters('e_water', 'Input')), [])
+        self.assertListEqual(list(fb.emitters('e_unknown', None)), [])
+
+    def test_exch_def_batches(self):
+        fb = _lci_test_background()
+        fb.context_map = {'air': 'air', 'water': 'water'}
+        batch = fb.lci_batch('f_model', 'f_product')
+        self.assertIs(batch.terms, fb.ex)
+        self.assertTrue(np.allclose(batch.value, _dense_lci(0)[batch.index]))
+        self.assertListEqual(list(fb.exch_defs(batch)), list(fb.lci('f_model', 'f_product')))
+        fg_deps, bg_deps = fb.dependencies_batch('f_model', 'f_product')
+        self.assertListEqual(list(fg_deps.index), [1])
+        self.assertListEqual(list(fg_deps.direction), [0])
+        self.assertListEqual(list(bg_deps.value), [0.5])
+
+    def test_ems_by_index_batches(self):
+        fb = _lci_test_background()
+        batches = fb.ems_by_index_batches([0], [0, 1, 2], background=True)
+        self.assertListEqual([b.process for b in batches], ['b_mill', 'b_grid', 'b_mine'])
+        self.assertListEqual([list(b.value) for b in batches], [[1.0], [], [2.5]])
+        self.assertListEqual(list(batches[2].index), [0])
+
+    def test_result_cache(self):
+        fb = _lci_test_background()
+        fb.context_map = dict()
+        process, ref_flow = lci_fg[0][2], lci_fg[0][0]
+        first = list(fb.lci(process, ref_flow, solver='spsolve'))
+        self.assertEqual(fb.cache_info.misses, 1)
+        second = list(fb.lci(process, ref_flow, solver='spsolve', quiet=True))
+        self.assertEqual(fb.cache_info.hits, 1)
+        self.assertListEqual(first, second)
+        list(fb.lci(process, ref_flow))  # different solver options are a different key
+        self.assertEqual(fb.cache_info.misses, 2)
+        self.assertEqual(fb.cache_info.entries, 2)
+        fb.invalidate_cache()
+        self.assertEqual(fb.cache_info.entries, 0)
+        self.assertEqual(fb.cache_info.nbytes, 0)
+
+    def test_cumulative_scores(self):
+        fb = _lci_test_background()
+        char_vector = np.array([[1.0, 0.25]])
+        sf, s = fb.cumulative_scores(csr_matrix(char_vector))
+        for i in range(len(lci_fg)):
+            self.assertAlmostEqual(sf[i], char_vector.dot(_dense_lci(i))[0])
+        for i in range(len(lci_bg)):
+            self.assertAlmostEqual(s[i], char_vector.dot(_dense_lci(i, background=True))[0])
+
+    def test_characterization_cache(self):
+        fb = _lci_test_background()
+        fb.context_map = {'air': 'to air', 'water': 'to water'}
+        fb.set_characterization('gwp', csr_matrix([[1.0, 0]]))
+        fb.set_characterization('wdp', csr_matrix([[0, 2.0]]))
+        char_matrix = fb.characterization_matrix(['gwp', 'wdp'])
+        scores = fb.scores(lci_fg[0][2], lci_fg[0][0], char_matrix)
+        self.assertTrue(np.allclose(scores, char_matrix.toarray().dot(_dense_lci(0))))
+        with TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.mat')
+            fb.write_to_file(fname)
+            fb_load = FlatBackground.from_file(fname)
+        self.assertIsNone(fb_load.characterization('gwp'))  # no context map
+        fb_load.context_map = {'air': 'to air', 'water': 'to water'}
+        self.assertTrue(np.allclose(fb_load.characterization_matrix(['gwp', 'wdp']).toarray(),
+                                    char_matrix.toarray()))
+        fb_load.context_map = {'air': 'to air', 'water': 'to somewhere else'}
+        self.assertIsNone(fb_load.characterization('gwp'))
+        with TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.mat')
+            fb.write_to_file(fname)
+            _lci_test_background().write_to_file(fname)  # same path, no characterizations
+            fb_load = FlatBackground.from_file(fname)
+        fb_load.context_map = {'air': 'to air', 'water': 'to water'}
+        self.assertIsNone(fb_load.characterization('gwp'))
+
+    def test_flatten(self):
+        af = np.array([[0, 0.5, 0], [0.2, 0, 0], [0.4, 0.1, 0]])
+        ad = np.array([[1.0, 0, 0.3], [0, 2.0, 0]])
+        af_flat, ad_flat, bf_flat = flatten(csr_matrix(af), csr_matrix(ad), csr_matrix(ad), _FgSccStack())
+        af_flat = af_flat.toarray()
+        self.assertTrue(np.allclose(np.triu(af_flat), 0))
+        self.assertTrue(np.allclose(ad.dot(np.linalg.inv(np.eye(3) - af)),
+                                    ad_flat.toarray().dot(np.linalg.inv(np.eye(3) - af_flat))))
+        fb = FlatBackground(lci_fg + (('f_extra', 'Output', 'f_extra', 0),), lci_bg[:2], lci_ex,
+                            csr_matrix(af_flat), ad_flat.tocsr(), bf_flat.tocsr())
+        exchs = list(fb.foreground('f_model', 'f_product', traverse=True))  # terminates
+        self.assertEqual(len([x for x in exchs if x.term == 'f_extra']), 1)
+        self.assertIsNone(fb._fg_solver)  # foreground() does not need the solver
+        self.assertTrue(fb.fg_solver.triangular)
+
+    def test_foreground_solver(self):
+        triangular = np.array([[0, 0, 0], [0.5, 0, 0], [0.2, 3.0, 0]])
+        cyclic = np.array([[0, 0, 0.1], [0.5, 0, 0], [0.2, 3.0, 0]])
+        y = np.array([[1.0, 0], [0, 2.0], [0.5, 0]])
+        for af in (triangular, cyclic):
+            ima = np.eye(3) - af
+            for closure_max in (0, 1000):
+                fs = ForegroundSolver(csr_matrix(af), closure_max=closure_max)
+                self.assertEqual(fs.triangular, af is triangular)
+                self.assertEqual(fs.closure is None, closure_max == 0)
+                self.assertTrue(np.allclose(fs.solve(csr_matrix(y)).toarray(), np.linalg.solve(ima, y)))
+                self.assertTrue(np.allclose(fs.solve(csr_matrix(y[:, :1])).toarray(),
+                                            np.linalg.solve(ima, y[:, :1])))
+                self.assertTrue(np.allclose(fs.solve(csr_matrix(y), trans=True).toarray(),
+                                            np.linalg.solve(ima.T, y)))
+
+    def test_add_foreground(self):
+        fb = _lci_test_background()
+        lu = fb.factorize()
+        before = _lci_vector(fb, 'f_model', 'f_product')
+        new = fb.add_foreground(_new_foreground_archive().query, ['n_widget_maker'])
+        self.assertListEqual([t.term_ref for t in new], ['n_widget_maker', 'n_part_maker'])
+        self.assertEqual((fb.pdim, fb.ndim, fb.mdim), (4, 3, 3))
+        self.assertEqual(fb._B.shape, (3, 3))
+        self.assertIs(fb.factorization, lu)
+        self.assertTrue(fb.fg_solver.triangular)
+        self.assertTrue(np.allclose(_lci_vector(fb, 'f_model', 'f_product'), np.append(before, 0)))
+        expected = 0.25 * _dense_lci(0, background=True) + 0.5 * _dense_lci(1) + \
+            1.5 * 0.2 * _dense_lci(1, background=True)
+        self.assertTrue(np.allclose(_lci_vector(fb, 'n_widget_maker', 'n_widget'), np.append(expected, 0.05)))
+        self.assertListEqual(fb.add_foreground(_new_foreground_archive().query, ['n_widget_maker']), [])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+
+import numpy as np
+
+from antelope_core.archives import LcArchive
+from antelope_core.characterizations import QRResult
+from antelope_core.contexts import Context
+from antelope_core.entities import LcQuantity, LcFlow, LcProcess
+from antelope_core.implementations.quantity import QuantityConversion
+
+from ..implementation import TarjanBackgroundImplementation
+from .test_flat_background import _lci_test_background, lci_fg, lci_bg, lci_ex
+
+
+# characterization factors of the exterior flows
+lci_cfs = {'e_co2': 1.0, 'e_water': 0.25}
+
+
+def _fixture_archive():
+    """
+    Entities for the lci test background: one process per foreground and background node, and their flows
+    """
+    ar = LcArchive(None, ref='test.background.implementation')
+    mass = LcQuantity.new('Mass', 'kg')
+    ar.add(mass)
+    for flow_ref, _, _, _ in lci_fg + lci_bg + lci_ex:
+        ar.add(LcFlow(flow_ref, Name=flow_ref, ReferenceQuantity=mass))
+    for flow_ref, _, term_ref, _ in lci_fg + lci_bg:
+        p = LcProcess(term_ref, Name=term_ref)
+        ar.add(p)
+        p.add_exchange(ar[flow_ref], 'Output', value=1.0)
+        p.set_reference(ar[flow_ref], 'Output')
+    return ar
+
+
+class _FixtureBackground(TarjanBackgroundImplementation):
+    """
+    TarjanBackgroundImplementation over the lci test background.  Entity refs come from the fixture archive's own
+    query and characterization factors from lci_cfs, in place of a catalog index and quantity implementation.
+    """
+    def __init__(self, archive):
+        super(_FixtureBackground, self).__init__(archive)
+        self._flat = _lci_test_background()
+        self._flat.context_map = {term_ref: Context(term_ref) for _, _, term_ref, _ in lci_ex}
+
+    def check_bg(self, reset=False, **kwargs):
+        return True
+
+    def _fetch(self, external_ref, **kwargs):
+        return self._archive[external_ref].make_ref(self._archive.query)
+
+    def get_canonical(self, quantity_ref):
+        return quantity_ref
+
+    def _get_quantity_conversion(self, q_ref, ex):
+        f = self[ex.flow_ref]
+        return QuantityConversion(QRResult(f.name, f.reference_entity, q_ref, self._flat.context_map[ex.term_ref],
+                                           None, self.origin, lci_cfs[ex.flow_ref]))
+
+
+def _per_element_lcia(fb, process, ref_flow, char_vector):
+    """
+    deep_lcia's node weights and unit scores, found one element at a time
+    :return: dict of (term_ref, flow_ref) to (node_weight, unit_score)
+    """
+    sf, s = fb.unit_scores(char_vector)
+    xf, x = fb.activity_levels(process, ref_flow)
+    found = dict()
+    for terms, weights, scores, dim in ((fb.fg, xf, sf, fb.pdim), (fb.bg, x, s, fb.ndim)):
+        for i in range(dim):
+            if weights[0, i] != 0 and scores[0, i] != 0:
+                found[terms[i].term_ref, terms[i].flow_ref] = (weights[0, i], scores[0, i])
+    return found
+
+
+class TarjanBackgroundImplementationTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.gwp = LcQuantity.new('Test score', 'points')
+        cls.bi = _FixtureBackground(_fixture_archive())
+        cls.char_vector = cls.bi._characterize(cls.gwp)
+
+    def test_characterize(self):
+        self.assertTrue(np.allclose(self.char_vector.toarray(), [[lci_cfs[ex[0]] for ex in lci_ex]]))
+
+    def test_deep_lcia(self):
+        fb = self.bi._flat
+        for flow_ref, _, term_ref, _ in lci_fg + lci_bg:
+            expected = _per_element_lcia(fb, term_ref, flow_ref, self.char_vector)
+            total = self.char_vector.dot(fb.lci_many([(term_ref, flow_ref)]).matrix).toarray()[0, 0]
+            for detailed in (False, True):
+                with self.subTest(term_ref=term_ref, detailed=detailed):
+                    res = self.bi.deep_lcia(term_ref, self.gwp, ref_flow=flow_ref, detailed=detailed)
+                    self.assertSetEqual(set(res.keys()), set(expected.keys()))
+                    for key, (node_weight, unit_score) in expected.items():
+                        summary = res[key]
+                        self.assertEqual(summary.static, not detailed)  # detailed: scored exchange by exchange
+                        self.assertAlmostEqual(summary.node_weight, node_weight)
+                        self.assertAlmostEqual(summary.unit_score, unit_score)
+                    self.assertAlmostEqual(res.total(), total)
+
+    def test_score_all(self):
+        scores = self.bi.score_all(self.gwp)
+        self.assertSetEqual(set(scores.keys()), {(t[2], t[0]) for t in lci_fg + lci_bg})
+        for (term_ref, flow_ref), score in scores.items():
+            self.assertIsInstance(score, float)
+            self.assertAlmostEqual(score, self.bi.deep_lcia(term_ref, self.gwp, ref_flow=flow_ref).total())
+
+
+if __name__ == '__main__':
+    unittest.main()
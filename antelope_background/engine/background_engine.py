@@ -4,9 +4,11 @@ we will re-implement the recursion as an iteration with a stack:
 https://www.refactoring.com/catalog/replaceRecursionWithIteration.html
 
 """
+import os
 import re  # for product_flows search
+import time
 
-from collections import deque
+from collections import deque, defaultdict
 
 import numpy as np
 from scipy.sparse import csr_matrix  # , csc_matrix,
@@ -18,6 +20,12 @@ from antelope_core.contexts import NullContext
 from .tarjan_stack import TarjanStack
 from .product_flow import ProductFlow, NoMatchingReference
 from .emission import Emission
+from .prefetch import InventoryPrefetcher
+from .coo_buffer import CooBuffer, RepeatAdjustment
+from .term_table import pack_strings, unpack_strings
+
+__all__ = ['BackgroundEngine', 'TerminationError', 'NoAllocation', 'DequeError', 'RepeatAdjustment',
+           'Marker', 'ParentMarker', 'RecurseMarker']  # RepeatAdjustment now lives in coo_buffer
 
 
 class Marker:
@@ -50,10 +58,6 @@ class DequeError(Exception):
     pass
 
 
-class RepeatAdjustment(Exception):
-    pass
-
-
 class TerminationError(Exception):
     """
     This indicates that an ambiguous termination was encountered, with no valid means to resolve the ambiguity
@@ -61,56 +65,7 @@ class TerminationError(Exception):
     pass
 
 
-class MatrixProto(object):
-    """
-    # Exchanges: parent = column; term = row;
-    Value is modified to encode exchange direction: outputs must be negated at creation, inputs entered directly
-    """
-    def __init__(self, parent, value):
-        assert isinstance(parent, ProductFlow)
-        self._parent = parent
-        self._value = value
-        self._adjusted = False
-
-    @property
-    def parent(self):
-        return self._parent
-
-    @property
-    def value(self):
-        return self._value
-
-    def adjust_val(self):
-        if self._adjusted is False:
-            self._value /= self.parent.inbound_ev
-            self._adjusted = True
-        else:
-            raise RepeatAdjustment
-
-
-class MatrixEntry(MatrixProto):
-    def __init__(self, parent, term, value):
-        assert isinstance(term, ProductFlow)
-        super(MatrixEntry, self).__init__(parent, value)
-        self._term = term
-
-    @property
-    def term(self):
-        return self._term
-
-
-class CutoffEntry(MatrixProto):
-    """
-    # Cutoffs: parent = column; emission = row of B includes direction information; value is entered unmodified
-    """
-    def __init__(self, parent, emission, value):
-        assert isinstance(emission, Emission)
-        super(CutoffEntry, self).__init__(parent, value)
-        self._term = emission
-
-    @property
-    def emission(self):
-        return self._term
+_CHECKPOINT_DIRECTIONS = ('Input', 'Output')
 
 
 class NoAllocation(Exception):
@@ -121,7 +76,7 @@ class BackgroundEngine(object):
     """
     Class for converting a collection of linked processes into a coherent technology matrix.
     """
-    def __init__(self, query, quiet=True, preferred=None):
+    def __init__(self, query, quiet=True, preferred=None, prefetch=0, max_pending=None):
         """
         Construct an ordered background matrix from a query that implements basic, index and exchange.
         Required routes:
@@ -140,6 +95,10 @@ class BackgroundEngine(object):
         :param preferred: a dict mapping flow external refs to their preferred processes (by external ref).
         The special entry None should map to a list of process external_refs that should be preferred whenever they
         are found (in the order of preference)
+        :param prefetch: [0] number of threads used to fetch inventories of newly discovered nodes ahead of the
+         traversal.  Useful when inventory() is slow (remote or disk-backed archives) and the query can be used from
+         several threads.  The traversal, and its result, are unchanged.
+        :param max_pending: [4 * prefetch] maximum number of prefetched inventories held at one time
         """
         self.fg = query
         self._preferred_processes = {None: []}  # use to resolve termination errors. dict of flow_ref -> process
@@ -152,14 +111,16 @@ class BackgroundEngine(object):
         self.tstack = TarjanStack()  # ordering of sccs
 
         # hold exchanges before updating component graph
-        self._interior_incoming = []  # terminated entries -> added to the component graph
-        self._cutoff_incoming = []  # entries with no termination -> emissions
+        # interior entries: row = term, col = parent (ProductFlow indices); value is direction-adjusted
+        # cutoff entries: row = emission index, col = parent; value is entered unmodified
+        self._interior_incoming = CooBuffer()  # terminated entries -> added to the component graph
+        self._cutoff_incoming = CooBuffer()  # entries with no termination -> emissions
 
         # _interior_incoming entries get sorted into:
-        self._interior = []  # MatrixEntries whose parent (column) is background - A*
-        self._foreground = []  # MatrixEntries whose parent is upstream of the background - Af + Ad
-        self._bg_emission = []  # CutoffEntries whose parent is background - B*
-        self._cutoff = []  # CutoffEntries whose parent is foreground - Bf
+        self._interior = CooBuffer()  # interior entries whose parent (column) is background - A*
+        self._foreground = CooBuffer()  # interior entries whose parent is upstream of the background - Af + Ad
+        self._bg_emission = CooBuffer()  # cutoff entries whose parent is background - B*
+        self._cutoff = CooBuffer()  # cutoff entries whose parent is foreground - Bf
 
         self._product_flows = dict()  # maps product_flow.key to index-- being position in _pf_index
         self._pf_index = []  # maps index to product_flow in order added
@@ -175,6 +136,14 @@ class BackgroundEngine(object):
         self._emissions = dict()  # maps emission key to index
         self._ef_index = []  # maps index to emission
 
+        self._prefetch = InventoryPrefetcher(prefetch, max_pending=max_pending)
+
+        self._targets_cache = dict()  # maps (flow_ref, direction) to list of targets() results
+        self._targets_prefetched = set()  # cache keys filled by the prefetch stage, not yet used by the traversal
+        self._term_resolved = 0
+        self._term_hits = 0
+        self._term_ambiguous = 0
+
     def _print(self, *args):
         if not self._quiet:
             print(*args)
@@ -206,30 +175,30 @@ class BackgroundEngine(object):
         self._pf_index.append(pf)
         self.tstack.add_to_stack(pf)
 
-    def _rm_product_flow_children(self, bad_pf):
+    def _rm_product_flow_children(self, bad_pf, n_emissions):
         """
-        Used only to back-out the links in-progress when a TerminationError is encountered.
-        This needs desperately to be tested. U
-        :param bad_pf:
+        Used only to back-out the links in-progress when a TerminationError is encountered.  Every product flow
+        created since the top-level bad_pf (inclusive), the SCCs and entries they belong to, and any emissions
+        created since then, are removed, leaving the engine as it was before bad_pf was added.
+        :param bad_pf: the top-level product flow whose traversal failed
+        :param n_emissions: number of emissions that existed before bad_pf was added
         :return:
         """
         self._r_stack.clear()
-        while len(self._interior_incoming) > 0:
-            pf = self.tstack.pop_from_stack()
-            self._print('!!!removing %s' % pf)
-            while 1:
-                z = self._pf_index.pop()
-                self._lowlinks.pop(z.key)
-                self._product_flows.pop(z.key)
-                if z is pf:
-                    break
-                self._print('--!removing %s' % z)
-            while self._interior_incoming and self._interior_incoming[-1].parent is pf:
-                self._interior_incoming.pop()
-            while self._cutoff_incoming and self._cutoff_incoming[-1].parent is pf:
-                self._cutoff_incoming.pop()
-            if pf is bad_pf:
-                break
+        index = bad_pf.index
+        self.tstack.back_out(index)
+        while len(self._pf_index) > index:
+            z = self._pf_index.pop()
+            self._print('--!removing %s' % z)
+            self._lowlinks.pop(z.key, None)
+            self._product_flows.pop(z.key)
+        # entries are appended in traversal order, so those of the removed product flows are all at the end
+        for buf in (self._interior_incoming, self._cutoff_incoming):
+            bad = np.flatnonzero(buf.col >= index)
+            if len(bad) > 0:
+                buf.truncate(bad[0])
+        while len(self._ef_index) > n_emissions:
+            self._emissions.pop(self._ef_index.pop().key)
 
     def _set_lowlink(self, pf, lowlink):
         """
@@ -295,11 +264,28 @@ class BackgroundEngine(object):
         Find the ProductFlow that terminates a given exchange.  If an exchange has an explicit termination, use it.
         Else if flow / direction / term are already seen, use it.
         Else if flow is found in list of preferred providers, use designated provider (None -> cutoff)
-        lastly, ask archive for valid targets. If this list has length != 1, defer to designated strategy or raise error
+        lastly, ask archive for valid targets. If this list has length != 1, defer to designated strategy or raise error.
+        The result of the last step's query is cached by flow and direction.
         :param exch:
         :param strategy:
         :return:
         """
+        return self._terminate(exch, strategy)
+
+    def _peek_termination(self, exch):
+        """
+        Resolve a termination for the prefetch stage without side effects on the traversal: ambiguous terminations
+        and bad preferred providers give None rather than raising, and cache statistics are not updated.  targets()
+        results are cached and shared with terminate().
+        :param exch:
+        :return:
+        """
+        try:
+            return self._terminate(exch, None, peek=True)
+        except Exception:  # speculative: any error will recur, and be reported, during the traversal
+            return None
+
+    def _terminate(self, exch, strategy, peek=False):
         if isinstance(exch.termination, str):
             return self.fg.get(exch.termination)
         else:
@@ -315,33 +301,71 @@ class BackgroundEngine(object):
                     raise TypeError('%s: Bad preferred provider %s' % (exch.flow.external_ref, term))
                 return term
 
-            terms = [t for t in self.fg.targets(exch.flow, direction=exch.direction)]
+            terms = self._targets(exch.flow, exch.direction, peek=peek)
             if len(terms) == 0:
                 return None
             elif len(terms) == 1:
-                term = terms[0]
+                return terms[0]  # targets() returns refs- no need to get again
+            t_map = {t.external_ref: t for t in terms}
+            pref = self._preferred_processes[None]
+            for p in pref:
+                if p in t_map:
+                    return t_map[p]
+            if peek:
+                return None
+            if strategy == 'abort':
+                print('flow: %s\nAmbiguous termination found for %s: %s' % (exch.flow.external_ref,
+                                                                            exch.direction, exch.flow))
+                raise TerminationError
+            elif strategy == 'first':
+                return terms[0]
+            elif strategy == 'last':
+                return terms[-1]
+            elif strategy == 'cutoff':
+                return None
+            elif strategy == 'mix':
+                raise NotImplementedError('MIX not presently supported (for some reason)')
+                # return self.fg.mix(exch.flow, exch.direction)
             else:
-                t_map = {t.external_ref: t for t in terms}
-                pref = self._preferred_processes[None]
-                for p in pref:
-                    if p in t_map:
-                        return t_map[p]
-                if strategy == 'abort':
-                    print('flow: %s\nAmbiguous termination found for %s: %s' % (exch.flow.external_ref,
-                                                                                exch.direction, exch.flow))
-                    raise TerminationError
-                elif strategy == 'first':
-                    term = terms[0]
-                elif strategy == 'last':
-                    term = terms[-1]
-                elif strategy == 'cutoff':
-                    return None
-                elif strategy == 'mix':
-                    raise NotImplementedError('MIX not presently supported (for some reason)')
-                    # return self.fg.mix(exch.flow, exch.direction)
-                else:
-                    raise KeyError('Unknown multi-termination strategy %s' % strategy)
-            return term  # targets() returns refs- no need to get again
+                raise KeyError('Unknown multi-termination strategy %s' % strategy)
+
+    def _targets(self, flow, direction, peek=False):
+        """
+        Valid targets for a flow and direction, as reported by the archive.  Results are cached, so that each
+        (flow, direction) is queried only once whatever strategy is used to resolve it.  Statistics count the
+        traversal's lookups only: a result first fetched by the prefetch stage counts as resolved, not as a hit, when
+        the traversal first uses it.
+        :param flow:
+        :param direction:
+        :param peek: [False] lookup by the prefetch stage
+        :return: list of process refs
+        """
+        key = (flow.external_ref, direction)
+        terms = self._targets_cache.get(key)
+        if terms is None:
+            terms = self._targets_cache[key] = [t for t in self.fg.targets(flow, direction=direction)]
+            if peek:
+                self._targets_prefetched.add(key)
+                return terms
+        elif peek:
+            return terms
+        elif key in self._targets_prefetched:
+            self._targets_prefetched.remove(key)
+        else:
+            self._term_hits += 1
+            return terms
+        self._term_resolved += 1
+        if len(terms) > 1:
+            self._term_ambiguous += 1
+        return terms
+
+    @property
+    def termination_stats(self):
+        """
+        :return: dict of 'resolved': distinct (flow, direction) pairs queried with targets(), 'hits': lookups answered
+         from the cache, 'ambiguous': pairs with more than one target
+        """
+        return {'resolved': self._term_resolved, 'hits': self._term_hits, 'ambiguous': self._term_ambiguous}
 
     @staticmethod
     def construct_sparse(nums, nrows, ncols):
@@ -370,9 +394,9 @@ class BackgroundEngine(object):
         """
         if self._b_matrix is not None:
             raise ValueError('B matrix already specified!')
-        num_bg = np.array([[co.emission.index, self.tstack.bg_dict(co.parent.index), co.value]
-                           for co in self._bg_emission])
-        self._b_matrix = self.construct_sparse(num_bg, self.mdim, self.tstack.ndim)
+        bg = self._bg_columns()
+        co = self._bg_emission
+        self._b_matrix = csr_matrix((co.value, (co.row, bg[co.col])), shape=(self.mdim, self.tstack.ndim))
 
     def _pad_b_matrix(self):
         print('Growing B matrix from %d to %d rows' % (self._b_matrix.shape[0], self.mdim))
@@ -382,9 +406,17 @@ class BackgroundEngine(object):
 
     def _construct_a_matrix(self):
         ndim = self.tstack.ndim
-        num_bg = np.array([[self.tstack.bg_dict(i.term.index), self.tstack.bg_dict(i.parent.index), i.value]
-                           for i in self._interior])
-        self._a_matrix = self.construct_sparse(num_bg, ndim, ndim)
+        bg = self._bg_columns()
+        i = self._interior
+        self._a_matrix = csr_matrix((i.value, (bg[i.row], bg[i.col])), shape=(ndim, ndim))
+
+    def _bg_columns(self):
+        """
+        :return: array mapping ProductFlow.index to A* / B* column, -1 for foreground product flows
+        """
+        bg = np.full(len(self._pf_index), -1, dtype=np.int64)
+        bg[np.array([pf.index for pf in self.tstack.background_flows()], dtype=np.int64)] = np.arange(self.tstack.ndim)
+        return bg
 
     '''required for create_flat_background
     '''
@@ -447,23 +479,11 @@ class BackgroundEngine(object):
         little archive Foregrounds.  A background database with cutoffs will properly situate the cutoffs in the B
         matrix, where they are treated equivalently.
         """
-        af_exch = []
-        ad_exch = []
-        fg_cutoff = []
+        bg = self._bg_columns()
         if product_flow is None:
-            pdim = self.tstack.pdim
-
-            def fg_dict(x):
-                return self.tstack.fg_dict(x)
-
-            bf_exch = self._cutoff
-            if self.tstack.pdim == 0:
+            product_flows = list(self.tstack.foreground_flows())
+            if len(product_flows) == 0:
                 return None, None, None
-            for fg in self._foreground:
-                if self.is_in_background(fg.term.index):
-                    ad_exch.append(fg)
-                else:
-                    af_exch.append(fg)
         else:
             if self.is_in_background(product_flow):
                 _af = self.construct_sparse([], 1, 1)
@@ -473,55 +493,48 @@ class BackgroundEngine(object):
                 return _af, _ad, _bf
 
             product_flows = self.foreground(product_flow)
-            pdim = len(product_flows)
-            bf_exch = []
-            _fg_dict = dict((pf.index, n) for n, pf in enumerate(product_flows))
-
-            def fg_dict(x):
-                return _fg_dict[x]
-
-            for fg in self._foreground:
-                if fg.parent.index in _fg_dict:
-                    if self.is_in_background(fg.term.index):
-                        ad_exch.append(fg)
-                    elif fg.term.index in _fg_dict:
-                        af_exch.append(fg)
-                    else:
-                        fg_cutoff.append(fg)
-            for co in self._cutoff:
-                if co.parent.index in _fg_dict:
-                    bf_exch.append(co)
-
-        num_af = np.array([[fg_dict(i.term.index), fg_dict(i.parent.index), i.value] for i in af_exch])
-        num_ad = np.array([[self.tstack.bg_dict(i.term.index), fg_dict(i.parent.index), i.value] for i in ad_exch])
-        num_bf = np.array([[co.emission.index, fg_dict(co.parent.index), co.value] for co in bf_exch])
+        pdim = len(product_flows)
+        fg = np.full(len(self._pf_index), -1, dtype=np.int64)  # maps ProductFlow.index to af / ad / bf column
+        fg[np.array([pf.index for pf in product_flows], dtype=np.int64)] = np.arange(pdim)
+
+        ent = self._foreground
+        cols = fg[ent.col]
+        in_fg = cols >= 0
+        to_bg = in_fg & (bg[ent.row] >= 0)
+        to_fg = in_fg & (fg[ent.row] >= 0)
+        co = self._cutoff
+        co_cols = fg[co.col]
+        in_bf = co_cols >= 0
+
         ndim = self.tstack.ndim
-        _af = self.construct_sparse(num_af, pdim, pdim)
-        _ad = self.construct_sparse(num_ad, ndim, pdim)
-        _bf = self.construct_sparse(num_bf, self.mdim, pdim)
-        if len(fg_cutoff) > 0:
-            for co in fg_cutoff:
-                # this should never happen
-                print('Losing FG Cutoff %s' % co)
+        _af = csr_matrix((ent.value[to_fg], (fg[ent.row[to_fg]], cols[to_fg])), shape=(pdim, pdim))
+        _ad = csr_matrix((ent.value[to_bg], (bg[ent.row[to_bg]], cols[to_bg])), shape=(ndim, pdim))
+        _bf = csr_matrix((co.value[in_bf], (co.row[in_bf], co_cols[in_bf])), shape=(self.mdim, pdim))
+        lost = np.flatnonzero(in_fg & ~to_bg & ~to_fg)
+        for k in lost:
+            # this should never happen
+            print('Losing FG Cutoff %s -> %s: %g' % (self.product_flow(int(ent.col[k])),
+                                                     self.product_flow(int(ent.row[k])), ent.value[k]))
         return _af, _ad, _bf
 
     def _update_component_graph(self):
-        self.tstack.add_to_graph(self._interior_incoming)  # background should be brought up to date
-        while len(self._interior_incoming) > 0:
-            k = self._interior_incoming.pop()
-            k.adjust_val()
-            if self.is_in_background(k.parent.index):
-                self._interior.append(k)
-            else:
-                self._foreground.append(k)
-
-        while len(self._cutoff_incoming) > 0:
-            k = self._cutoff_incoming.pop()
-            k.adjust_val()
-            if self.is_in_background(k.parent.index):
-                self._bg_emission.append(k)
-            else:
-                self._cutoff.append(k)
+        incoming = self._interior_incoming
+        pfs = self._pf_index
+        self.tstack.add_to_graph((pfs[r], pfs[c]) for r, c in zip(incoming.row.tolist(), incoming.col.tolist()))
+        # background should be brought up to date
+        inbound_ev = np.array([pf.inbound_ev for pf in pfs], dtype=np.float64)
+        bg = self._bg_columns() >= 0
+
+        incoming.adjust(inbound_ev)
+        self._interior.extend(incoming, bg[incoming.col])
+        self._foreground.extend(incoming, ~bg[incoming.col])
+        incoming.clear()
+
+        cutoffs = self._cutoff_incoming
+        cutoffs.adjust(inbound_ev)
+        self._bg_emission.extend(cutoffs, bg[cutoffs.col])
+        self._cutoff.extend(cutoffs, ~bg[cutoffs.col])
+        cutoffs.clear()
 
         # if self.tstack.background is None:
         #     return
@@ -539,24 +552,158 @@ class BackgroundEngine(object):
 
         # self.make_foreground()
 
-    def add_all_ref_products(self, multi_term='abort', default_allocation=None):
+    def add_all_ref_products(self, multi_term='abort', default_allocation=None, checkpoint=None,
+                             checkpoint_interval=600):
         """
 
         :param multi_term:
         :param default_allocation:
         The list-of-2-tuples is tested in UsLciEcospoldTest; the legacy list-of-processes is tested in UsLciOlcaTest
+        :param checkpoint: [None] filename. If given, the traversal state is written to this file every
+         checkpoint_interval seconds (between top-level reference products) and when a TerminationError is
+         encountered.  A failed build can then be continued with BackgroundEngine.resume().
+        :param checkpoint_interval: [600] minimum number of seconds between checkpoints
         :return:
         """
         if self._all_added:
             return
-        for p in self.fg.processes(count=self.fg.count('process')):
-            for x in p.references():
-                j = self.check_product_flow(x.flow, p)
-                if j is None:
-                    self._add_ref_product_deque(x.flow, p, multi_term, default_allocation)
+        if checkpoint is not None and self._a_matrix is not None:
+            raise ValueError('Cannot checkpoint an engine whose component graph has already been built')
+        last = time.time()
+        try:
+            for p in self.fg.processes(count=self.fg.count('process')):
+                for x in p.references():
+                    j = self.check_product_flow(x.flow, p)
+                    if j is None:
+                        try:
+                            self._add_ref_product_deque(x.flow, p, multi_term, default_allocation)
+                        except TerminationError:
+                            if checkpoint is not None:
+                                self.write_checkpoint(checkpoint)  # state has been backed out to the last top-level
+                            raise
+                        if checkpoint is not None and time.time() - last > checkpoint_interval:
+                            self.write_checkpoint(checkpoint)
+                            last = time.time()
+        finally:
+            self.close()  # later traversals fetch inventories on demand
         self._update_component_graph()
         self._all_added = True
 
+    def close(self):
+        """
+        Shut down the prefetch thread pool, discarding any inventories that were requested but not collected.  The
+        engine remains usable, without prefetching.
+        :return:
+        """
+        self._prefetch.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write_checkpoint(self, filename):
+        """
+        Write the state of an unfinished add_all_ref_products() to a compressed .npz file: product flows (with their
+        SCCs, lowlinks and inbound exchange values), emissions, and the pending interior and cutoff entries.
+        Entities are stored by external ref.  Only possible between top-level reference products and before the
+        component graph is built.
+        :param filename:
+        :return:
+        """
+        if len(self._r_stack) > 0 or self._a_matrix is not None:
+            raise ValueError('Checkpoints can only be written between top-level reference products')
+        assert self.tstack.depth == 0, 'Tarjan stack is not empty'
+        codes = dict()
+
+        def _code(s):
+            return codes.setdefault(s, len(codes))
+
+        def _cx_name(cx):
+            return '; '.join(cx.as_list()) if cx else ''
+
+        pfs = self._pf_index
+        ems = self._ef_index
+        arrays = {
+            'pf_flow': np.array([_code(pf.flow.external_ref) for pf in pfs], dtype=np.int32),
+            'pf_process': np.array([_code(pf.process.external_ref) for pf in pfs], dtype=np.int32),
+            'pf_direction': np.array([_CHECKPOINT_DIRECTIONS.index(pf.direction) for pf in pfs], dtype=np.int8),
+            'pf_inbound_ev': np.array([pf.inbound_ev for pf in pfs], dtype=np.float64),
+            'pf_lowlink': np.array([self._lowlink(pf) for pf in pfs], dtype=np.int64),
+            'pf_scc': np.array([self.tstack.scc_id(pf) for pf in pfs], dtype=np.int64),
+            'em_flow': np.array([_code(em.flow.external_ref) for em in ems], dtype=np.int32),
+            'em_direction': np.array([_CHECKPOINT_DIRECTIONS.index(em.direction) for em in ems], dtype=np.int8),
+            'em_context': np.array([_code(_cx_name(em.context)) for em in ems], dtype=np.int32),
+            'interior_parent': self._interior_incoming.col,
+            'interior_term': self._interior_incoming.row,
+            'interior_value': self._interior_incoming.value,
+            'cutoff_parent': self._cutoff_incoming.col,
+            'cutoff_emission': self._cutoff_incoming.row,
+            'cutoff_value': self._cutoff_incoming.value,
+            'missing': np.array([[_code(t), _code(f)] for t, f in self.missing_references],
+                                dtype=np.int32).reshape(-1, 2)
+        }
+        arrays['string_data'], arrays['string_offsets'] = pack_strings(list(codes))
+        tmp = filename + '.tmp.npz'
+        with open(tmp, 'wb') as fp:
+            np.savez_compressed(fp, **arrays)
+        os.replace(tmp, filename)
+        self._print('Wrote checkpoint with %d product flows to %s' % (len(pfs), filename))
+
+    @classmethod
+    def resume(cls, query, checkpoint, **kwargs):
+        """
+        Create an engine from a checkpoint written by write_checkpoint().  Call add_all_ref_products() on the result
+        to continue the build: reference products already traversed are skipped.
+        :param query: the same query the checkpointed engine used
+        :param checkpoint: filename
+        :param kwargs: passed to the constructor (e.g. preferred providers to resolve a TerminationError)
+        :return: a BackgroundEngine
+        """
+        be = cls(query, **kwargs)
+        try:
+            be._read_checkpoint(checkpoint)
+        except Exception:
+            be.close()
+            raise
+        return be
+
+    def _read_checkpoint(self, filename):
+        if len(self._pf_index) > 0:
+            raise ValueError('Checkpoints can only be read into a new engine')
+        with np.load(filename, allow_pickle=False) as d:
+            strings = unpack_strings(d['string_data'], d['string_offsets'])
+            refs = dict()
+
+            def _get(k):
+                if k not in refs:
+                    refs[k] = self.fg.get(strings[k])
+                return refs[k]
+
+            sccs = defaultdict(list)
+            for i, (f, p, dn, ev, ll, s) in enumerate(zip(d['pf_flow'], d['pf_process'], d['pf_direction'],
+                                                           d['pf_inbound_ev'], d['pf_lowlink'], d['pf_scc'])):
+                pf = ProductFlow(i, _get(f), _get(p), direction=_CHECKPOINT_DIRECTIONS[dn], inbound_ev=float(ev))
+                self._product_flows[pf.key] = i
+                self._pf_index.append(pf)
+                self._lowlinks[pf.key] = int(ll)
+                sccs[int(s)].append(pf)
+            for k, nodes in sccs.items():
+                self.tstack.add_scc(k, nodes[::-1])  # label_scc adds nodes in reverse order of discovery
+
+            contexts = dict()
+            for f, dn, c in zip(d['em_flow'], d['em_direction'], d['em_context']):
+                if c not in contexts:
+                    contexts[c] = self.fg.get_context(tuple(strings[c].split('; '))) if strings[c] else None
+                self._add_emission(_get(f), _CHECKPOINT_DIRECTIONS[dn], contexts[c])
+
+            for p, t, v in zip(d['interior_parent'], d['interior_term'], d['interior_value']):
+                self._interior_incoming.append(t, p, v)
+            for p, e, v in zip(d['cutoff_parent'], d['cutoff_emission'], d['cutoff_value']):
+                self._cutoff_incoming.append(e, p, v)
+            self.missing_references = [(strings[t], strings[f]) for t, f in d['missing']]
+
     def add_ref_product(self, flow, term, multi_term='abort', default_allocation=None):
         """
         Here we are adding a reference product - column of the A + B matrix.  The termination must be supplied.
@@ -671,21 +818,26 @@ class BackgroundEngine(object):
     def _add_ref_product_deque(self, flow, term, multi_term, default_allocation):
         if len(self._r_stack) != 0:
             raise DequeError('Recursion stack is not empty')
+        n_emissions = len(self._ef_index)
         j = self._create_product_flow(flow, term)
         if j is None:
             # _create_product_flow already prints a MissingReference message
             return
 
-        self._dq_put_node_on_stack(j)
+        try:
+            self._dq_put_node_on_stack(j)
 
-        while len(self._r_stack) > 0:
-            try:
-                self._dq_handle_stack(multi_term, default_allocation)
-            except TerminationError:
-                self._rm_product_flow_children(j)
-                print('Termination Error: process %s: ref_flow %s, ' % (j.process.external_ref, j.flow.external_ref))
+            while len(self._r_stack) > 0:
+                try:
+                    self._dq_handle_stack(multi_term, default_allocation)
+                except TerminationError:
+                    self._rm_product_flow_children(j, n_emissions)
+                    print('Termination Error: process %s: ref_flow %s, ' % (j.process.external_ref,
+                                                                            j.flow.external_ref))
 
-                raise
+                    raise
+        finally:
+            self._prefetch.clear()
 
         return j
 
@@ -706,10 +858,34 @@ class BackgroundEngine(object):
         self._r_stack.appendleft(ParentMarker())
         self._r_stack.append(parent)
 
-        rx = parent.process.reference(parent.flow)
-        exchs = parent.process.inventory(ref_flow=rx)  # allocated exchanges
+        rx, exchs = self._prefetch.fetch(parent.process, parent.flow)  # allocated exchanges
 
-        self._r_stack.extendleft(list(exchs))
+        self._r_stack.extendleft(exchs)
+        self._dq_prefetch_terms(exchs)
+
+    def _dq_prefetch_terms(self, exchs):
+        """
+        Request inventories for the novel interior nodes that these exchanges lead to, in the order the traversal
+        will visit them (the exchanges are handled from the left end of the stack, i.e. in reverse).  Ambiguous
+        terminations are skipped.
+        :param exchs:
+        :return:
+        """
+        if not self._prefetch.enabled:
+            return
+        for exch in reversed(exchs):
+            if exch.is_reference or not exch.value:
+                continue
+            term = self._peek_termination(exch)
+            if term is not None and self.check_product_flow(exch.flow, term) is None:
+                self._prefetch.request(term, exch.flow)
+
+    @property
+    def prefetch_stats(self):
+        """
+        :return: (hits, misses) -- inventories collected from the prefetcher, and fetched on demand
+        """
+        return self._prefetch.hits, self._prefetch.misses
 
     def _dq_handle_stack(self, multi_term, default_allocation):
         obj = self._r_stack[0]
@@ -837,7 +1013,7 @@ class BackgroundEngine(object):
         :param emission: emission - B matrix row
         :param val: raw exchange value
         """
-        self._cutoff_incoming.append(CutoffEntry(parent, emission, val))
+        self._cutoff_incoming.append(emission.index, parent.index, val)
 
     def add_interior(self, parent, term, val):
         """
@@ -853,4 +1029,4 @@ class BackgroundEngine(object):
             self._print('self-dependency detected! %s' % parent.process)
             parent.adjust_ev(val)
         else:
-            self._interior_incoming.append(MatrixEntry(parent, term, val))
+            self._interior_incoming.append(term.index, parent.index, val)
@@ -1,11 +1,13 @@
 from abc import ABC
-from typing import Generator, Optional, Iterable
+from typing import Generator, Optional, Iterable, Tuple
 from collections import namedtuple
 
 from antelope_core.contexts import Context
 
 
 class TermRef(object):
+    __slots__ = ('_f', '_d', '_t', '_s')
+
     def __init__(self, flow_ref, direction, term_ref, scc_id=None):
         """
 
@@ -64,6 +66,27 @@ An ExchDef is a serialized exchange definition. It should contain:
 ExchDef = namedtuple('ExchDef', ('process', 'flow', 'direction', 'term', 'value'))
 
 
+"""
+An ExchDefBatch is a columnar form of a sequence of ExchDefs from one process whose terminations all belong to the
+same table of TermRefs. It should contain:
+.process = a string node ref
+.terms = the sequence of TermRefs (foreground, background, or exterior) that the indices refer to
+.index = integer array of positions in terms
+.direction = integer array of directions w.r.t. the process: 0 for 'Input', 1 for 'Output'
+.value = float array of exchange values
+"""
+ExchDefBatch = namedtuple('ExchDefBatch', ('process', 'terms', 'index', 'direction', 'value'))
+
+
+"""
+LciColumns is a columnar LCI result for a batch of requests. It should contain:
+.terms = a tuple of (process_ref, flow_ref) pairs, one per column
+.exterior = the sequence of exterior TermRefs, one per row
+.matrix = a sparse (len(exterior) x len(terms)) matrix of LCI results
+"""
+LciColumns = namedtuple('LciColumns', ('terms', 'exterior', 'matrix'))
+
+
 class BackgroundLayer(ABC):
     """
     the functions that are required by our background implementation
@@ -122,5 +145,23 @@ class BackgroundLayer(ABC):
     def lci(self, process_ref: str, ref_flow: str) -> Generator[ExchDef, None, None]:
         raise NotImplementedError
 
+    def dependencies_batch(self, process_ref: str, ref_flow: str) -> Tuple[ExchDefBatch, ...]:
+        raise NotImplementedError
+
+    def exterior_batch(self, process_ref: str, ref_flow: str) -> ExchDefBatch:
+        raise NotImplementedError
+
+    def ad_batch(self, process_ref: str, ref_flow: str) -> ExchDefBatch:
+        raise NotImplementedError
+
+    def bf_batch(self, process_ref: str, ref_flow: str) -> ExchDefBatch:
+        raise NotImplementedError
+
+    def lci_batch(self, process_ref: str, ref_flow: str) -> ExchDefBatch:
+        raise NotImplementedError
+
+    def lci_many(self, terms: Iterable) -> LciColumns:
+        raise NotImplementedError
+
     def sys_lci(self, demand: Iterable) -> Generator[ExchDef, None, None]:
         raise NotImplementedError
@@ -0,0 +1,101 @@
+"""
+Growable typed-array storage for the sparse matrix entries accumulated by the BackgroundEngine
+"""
+
+import numpy as np
+
+
+class RepeatAdjustment(Exception):
+    pass
+
+
+class CooBuffer(object):
+    """
+    Sparse matrix entries in coordinate form, stored in typed arrays that grow by doubling.  Each entry has a row, a
+    column, a value, and a flag recording whether the value has been adjusted, i.e. divided by its column's inbound
+    exchange value.  Rows and columns are ProductFlow or Emission indices until the matrices are constructed.
+    """
+    def __init__(self, capacity=1024):
+        self._row = np.empty(capacity, dtype=np.int64)
+        self._col = np.empty(capacity, dtype=np.int64)
+        self._val = np.empty(capacity, dtype=np.float64)
+        self._adj = np.zeros(capacity, dtype=bool)
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def _reserve(self, n):
+        need = self._n + n
+        if need <= len(self._row):
+            return
+        cap = max(need, 2 * len(self._row))
+        for k in ('_row', '_col', '_val', '_adj'):
+            old = getattr(self, k)
+            new = np.zeros(cap, dtype=old.dtype)
+            new[:self._n] = old[:self._n]
+            setattr(self, k, new)
+
+    def append(self, row, col, value):
+        self._reserve(1)
+        n = self._n
+        self._row[n] = row
+        self._col[n] = col
+        self._val[n] = value
+        self._adj[n] = False
+        self._n += 1
+
+    def extend(self, other, mask=None):
+        """
+        Append the entries of another buffer, or those selected by a boolean mask, keeping their adjustment state
+        :param other: a CooBuffer
+        :param mask: [None] boolean array over other's entries
+        :return:
+        """
+        sl = slice(None) if mask is None else mask
+        rows = other.row[sl]
+        self._reserve(len(rows))
+        n, m = self._n, self._n + len(rows)
+        self._row[n:m] = rows
+        self._col[n:m] = other.col[sl]
+        self._val[n:m] = other.value[sl]
+        self._adj[n:m] = other.adjusted[sl]
+        self._n = m
+
+    @property
+    def row(self):
+        return self._row[:self._n]
+
+    @property
+    def col(self):
+        return self._col[:self._n]
+
+    @property
+    def value(self):
+        return self._val[:self._n]
+
+    @property
+    def adjusted(self):
+        return self._adj[:self._n]
+
+    def adjust(self, inbound_ev):
+        """
+        Divide each entry's value by the inbound exchange value of its column
+        :param inbound_ev: array of inbound exchange values, indexed by column
+        :return:
+        """
+        if self.adjusted.any():
+            raise RepeatAdjustment
+        self._val[:self._n] /= inbound_ev[self.col]
+        self._adj[:self._n] = True
+
+    def truncate(self, n):
+        """
+        Discard all but the first n entries
+        :param n:
+        :return:
+        """
+        self._n = min(self._n, n)
+
+    def clear(self):
+        self._n = 0
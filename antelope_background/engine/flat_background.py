@@ -2,34 +2,60 @@
 class for storing static results of a tarjan ordering
 """
 
-from scipy.sparse import csc_matrix, csr_matrix
-from scipy.sparse.linalg import inv, factorized, spsolve
-from scipy.sparse import eye
-from scipy.io import savemat, loadmat
-
+from scipy.sparse import csc_matrix, csr_matrix, issparse
+from scipy.sparse.linalg import splu, spsolve
+from scipy.sparse import eye, diags, vstack, hstack, bmat, triu
+from scipy.io import savemat, loadmat, whosmat
+
+import numpy as np
+import hashlib
+import shutil
+from collections import defaultdict
+from threading import Lock, local
 import os
 
 from antelope import CONTEXT_STATUS_, comp_dir  # , num_dir
 from antelope.models import UnallocatedExchange, Exchange
-from .background_layer import BackgroundLayer, TermRef, ExchDef
+from antelope_core.contexts import NullContext
+from .background_layer import BackgroundLayer, ExchDef, ExchDefBatch, LciColumns
 from .background_engine import BackgroundEngine
-from antelope_core import from_json, to_json
+from .product_flow import ProductFlow, NoMatchingReference
+from .solvers import (LuFactorization, KrylovSolver, ForegroundSolver, BlockTriangularSolver, scc_blocks,
+                      KRYLOV_SOLVERS)
+from .lci_cache import LciCache
+from .npy_storage import (write_sparse_npy, read_sparse_npy, has_sparse_npy, write_array_npy, read_array_npy,
+                          has_array_npy, clear_npy, sparse_column)
+from .hdf5_storage import write_hdf5, read_hdf5, hdf5_matrix_names
+from .term_table import TermTable, write_ordering, read_ordering
+from antelope_core import from_json
 
 
-SUPPORTED_FILETYPES = ('.mat', )
+SUPPORTED_FILETYPES = ('.mat', '.hdf', '.mmap')
 
 _FLATTEN_AF = False
 
+_FG_CLOSURE_MAX = 1000  # cache the foreground closure (I - Af)^-1 if pdim is no larger than this
+
+
+_DIRECTIONS = ('Input', 'Output')
+
 
 class NoLciDatabase(Exception):
     pass
 
 
-def _iterate_a_matrix(a, y, threshold=1e-8, count=100, quiet=False, solver=None):
+def _iterate_a_matrix(a, y, threshold=1e-8, count=100, quiet=False, solver=None, **kwargs):
+    """
+    Computes (I - a)^-1 y by power series, unless solver='spsolve'.  Options for other solvers are ignored.
+    """
     if solver == 'spsolve':
-        ima = eye(a.shape[0]) - a
+        ima = (eye(a.shape[0]) - a).tocsc()
+        if issparse(y):
+            y = y.tocsc()
         x = spsolve(ima, y)
-        return csr_matrix(x).T
+        if issparse(x):  # multi-column sparse RHS
+            return csr_matrix(x)
+        return _sparse_result(x)
     y = csr_matrix(y)  # tested this with ecoinvent: convert to sparse: 280 ms; keep full: 4.5 sec
     total = csr_matrix(y.shape)
     if a is None:
@@ -60,46 +86,91 @@ def _unit_column_vector(dim, inx):
     return csr_matrix(((1,), ((inx,), (0,))), shape=(dim, 1))
 
 
-def split_af(_af, _inds):
+def _dense_rhs(y):
     """
-    splits the input matrix into diagonal and off-diagonal portions, with the split being determined by _inds
-    :param _af:
-    :param _inds:
+    Direct solvers want a dense right-hand side: 1-d for a single column, 2-d otherwise
+    :param y: sparse or dense column(s)
     :return:
     """
+    if issparse(y):
+        y = y.toarray()
+    y = np.asarray(y, dtype=float)
+    if y.ndim == 2 and y.shape[1] == 1:
+        return y[:, 0]
+    return y
+
+
+def _sparse_result(x):
+    if x.ndim == 1:
+        return csr_matrix(x).T
+    return csr_matrix(x)
+
+
+def split_af(_af, _blocks):
+    """
+    splits the input matrix into block-diagonal and off-diagonal portions, with the blocks being determined by _blocks.
+    An entry belongs to the block-diagonal portion if its row and column are in the same block.
+    :param _af:
+    :param _blocks: array of block numbers, one per row / column, with -1 for nodes that belong to no block
+    :return: _af_non, _af_scc
+    """
     _af = _af.tocoo()
-    _r = _af.row
-    _c = _af.col
-    _d = _af.data
-    _d_non = []
-    _d_scc = []
+    _blocks = np.asarray(_blocks)
     _shape = _af.shape
-    for i in range(len(_d)):
-        if _r[i] in _inds and _c[i] in _inds:
-            _d_non.append(0)
-            _d_scc.append(_d[i])
-        else:
-            _d_non.append(_d[i])
-            _d_scc.append(0)
-    _af_non = csc_matrix((_d_non, (_r, _c)), shape=_shape)
-    _af_scc = csc_matrix((_d_scc, (_r, _c)), shape=_shape)
-    assert (_af_non + _af_scc - _af).nnz == 0
+    _br = _blocks[_af.row]
+    _in = (_br >= 0) & (_br == _blocks[_af.col])
+    _out = ~_in
+    _af_non = csc_matrix((_af.data[_out], (_af.row[_out], _af.col[_out])), shape=_shape)
+    _af_scc = csc_matrix((_af.data[_in], (_af.row[_in], _af.col[_in])), shape=_shape)
     return _af_non, _af_scc
 
 
-def _determine_scc_inds(ts):
-    scc_inds = set()
+def _determine_scc_blocks(ts):
+    """
+    Numbers the nontrivial foreground SCCs
+    :param ts: TarjanStack
+    :return: array of block numbers, one per foreground node, with -1 for nodes not in a foreground SCC
+    """
+    blocks = -np.ones(ts.pdim, dtype=int)
+    k = 0
     for _s in ts.nontrivial_sccs():
         if ts.is_background_scc(_s):
             continue
-        for k in ts.scc(_s):
-            scc_inds.add(ts.fg_dict(k.index))
-    return scc_inds
+        for n in ts.scc(_s):
+            blocks[ts.fg_dict(n.index)] = k
+        k += 1
+    return blocks
+
+
+def _scc_right_solve(m, blocks, factors):
+    """
+    Computes m (I - S)^-1, where S is block diagonal with the blocks given.  Columns outside the blocks are unchanged;
+    the columns of each block are replaced by m[:, b] (I - S_bb)^-1, computed from the block's LU factorization using
+    only the nonzero rows of m[:, b].
+    :param m: sparse matrix
+    :param blocks: block numbers, as for split_af
+    :param factors: list of (column indices, SuperLU of I - S_bb), one per block
+    :return: csc_matrix
+    """
+    m = csc_matrix(m)
+    result = [m.dot(diags((blocks < 0).astype(float)))]
+    for inds, lu in factors:
+        sub = m[:, inds]
+        rows = np.unique(sub.indices)
+        if len(rows) == 0:
+            continue
+        z = lu.solve(sub[rows, :].toarray().T, trans='T').T  # (I - S_bb)^-T z^T = sub^T
+        r, c = np.nonzero(z)
+        result.append(csc_matrix((z[r, c], (rows[r], inds[c])), shape=m.shape))
+    return csc_matrix(sum(result[1:], result[0]))
 
 
 def flatten(af, ad, bf, ts):
     """
-    Accepts a fully populated background engine as argument
+    Accepts a fully populated background engine as argument.  Removes foreground SCCs from Af by splitting it into
+    block-diagonal (within-SCC) and remainder portions Af = N + S, so that (I - Af) = (I - N (I - S)^-1)(I - S), and
+    returns N (I - S)^-1, Ad (I - S)^-1 and Bf (I - S)^-1.  Each SCC is factorized separately; (I - S)^-1 is never
+    formed.  The flattened Af is acyclic (strictly lower triangular in Tarjan order).
 
     :param af:
     :param ad:
@@ -107,16 +178,30 @@ def flatten(af, ad, bf, ts):
     :param ts:
     :return: af_flat, ad_flat, bf_flat
     """
-    scc_inds = _determine_scc_inds(ts)
+    blocks = _determine_scc_blocks(ts)
 
-    non, scc = split_af(af, scc_inds)
+    non, scc = split_af(af, blocks)
+    if scc.nnz == 0:
+        return non, ad, bf
 
-    scc_inv = inv(eye(ts.pdim).tocsc() - scc)
+    scc = scc.tocsr()
+    factors = []
+    for k in range(blocks.max() + 1):
+        inds = np.flatnonzero(blocks == k)
+        factors.append((inds, splu(csc_matrix(eye(len(inds)) - scc[inds, :][:, inds]))))
 
-    return non * scc_inv, ad * scc_inv, bf * scc_inv
+    return tuple(_scc_right_solve(m, blocks, factors) for m in (non, ad, bf))
 
 
-ORDERING_SUFFIX = '.ordering.json.gz'
+ORDERING_SUFFIX = '.ordering.json.gz'  # legacy
+BINARY_ORDERING_SUFFIX = '.ordering.npz'
+MMAP_ORDERING = 'background'  # name of the ordering file within a .mmap directory
+MMAP_CSC = ('A', 'B')  # matrices also stored in csc orientation within a .mmap directory, for column slices
+MMAP_CSC_SUFFIX = '_csc'
+MMAP_CSR = ('lu_L', 'lu_U')  # factors also stored in csr orientation, the form used by triangular solves
+MMAP_CSR_SUFFIX = '_csr'
+AGGREGATED_SUFFIX = '.lci'  # directory of memory-mappable arrays holding the aggregated LCI matrix B(I - A)^-1
+CHARACTERIZATION_SUFFIX = '.char.npz'  # cached characterization vectors
 
 
 class FlatBackground(BackgroundLayer):
@@ -124,25 +209,26 @@ class FlatBackground(BackgroundLayer):
     Static, ordered background stored in an easily serializable way
     """
     @classmethod
-    def from_query(cls, query, quiet=True, preferred=None, **kwargs):
+    def from_query(cls, query, quiet=True, preferred=None, flatten_af=_FLATTEN_AF, **kwargs):
         """
         :param query: an index + exchange interface with operable processes(), terminate(), get() and inventory()
         :param quiet: passed to cls
         :param preferred: a preferred-provider dict as specified in BackgroundEngine init
+        :param flatten_af: [_FLATTEN_AF] whether to remove foreground SCCs from Af (see flatten())
         :param kwargs: passed to add_all_ref_products()
         :return:
         """
         be = BackgroundEngine(query, preferred=preferred)
         be.add_all_ref_products(**kwargs)
-        flat = cls.from_background_engine(be, quiet=quiet)
+        flat = cls.from_background_engine(be, flatten_af=flatten_af, quiet=quiet)
         flat.map_contexts(query)
         return flat
 
     @classmethod
-    def from_background_engine(cls, be, **kwargs):
+    def from_background_engine(cls, be, flatten_af=_FLATTEN_AF, **kwargs):
         af, ad, bf = be.make_foreground()
 
-        if _FLATTEN_AF:
+        if flatten_af:
             af, ad, bf = flatten(af, ad, bf, be.tstack)
 
         _map_nontrivial_sccs = {k: be.product_flow(k).process.external_ref for k in be.tstack.nontrivial_sccs()}
@@ -192,30 +278,124 @@ class FlatBackground(BackgroundLayer):
 
     @classmethod
     def from_file(cls, file, **kwargs):
+        """
+        Load a background with the reader for its file type
+        :param file: a '.mat' or '.hdf' file, or a '.mmap' directory
+        :param kwargs: quiet, complete, lazy -- accepted by every reader
+        :return:
+        """
         ext = os.path.splitext(file)[1]
         if ext == '.mat':
             return cls.from_matfile(file, **kwargs)
         elif ext == '.hdf':
             return cls.from_hdf5(file, **kwargs)
+        elif ext == '.mmap':
+            return cls.from_mmap(file, **kwargs)
         else:
             raise ValueError('Unsupported file type %s' % ext)
 
     @classmethod
-    def from_hdf5(cls, fle, quiet=True):
-        raise NotImplementedError
+    def from_hdf5(cls, fle, quiet=True, complete=True, lazy=True):
+        """
+        Load a background stored in an HDF5 file.  Requires h5py.
+        :param fle:
+        :param quiet:
+        :param complete: [True] whether to read A, B, and the factorization of (I - A). If False, only the foreground
+         matrices are read, and background computations are unavailable.
+        :param lazy: [True] defer reading A, B, and the factorization until they are first needed
+        :return:
+        """
+        tables, matrices, arrays = read_hdf5(fle, ('Af', 'Ad', 'Bf'), ('bg_blocks', ))
+        d = {k: v for k, v in list(matrices.items()) + list(arrays.items()) if v is not None}
+
+        def _load_lci_db():
+            _, m, a = read_hdf5(fle, ('A', 'B', 'lu_L', 'lu_U'), ('lu_perm_r', 'lu_perm_c'), tables=False)
+            dl = {k: v for k, v in list(m.items()) + list(a.items()) if v is not None}
+            return dl['A'].tocsr(), dl['B'].tocsr(), LuFactorization.from_dict(dl)
+
+        if not complete or 'A' not in hdf5_matrix_names(fle):
+            lci_db = None
+        elif lazy:
+            lci_db = _load_lci_db
+        else:
+            lci_db = _load_lci_db()
+        return cls(tables['foreground'], tables['background'], tables['exterior'],
+                   d['Af'].tocsr(), d['Ad'].tocsr(), d['Bf'].tocsr(),
+                   lci_db=lci_db,
+                   bg_blocks=d.get('bg_blocks') if complete else None,
+                   aggregated=cls._read_aggregated(fle) if complete else None,
+                   characterizations=cls._read_characterizations(fle),
+                   quiet=quiet)
 
     @classmethod
-    def from_matfile(cls, file, quiet=True):
-        d = loadmat(file)
+    def from_mmap(cls, dirname, quiet=True, complete=True, lazy=True):
+        """
+        Open a background stored as a directory of raw .npy arrays.  The matrices are memory maps of the stored files,
+        so loading is nearly instantaneous, and processes on the same host that open the same background share one
+        copy of the data in the page cache.  A and B are stored in both csr and csc orientation, so that row and column
+        slices are both taken from the shared maps.  The LU factors are likewise stored in both orientations, so that
+        triangular solves and their transposes use the shared maps directly.
+        :param dirname:
+        :param quiet:
+        :param complete: [True] whether to open A, B, and the factorization of (I - A)
+        :param lazy: [True] memory-map the stored arrays, so that they are read only as they are used.  If False, read
+         them into memory now.
+        :return:
+        """
+        mmap_mode = 'r' if lazy else None
+        ordr = cls._read_ordering(os.path.join(dirname, MMAP_ORDERING))
+        d = dict()
+        names = ('Af', 'Ad', 'Bf', 'A', 'B', 'lu_L', 'lu_U') + tuple(k + MMAP_CSC_SUFFIX for k in MMAP_CSC) \
+            + tuple(k + MMAP_CSR_SUFFIX for k in MMAP_CSR) if complete else ('Af', 'Ad', 'Bf')
+        for name in names:
+            if has_sparse_npy(dirname, name):
+                d[name] = read_sparse_npy(dirname, name, mmap_mode=mmap_mode)
+        for name in ('lu_perm_r', 'lu_perm_c', 'bg_blocks') if complete else ():
+            if has_array_npy(dirname, name):
+                d[name] = read_array_npy(dirname, name, mmap_mode=mmap_mode)
         if 'A' in d:
-            lci_db = (d['A'].tocsr(), d['B'].tocsr())
+            lci_db = (d['A'], d['B'])
         else:
             lci_db = None
+        fb = cls(ordr['foreground'], ordr['background'], ordr['exterior'],
+                 d['Af'], d['Ad'], d['Bf'],
+                 lci_db=lci_db,
+                 factorization=LuFactorization.from_dict(d),
+                 bg_blocks=d.get('bg_blocks'),
+                 aggregated=cls._read_aggregated(dirname) if complete else None,
+                 characterizations=cls._read_characterizations(dirname),
+                 quiet=quiet)
+        for k in MMAP_CSC:
+            if k + MMAP_CSC_SUFFIX in d:
+                fb._set_view('_' + k, d[k + MMAP_CSC_SUFFIX])
+        return fb
 
-        try:
-            ordr = from_json(file + ORDERING_SUFFIX)
-        except FileNotFoundError:  # legacy
-            ordr = from_json(file + '.index.json.gz')
+    @classmethod
+    def from_matfile(cls, file, quiet=True, complete=True, lazy=True):
+        """
+        :param file:
+        :param quiet:
+        :param complete: [True] whether to read A, B, and the factorization of (I - A). If False, only the foreground
+         matrices are read, and background computations are unavailable.
+        :param lazy: [True] defer reading A, B, and the factorization of (I - A) until they are first needed
+        :return:
+        """
+        names = set(k[0] for k in whosmat(file))
+        d = loadmat(file, variable_names=[k for k in ('Af', 'Ad', 'Bf', 'bg_blocks') if k in names])
+        bg_blocks = d['bg_blocks'].flatten() if 'bg_blocks' in d and complete else None
+
+        def _load_lci_db():
+            dl = loadmat(file, variable_names=[k for k in names if k in ('A', 'B') or k.startswith('lu_')])
+            return dl['A'].tocsr(), dl['B'].tocsr(), LuFactorization.from_dict(dl)
+
+        if not complete or 'A' not in names:
+            lci_db = None
+        elif lazy:
+            lci_db = _load_lci_db
+        else:
+            lci_db = _load_lci_db()
+
+        ordr = cls._read_ordering(file)
 
         '''
         def _unpack_term_ref(arr):
@@ -234,20 +414,108 @@ class FlatBackground(BackgroundLayer):
         return cls(ordr['foreground'], ordr['background'], ordr['exterior'],
                    d['Af'].tocsr(), d['Ad'].tocsr(), d['Bf'].tocsr(),
                    lci_db=lci_db,
+                   bg_blocks=bg_blocks,
+                   aggregated=cls._read_aggregated(file) if complete else None,
+                   characterizations=cls._read_characterizations(file),
                    quiet=quiet)
 
+    @staticmethod
+    def _read_ordering(file):
+        """
+        Read the binary ordering if present, else the JSON ordering
+        :param file: background file name
+        :return: dict of 'foreground', 'background', 'exterior' to TermTables or lists of TermRef parameter tuples
+        """
+        if os.path.exists(file + BINARY_ORDERING_SUFFIX):
+            return read_ordering(file + BINARY_ORDERING_SUFFIX)
+        try:
+            return from_json(file + ORDERING_SUFFIX)
+        except FileNotFoundError:  # legacy
+            return from_json(file + '.index.json.gz')
+
+    @staticmethod
+    def _read_aggregated(file):
+        agg_dir = file + AGGREGATED_SUFFIX
+        if has_sparse_npy(agg_dir, 'M'):
+            return read_sparse_npy(agg_dir, 'M', mmap_mode='r')
+        return None
+
+    @staticmethod
+    def _read_characterizations(file):
+        try:
+            d = np.load(file + CHARACTERIZATION_SUFFIX, allow_pickle=False)
+        except FileNotFoundError:
+            return None
+        c = csr_matrix((d['data'], d['indices'], d['indptr']), shape=tuple(d['shape']))
+        return {(str(q), str(v)): c[i, :] for i, (q, v) in enumerate(zip(d['quantities'], d['versions']))}
+
     context_map = None
+    _context_version = None
 
     def map_contexts(self, index):
         self.context_map = dict()
-        for k in self._ex:
-            if k.term_ref not in self.context_map:
-                term = tuple(k.term_ref.split('; '))  # de-serialize
+        for term_ref, _ in self._ex.keys():
+            if term_ref not in self.context_map:
+                term = tuple(term_ref.split('; '))  # de-serialize
                 naive_context = index.get_context(term)
                 canonical_context = index._tm[naive_context]  # not sure about this
-                self.context_map[k.term_ref] = canonical_context
+                self.context_map[term_ref] = canonical_context
 
-    def __init__(self, foreground, background, exterior, af, ad, bf, lci_db=None, quiet=True):
+    @property
+    def context_version(self):
+        """
+        A digest of the context map, used to key stored characterizations: these remain valid only as long as the
+        exterior flows' contexts map to the same canonical contexts.
+        :return: hex string, or None if contexts are not mapped
+        """
+        if self.context_map is None:
+            return None
+        if self._context_version is None or self._context_version[0] is not self.context_map:
+            h = hashlib.sha1()
+            for k in sorted(self.context_map.keys()):
+                h.update(('%s\t%s\n' % (k, self.context_map[k])).encode('utf-8'))
+            self._context_version = (self.context_map, h.hexdigest()[:16])
+        return self._context_version[1]
+
+    def characterization(self, quantity_key):
+        """
+        Retrieve a stored characterization vector for the current context map
+        :param quantity_key: string identifying a canonical quantity
+        :return: sparse 1 x mdim characterization vector, or None if not known
+        """
+        return self._char_vectors.get((quantity_key, self.context_version))
+
+    def set_characterization(self, quantity_key, char_vector):
+        """
+        Store a characterization vector for the current context map.  Stored vectors are saved by write_to_file().
+        :param quantity_key: string identifying a canonical quantity
+        :param char_vector: sparse 1 x mdim characterization vector
+        :return:
+        """
+        char_vector = csr_matrix(char_vector)
+        if char_vector.shape != (1, self.mdim):
+            raise ValueError('Characterization vector has wrong shape %s' % (char_vector.shape, ))
+        self._char_vectors[quantity_key, self.context_version] = char_vector
+
+    def characterization_matrix(self, quantity_keys):
+        """
+        Stack stored characterization vectors into a single sparse matrix C, with one row per quantity, so that a
+        column of LCI results can be scored against all of the quantities with one product C * lci.
+        :param quantity_keys: iterable of quantity keys, all of which must be stored
+        :return: sparse (len(quantity_keys) x mdim) csr_matrix
+        """
+        rows = []
+        for q in quantity_keys:
+            c = self.characterization(q)
+            if c is None:
+                raise KeyError('No characterization for %s' % q)
+            rows.append(c)
+        if len(rows) == 0:
+            return csr_matrix((0, self.mdim))
+        return csr_matrix(vstack(rows))
+
+    def __init__(self, foreground, background, exterior, af, ad, bf, lci_db=None, factorization=None,
+                 bg_blocks=None, aggregated=None, characterizations=None, cache_bytes=64 * 1024 * 1024, quiet=True):
         """
 
         :param foreground: iterable of foreground Product Flows as TermRef params
@@ -256,44 +524,120 @@ class FlatBackground(BackgroundLayer):
         :param af: sparse, flattened Af
         :param ad: sparse, flattened Ad
         :param bf: sparse, flattened Bf
-        :param lci_db: [None] optional (A, B) 2-tuple
+        :param lci_db: [None] optional (A, B) 2-tuple or (A, B, factorization) 3-tuple, or a function of no arguments
+         that returns one.  A function is not called until the background is first needed.
+        :param factorization: [None] optional LuFactorization of (I - A), e.g. restored from file
+        :param bg_blocks: [None] optional SCC block numbers of background nodes, in solution order (see scc_blocks)
+        :param aggregated: [None] optional aggregated LCI matrix B(I - A)^-1 as csc_matrix (may be memory-mapped)
+        :param characterizations: [None] optional dict of stored characterization vectors, keyed by
+         (quantity key, context version)
+        :param cache_bytes: [64 MiB] capacity of the LRU cache of computed lci, ad and bf results. 0 to disable.
         :param quiet: [True] does nothing for now
         """
-        self._fg = tuple([TermRef(*f) for f in foreground])
-        self._bg = tuple([TermRef(*x) for x in background])
-        self._ex = tuple([TermRef(*x) for x in exterior])
+        self._set_terms(foreground, background, exterior)
 
         self._af = af
         self._ad = ad
         self._bf = bf
 
+        self._lci_lock = Lock()
+        self._lci_loader = None
         if lci_db is None:
-            self._A = None
-            self._B = None
+            self._lci_db = None
+        elif callable(lci_db):
+            self._lci_db = None
+            self._lci_loader = lci_db
         else:
-            self._A = lci_db[0].tocsr()
-            self._B = lci_db[1].tocsr()
-
-        self._lu = None  # store LU decomposition
-
-        self._fg_index = {(k.term_ref, k.flow_ref): i for i, k in enumerate(self._fg)}
-        self._bg_index = {(k.term_ref, k.flow_ref): i for i, k in enumerate(self._bg)}
-        self._ex_index = {(k.term_ref, k.flow_ref, k.direction): i for i, k in enumerate(self._ex)}
+            self._lci_db = (lci_db[0].tocsr(), lci_db[1].tocsr())
+            if len(lci_db) > 2 and factorization is None:
+                factorization = lci_db[2]
+
+        self._lu_factor = factorization  # store LU decomposition
+        self._krylov = None  # store ILU-preconditioned iterative solver
+        self._bg_blocks = bg_blocks
+        self._scc_solver = None  # store block-triangular solver
+        self._fg_solver = None  # store exact foreground solver
+        self._solve_local = local()  # per-thread info of the most recent background solve
+
+        self._cache = LciCache(cache_bytes)
+        self._views = dict()  # alternate compressed formats of stored matrices, for slicing
+
+        self._char_vectors = dict() if characterizations is None else dict(characterizations)
+        if aggregated is not None and aggregated.shape != (self.mdim, self.ndim):
+            print('Warning: aggregated LCI matrix has shape %s; expected %s. Ignored.' % (aggregated.shape,
+                                                                                       (self.mdim, self.ndim)))
+            aggregated = None
+        self._M = aggregated  # store aggregated LCI matrix
 
         self._quiet = quiet
 
+    def _set_terms(self, foreground, background, exterior):
+        """
+        Build the TermRef tables and their indexes
+        """
+        strings = dict()
+        self._fg = TermTable.from_terms(foreground, strings)
+        self._bg = TermTable.from_terms(background, strings)
+        self._ex = TermTable.from_terms(exterior, strings)
+
+        self._fg_index = self._fg.index()  # (term_ref, flow_ref) -> row
+        self._bg_index = self._bg.index()
+        self._ex_index = self._ex.index(with_direction=True)  # (term_ref, flow_ref, direction) -> row
+        self._ex_flow_index = defaultdict(list)  # flow_ref -> exterior indices
+        for i, f in enumerate(self._ex.flow_codes.tolist()):
+            self._ex_flow_index[f].append(i)
+
     def index_of(self, term_ref, flow_ref):
         key = (term_ref, flow_ref)
-        if key in self._fg_index:
-            return self._fg_index[key]
-        elif key in self._bg_index:
-            return self._bg_index[key]
-        else:
+        index = self._fg_index.get(key)
+        if index is None:
+            index = self._bg_index.get(key)
+        if index is None:
             raise KeyError('Unknown termination %s, %s' % key)
+        return index
+
+    def _load_lci_db(self):
+        with self._lci_lock:
+            if self._lci_loader is not None:
+                loaded = self._lci_loader()
+                self._lci_db = (loaded[0].tocsr(), loaded[1].tocsr())
+                if len(loaded) > 2 and self._lu_factor is None:
+                    self._lu_factor = loaded[2]
+                self._lci_loader = None
+        return self._lci_db
+
+    @property
+    def lci_db_loaded(self):
+        return self._lci_db is not None
+
+    @property
+    def _A(self):
+        if self._lci_db is None:
+            self._load_lci_db()
+        return None if self._lci_db is None else self._lci_db[0]
+
+    @property
+    def _B(self):
+        if self._lci_db is None:
+            self._load_lci_db()
+        return None if self._lci_db is None else self._lci_db[1]
+
+    @property
+    def _lu(self):
+        if self._lci_loader is not None:
+            self._load_lci_db()
+        return self._lu_factor
+
+    @_lu.setter
+    def _lu(self, value):
+        self._lu_factor = value
 
     @property
     def _complete(self):
-        return self._A is not None and self._B is not None
+        """
+        Whether the background LCI database is available (whether or not it has been loaded)
+        """
+        return self._lci_db is not None or self._lci_loader is not None
 
     @property
     def ndim(self):
@@ -349,7 +693,8 @@ class FlatBackground(BackgroundLayer):
         :param exterior: [False] return entries for exterior flows
         :return:
         """
-        if _FLATTEN_AF is False and traverse is True:
+        acyclic = triu(self._af).count_nonzero() == 0  # strictly lower triangular; no need to build the fg solver
+        if traverse is True and not acyclic:
             print('Warning: traversal of foreground SCC will never terminate')
 
         index = self._fg_index[process, ref_flow]
@@ -362,11 +707,11 @@ class FlatBackground(BackgroundLayer):
         while len(q) > 0:
             current = q.pop(0)
             node = self._fg[current]
-            fg_deps = self._af[:, current]
+            fg_deps = self._col('_af', current)
             rows, cols = fg_deps.nonzero()
             for i in range(len(rows)):
                 assert cols[i] == 0  # 1-column slice
-                if _FLATTEN_AF:
+                if acyclic:
                     assert rows[i] > current  # well-ordered and flattened
                 if rows[i] in cols_seen:
                     if traverse:
@@ -383,28 +728,62 @@ class FlatBackground(BackgroundLayer):
                     dirn = comp_dir(term.direction)  # comp directions w.r.t. parent node
                 yield ExchDef(node.term_ref, term.flow_ref, dirn, term.term_ref, dat)
 
-            bg_deps = self._ad[:, current]
+            bg_deps = self._col('_ad', current)
             for dep in self._generate_exch_defs(node.term_ref, bg_deps, self._bg):
                 yield dep
 
             if exterior:
-                ems = self._bf[:, current]
+                ems = self._col('_bf', current)
                 for ext in self._generate_em_defs(node.term_ref, ems):
                     yield ext
 
     @staticmethod
-    def _generate_exch_defs(node_ref, data_vec, enumeration):
-        rows, cols = data_vec.nonzero()
-        assert all(cols == 0)
-        for i in range(len(rows)):
-            term = enumeration[rows[i]]
-            dat = data_vec.data[i]
-            if dat < 0:
-                dat *= -1
-                dirn = term.direction
+    def _term_directions(terms):
+        return terms.directions  # 1 for 'Output' w.r.t. term
+
+    def _make_batch(self, node_ref, data_vec, terms):
+        """
+        Convert a sparse column into an ExchDefBatch.  Interior flows with negative values are reported with positive
+        values and the term's own direction; exterior flows keep their values and take the complement of the
+        direction w.r.t. the context.
+        :param node_ref:
+        :param data_vec: sparse column
+        :param terms: the TermRef table that data_vec's rows refer to
+        :return: ExchDefBatch
+        """
+        col = csc_matrix(data_vec)
+        nz = col.data != 0
+        index = col.indices[nz]
+        value = col.data[nz]
+        dirns = self._term_directions(terms)[index]
+        if terms is self._ex:
+            direction = 1 - dirns
+        else:
+            neg = value < 0
+            direction = np.where(neg, dirns, 1 - dirns)
+            value = np.abs(value)
+        return ExchDefBatch(node_ref, terms, index, direction.astype(np.int8), value)
+
+    def exch_defs(self, batch):
+        """
+        Generate the ExchDefs contained in an ExchDefBatch
+        :param batch:
+        :return:
+        """
+        terms = batch.terms
+        exterior = terms is self._ex
+        for i, d, v in zip(batch.index, batch.direction, batch.value):
+            term = terms[i]
+            if not exterior:
+                _term = term.term_ref
+            elif CONTEXT_STATUS_ == 'compat':
+                _term = None
             else:
-                dirn = comp_dir(term.direction)
-            yield ExchDef(node_ref, term.flow_ref, dirn, term.term_ref, dat)
+                _term = self.context_map.get(term.term_ref)
+            yield ExchDef(batch.process, term.flow_ref, _DIRECTIONS[d], _term, v)
+
+    def _generate_exch_defs(self, node_ref, data_vec, enumeration):
+        return self.exch_defs(self._make_batch(node_ref, data_vec, enumeration))
 
     def _generate_em_defs(self, node_ref, data_vec):
         """
@@ -413,42 +792,54 @@ class FlatBackground(BackgroundLayer):
         :param data_vec:
         :return:
         """
-        rows, cols = data_vec.nonzero()
-        assert all(cols == 0)
-        for i in range(len(rows)):
-            term = self._ex[rows[i]]
-            dat = data_vec.data[i]
-            dirn = comp_dir(term.direction)
-            if CONTEXT_STATUS_ == 'compat':
-                _term = None
-            else:
-                _term = self.context_map.get(term.term_ref)
-            yield ExchDef(node_ref, term.flow_ref, dirn, _term, dat)
+        return self.exch_defs(self._make_batch(node_ref, data_vec, self._ex))
 
     def generate_ems_by_index(self, process, ref_flow, m_index):
         if self.is_in_background(process, ref_flow):
             index = self._bg_index[process, ref_flow]
-            ems = self._B[:, index]
+            ems = self._col('_B', index)
         else:
             index = self._fg_index[process, ref_flow]
-            ems = self._bf[:, index]
+            ems = self._col('_bf', index)
 
-        for i in m_index:
+        m_index = np.asarray(m_index, dtype=int)
+        data = ems[m_index, :].toarray().flatten()
+        for i, dat in zip(m_index, data):
             term = self._ex[i]
-            dat = ems[i, 0]
             dirn = comp_dir(term.direction)
             cx = self.context_map.get(term.term_ref)
             yield ExchDef(process, term.flow_ref, dirn, cx, dat)
 
+    def ems_by_index_batches(self, m_index, nodes, background=False):
+        """
+        Batched form of generate_ems_by_index(): takes the exterior rows m_index for all the given nodes in a single
+        slice, and returns the nonzero entries of each node's column
+        :param m_index: exterior indices, e.g. those of the characterized flows
+        :param nodes: foreground indices, or background indices if background is True
+        :param background: [False]
+        :return: list of ExchDefBatch, one per node
+        """
+        terms = self._bg if background else self._fg
+        m_index = np.asarray(m_index, dtype=int)
+        sub = self._view('_B' if background else '_bf', 'csr')[m_index, :][:, nodes].tocsc()
+        direction = (1 - self._term_directions(self._ex)[m_index]).astype(np.int8)
+        batches = []
+        for j, node in enumerate(nodes):
+            lo, hi = sub.indptr[j], sub.indptr[j + 1]
+            rows = sub.indices[lo:hi]
+            batches.append(ExchDefBatch(terms[node].term_ref, self._ex, m_index[rows], direction[rows],
+                                        sub.data[lo:hi]))
+        return batches
+
     def consumers(self, process, ref_flow):
         idx = self.index_of(process, ref_flow)
         if self.is_in_background(process, ref_flow):
-            for i in self._ad[idx, :].nonzero()[1]:
+            for i in self._row('_ad', idx).nonzero()[1]:
                 yield self._fg[i]
-            for i in self._A[idx, :].nonzero()[1]:
+            for i in self._row('_A', idx).nonzero()[1]:
                 yield self._bg[i]
         else:
-            for i in self._af[idx, :].nonzero()[1]:
+            for i in self._row('_af', idx).nonzero()[1]:
                 yield self._fg[i]
 
     def emitters(self, flow_ref, direction, context=None):
@@ -460,10 +851,9 @@ class FlatBackground(BackgroundLayer):
         :param context: (canonical, "of query")
         :return:
         """
-        yielded = set()
-        for idx, ex in enumerate(self.ex):  # termination, flow_ref, direction
-            if ex.flow_ref != flow_ref:
-                continue
+        idxs = []
+        for idx in self._ex_flow_index.get(self._ex.codes.get(flow_ref), ()):  # termination, flow_ref, direction
+            ex = self._ex[idx]
             if direction:
                 if ex.direction != direction:
                     continue
@@ -471,77 +861,344 @@ class FlatBackground(BackgroundLayer):
                 if self.context_map.get(ex.term_ref) != context:
                     continue
             # found an eligible external flow
-            for i in self._bf[idx, :].nonzero()[1]:
-                yielded.add(self._fg[i])
-            for i in self._B[idx, :].nonzero()[1]:
+            idxs.append(idx)
+        if len(idxs) == 0:
+            return
+        yielded = set()
+        for i in np.unique(self._row('_bf', idxs).nonzero()[1]):
+            yielded.add(self._fg[i])
+        if self._complete:
+            for i in np.unique(self._row('_B', idxs).nonzero()[1]):
                 yielded.add(self._bg[i])
         for rx in yielded:
             yield rx
 
-    def dependencies(self, process, ref_flow):
+    def dependencies_batch(self, process, ref_flow):
+        """
+        :param process:
+        :param ref_flow:
+        :return: 2-tuple of ExchDefBatch: foreground dependencies, background dependencies
+        """
         if self.is_in_background(process, ref_flow):
             index = self._bg_index[process, ref_flow]
-            fg_deps = csr_matrix([])
-            bg_deps = self._A[:, index]
+            fg_deps = csc_matrix((self.pdim, 1))
+            bg_deps = self._col('_A', index)
         else:
             index = self._fg_index[process, ref_flow]
-            fg_deps = self._af[:, index]
-            bg_deps = self._ad[:, index]
+            fg_deps = self._col('_af', index)
+            bg_deps = self._col('_ad', index)
+        return self._make_batch(process, fg_deps, self._fg), self._make_batch(process, bg_deps, self._bg)
 
-        for x in self._generate_exch_defs(process, fg_deps, self._fg):
-            yield x
-
-        for x in self._generate_exch_defs(process, bg_deps, self._bg):
-            yield x
+    def dependencies(self, process, ref_flow):
+        for batch in self.dependencies_batch(process, ref_flow):
+            for x in self.exch_defs(batch):
+                yield x
 
-    def exterior(self, process, ref_flow):
+    def exterior_batch(self, process, ref_flow):
         if self.is_in_background(process, ref_flow):
             index = self._bg_index[process, ref_flow]
-            ems = self._B[:, index]
+            ems = self._col('_B', index)
         else:
             index = self._fg_index[process, ref_flow]
-            ems = self._bf[:, index]
+            ems = self._col('_bf', index)
+        return self._make_batch(process, ems, self._ex)
 
-        for x in self._generate_em_defs(process, ems):
+    def exterior(self, process, ref_flow):
+        for x in self.exch_defs(self.exterior_batch(process, ref_flow)):
             yield x
 
-    def _x_tilde(self, process, ref_flow, quiet=True, **kwargs):
+    def _view(self, name, fmt):
+        """
+        Return the named stored matrix in the requested compressed format, converting it on first use.  Column slices
+        should be taken from 'csc' views and row slices from 'csr' views.
+        :param name: attribute name of the matrix, e.g. '_af' or '_B'
+        :param fmt: 'csc' or 'csr'
+        :return:
+        """
+        m = getattr(self, name)
+        if m.format == fmt:
+            return m
+        try:
+            src, view = self._views[name, fmt]
+            if src is m:
+                return view
+        except KeyError:
+            pass
+        view = m.asformat(fmt)
+        self._views[name, fmt] = (m, view)
+        return view
+
+    def _set_view(self, name, view):
+        """
+        Supply an alternate-format copy of a stored matrix, e.g. one memory-mapped from disk, so that it need not be
+        converted.  The view is used for as long as the stored matrix is unchanged.
+        :param name: attribute name of the matrix
+        :param view: the same matrix in another compressed format
+        :return:
+        """
+        m = getattr(self, name)
+        if view.shape != m.shape:
+            raise ValueError('View of %s has wrong shape %s' % (name, view.shape, ))
+        self._views[name, view.format] = (m, view)
+
+    def _col(self, name, index):
+        return self._view(name, 'csc')[:, index]
+
+    def _row(self, name, index):
+        return self._view(name, 'csr')[index, :]
+
+    @property
+    def views_nbytes(self):
+        """
+        Memory used by alternate-format views of the stored matrices
+        """
+        return sum(v.data.nbytes + v.indices.nbytes + v.indptr.nbytes for _, v in self._views.values())
+
+    def drop_views(self):
+        """
+        Release alternate-format views of the stored matrices.  They are rebuilt on demand.
+        """
+        self._views.clear()
+
+    @property
+    def cache_info(self):
+        """
+        Hit / miss statistics and size of the result cache
+        :return: CacheInfo(hits, misses, entries, nbytes, max_bytes)
+        """
+        return self._cache.info
+
+    def invalidate_cache(self):
+        """
+        Discard all cached lci, ad, and bf results.  Must be called if the matrices are modified.
+        """
+        self._cache.invalidate()
+
+    def _cached(self, kind, process, ref_flow, options, compute):
+        """
+        Return a result from the cache, or compute and store it
+        :param kind: 'lci', 'ad', or 'bf'
+        :param process:
+        :param ref_flow:
+        :param options: solver kwargs, part of the key
+        :param compute: function of no arguments that computes the result
+        :return:
+        """
+        key = self._cache.make_key(kind, process, ref_flow, options)
+        self._solve_local.info = None
+        if key is None:
+            return compute()
+        result, info = self._cache.get_with_info(key)
+        if result is None:
+            result = compute()
+            self._cache.put(key, result, solve_info=self.last_solve)
+        else:
+            self._solve_local.info = info
+        return result
+
+    @property
+    def fg_solver(self):
+        if self._fg_solver is None:
+            self._fg_solver = ForegroundSolver(self._af, closure_max=_FG_CLOSURE_MAX)
+        return self._fg_solver
+
+    def _solve_fg(self, x_dmd, trans=False):
+        """
+        Computes foreground activity levels x_tilde = (I - Af)^-1 x_dmd exactly, exploiting the topological ordering
+        of the foreground
+        :param x_dmd: sparse foreground demand column(s)
+        :param trans: [False] solve the transposed system instead
+        :return: sparse column(s)
+        """
+        if self.pdim == 0:
+            return csr_matrix(x_dmd.shape)
+        return self.fg_solver.solve(csr_matrix(x_dmd), trans=trans)
+
+    def _x_tilde(self, process, ref_flow, **kwargs):
+        """
+        Foreground activity levels for a unit of the named node's reference flow.  Solver options are not used
+        because the foreground solve is exact.
+        """
         index = self._fg_index[process, ref_flow]
-        return _iterate_a_matrix(self._af, _unit_column_vector(self.pdim, index), quiet=quiet, **kwargs)
+        if self.fg_solver.closure is not None:
+            return sparse_column(self.fg_solver.closure, index)
+        return self._solve_fg(_unit_column_vector(self.pdim, index))
+
+    def ad_batch(self, process, ref_flow, **kwargs):
+        if self.is_in_background(process, ref_flow):
+            return self.dependencies_batch(process, ref_flow)[1]
+        ad_tilde = self._cached('ad', process, ref_flow, kwargs,
+                                lambda: self._ad.dot(self._x_tilde(process, ref_flow, **kwargs)))
+        return self._make_batch(process, ad_tilde, self._bg)
 
     def ad(self, process, ref_flow, **kwargs):
         if self.is_in_background(process, ref_flow):
             for x in self.dependencies(process, ref_flow):
                 yield x
         else:
-            ad_tilde = self._ad.dot(self._x_tilde(process, ref_flow, **kwargs))
-            for x in self._generate_exch_defs(process, ad_tilde, self._bg):
+            for x in self.exch_defs(self.ad_batch(process, ref_flow, **kwargs)):
                 yield x
 
-    def bf(self, process, ref_flow, **kwargs):
+    def bf_batch(self, process, ref_flow, **kwargs):
         if self.is_in_background(process, ref_flow):
-            for x in self.exterior(process, ref_flow):
-                yield x
-        else:
-            bf_tilde = self._bf.dot(self._x_tilde(process, ref_flow, **kwargs))
-            for x in self._generate_em_defs(process, bf_tilde):
-                yield x
+            return self.exterior_batch(process, ref_flow)
+        bf_tilde = self._cached('bf', process, ref_flow, kwargs,
+                                lambda: self._bf.dot(self._x_tilde(process, ref_flow, **kwargs)))
+        return self._make_batch(process, bf_tilde, self._ex)
+
+    def bf(self, process, ref_flow, **kwargs):
+        for x in self.exch_defs(self.bf_batch(process, ref_flow, **kwargs)):
+            yield x
+
+    @property
+    def factorization(self):
+        return self._lu
+
+    def factorize(self):
+        """
+        Compute the sparse LU factorization of (I - A), if it is not already known.  Once present, the factorization
+        is used for all background computations, and it is saved by write_to_file() so that it need not be
+        recomputed when the background is next loaded.
+        :return: the LuFactorization
+        """
+        if not self._complete:
+            raise NoLciDatabase
+        if self._lu is None:
+            self._lu = LuFactorization.from_matrix(self._A)
+        return self._lu
+
+    def precondition(self, drop_tol=1e-4, fill_factor=10):
+        """
+        Compute the incomplete LU preconditioner used by the iterative 'gmres' and 'bicgstab' solvers.  This is done
+        automatically (with default parameters) the first time one of those solvers is used; the preconditioner is
+        then reused for all subsequent queries.
+        :param drop_tol: [1e-4] passed to spilu
+        :param fill_factor: [10] passed to spilu
+        :return: the KrylovSolver
+        """
+        if not self._complete:
+            raise NoLciDatabase
+        self._krylov = KrylovSolver(self._A, drop_tol=drop_tol, fill_factor=fill_factor)
+        return self._krylov
+
+    @property
+    def bg_blocks(self):
+        """
+        The strongly connected component of each background node, numbered in the (topological) order in which the
+        blocks are solved.  Computed on first access if not restored from file.
+        """
+        if self._bg_blocks is None:
+            if not self._complete:
+                raise NoLciDatabase
+            self._bg_blocks = scc_blocks(self._A)
+        return self._bg_blocks
 
-    def _compute_bg_lci(self, ad, solver=None, **kwargs):
+    def scc_solver(self):
+        """
+        Build the block-triangular background solver, which factorizes only the nontrivial SCCs of A and solves the
+        acyclic remainder by substitution.  This is done automatically the first time the 'scc' solver is used.
+        :return: the BlockTriangularSolver
+        """
+        if not self._complete:
+            raise NoLciDatabase
+        if self._scc_solver is None:
+            self._scc_solver = BlockTriangularSolver(self._A, self.bg_blocks)
+        return self._scc_solver
+
+    @property
+    def last_solve(self):
+        """
+        A tuple of SolveInfo reporting iterations, residuals and convergence for each column of the calling thread's
+        most recent iterative ('gmres' or 'bicgstab') background solve.  A result served from the cache reports the
+        solve that produced it.  None if the most recent result did not come from an iterative solve.
+        """
+        return getattr(self._solve_local, 'info', None)
+
+    def _krylov_solve(self, rhs, solver, rtol, maxiter, quiet, trans=False):
+        """
+        Solves the background system with the preconditioned iterative solver and records the SolveInfo for
+        last_solve
+        :return: dense result
+        """
+        if self._krylov is None:
+            self.precondition()
+        x, infos = self._krylov.solve(_dense_rhs(rhs), method=solver, rtol=rtol, maxiter=maxiter, trans=trans)
+        if not quiet:
+            for info in infos:
+                print('%s: %d iterations, residual %.3g%s' % (info.solver, info.iterations, info.residual,
+                                                              '' if info.converged else ' (NOT CONVERGED)'))
+        self._solve_local.info = infos
+        return x
+
+    def _compute_bg_activity(self, ad, solver=None, rtol=1e-8, maxiter=None, quiet=False, **kwargs):
+        """
+        Computes background activity levels x = (I - A)^-1 ad.  Uses the LU factorization if one is present, unless
+        an iterative solver is specified.
+        :param ad: background demand, sparse or dense column(s)
+        :param solver: 'factorize' to compute the factorization if absent; 'scc' to solve block-wise over strongly
+         connected components; 'gmres' or 'bicgstab' to use a preconditioned iterative solver; otherwise passed to
+         _iterate_a_matrix
+        :param rtol: [1e-8] relative tolerance for iterative solvers
+        :param maxiter: [None] maximum iterations for iterative solvers
+        :param quiet: [False] suppress convergence reports
+        :return: sparse column(s)
+        """
+        if solver in KRYLOV_SOLVERS:
+            return _sparse_result(self._krylov_solve(ad, solver, rtol, maxiter, quiet))
+        self._solve_local.info = None
+        if solver == 'scc':
+            return _sparse_result(self.scc_solver().solve(_dense_rhs(ad)))
         if solver == 'factorize':
-            if self._lu is None:
-                ima = eye(self._A.shape[0]) - self._A
-                self._lu = factorized(ima.tocsc())
+            self.factorize()
         if self._lu is None:
-            bx = _iterate_a_matrix(self._A, ad, solver=solver, **kwargs)
+            return _iterate_a_matrix(self._A, ad, solver=solver, quiet=quiet, **kwargs)
+        return _sparse_result(self._lu.solve(_dense_rhs(ad)))
+
+    @property
+    def aggregated(self):
+        return self._M
+
+    def aggregate(self, drop_tol=1e-10, chunk=256):
+        """
+        Compute the aggregated LCI matrix M = B(I - A)^-1, whose columns are the LCIs of the background nodes.  Once
+        present, background LCIs are computed by multiplying by M (a background node's LCI is a single column lookup)
+        and no solve is required.  write_to_file() stores M in a memory-mappable form.
+
+        M is computed a block of rows at a time, as M^T = (I - A)^-T B^T, using the LU factorization of (I - A).
+        Within each row (i.e. each exterior flow), entries smaller in magnitude than drop_tol times the row's largest
+        entry are dropped.
+        :param drop_tol: [1e-10] relative drop tolerance for sparsifying M
+        :param chunk: [256] number of rows of M to compute at a time
+        :return: M as csc_matrix
+        """
+        lu = self.factorize()
+        b = self._view('_B', 'csr')
+        blocks = []
+        for start in range(0, self.mdim, chunk):
+            mt = lu.solve(b[start:start + chunk, :].T.toarray(), trans=True)
+            scale = abs(mt).max(axis=0)
+            mt[abs(mt) < drop_tol * scale] = 0.0
+            blocks.append(csr_matrix(mt.T))
+        if len(blocks) == 0:
+            self._M = csc_matrix((self.mdim, self.ndim))
         else:
-            bx = csr_matrix(self._lu(ad.toarray().flatten())).T
+            self._M = csc_matrix(vstack(blocks))
+        self.invalidate_cache()
+        return self._M
+
+    def _compute_bg_lci(self, ad, **kwargs):
+        if self._M is not None:
+            self._solve_local.info = None
+            return self._M.dot(ad)
+        bx = self._compute_bg_activity(ad, **kwargs)
         return self._B.dot(bx)
 
     def _compute_lci(self, process, ref_flow, **kwargs):
         if self.is_in_background(process, ref_flow):
             if not self._complete:
                 raise NoLciDatabase
+            if self._M is not None:
+                return sparse_column(self._M, self._bg_index[process, ref_flow])
             ad = _unit_column_vector(self.ndim, self._bg_index[process, ref_flow])
             bx = self._compute_bg_lci(ad, **kwargs)
             return bx
@@ -555,11 +1212,74 @@ class FlatBackground(BackgroundLayer):
             else:
                 return bf_tilde
 
+    def lci_batch(self, process, ref_flow, **kwargs):
+        lci = self._cached('lci', process, ref_flow, kwargs,
+                           lambda: self._compute_lci(process, ref_flow, **kwargs))
+        return self._make_batch(process, lci, self._ex)
+
     def lci(self, process, ref_flow, **kwargs):
-        for x in self._generate_em_defs(process,
-                                        self._compute_lci(process, ref_flow, **kwargs)):
+        for x in self.exch_defs(self.lci_batch(process, ref_flow, **kwargs)):
             yield x
 
+    def scores(self, process, ref_flow, char_matrix, **kwargs):
+        """
+        Score the LCI of a node against every row of a characterization matrix with a single sparse product
+        :param process:
+        :param ref_flow:
+        :param char_matrix: sparse (k x mdim), e.g. from characterization_matrix()
+        :param kwargs: passed to the solver
+        :return: dense 1-d array of k scores
+        """
+        lci = self._cached('lci', process, ref_flow, kwargs,
+                           lambda: self._compute_lci(process, ref_flow, **kwargs))
+        return _dense_rhs(char_matrix.dot(lci))
+
+    def _compute_lci_many(self, terms, quiet=True, **kwargs):
+        """
+        Stacks the demand for every term into one sparse right-hand side, so that the foreground and background
+        are each solved once for the whole batch.
+        :param terms: sequence of (process, ref_flow) pairs
+        :return: sparse (mdim x len(terms)) matrix
+        """
+        n = len(terms)
+        fg_rows = []
+        fg_cols = []
+        bg_rows = []
+        bg_cols = []
+        for j, (process, ref_flow) in enumerate(terms):
+            if self.is_in_background(process, ref_flow):
+                bg_rows.append(self._bg_index[process, ref_flow])
+                bg_cols.append(j)
+            else:
+                fg_rows.append(self._fg_index[process, ref_flow])
+                fg_cols.append(j)
+        if len(bg_cols) > 0 and not self._complete:
+            raise NoLciDatabase
+
+        x_dmd = csr_matrix((np.ones(len(fg_cols)), (fg_rows, fg_cols)), shape=(self.pdim, n))
+        x_tilde = self._solve_fg(x_dmd)
+        bf_tilde = self._bf.dot(x_tilde)
+        if not self._complete:
+            return bf_tilde.tocsc()
+
+        ad_tilde = self._ad.dot(x_tilde) + csr_matrix((np.ones(len(bg_cols)), (bg_rows, bg_cols)),
+                                                      shape=(self.ndim, n))
+        bx = self._compute_bg_lci(ad_tilde, quiet=quiet, **kwargs)
+        return csc_matrix(bx + bf_tilde)
+
+    def lci_many(self, terms, solver='factorize', **kwargs):
+        """
+        Compute the LCIs of many nodes at once.  The demand columns are stacked into a single sparse matrix, and the
+        background is solved once for all of them (by default using the LU factorization of (I - A), which is
+        computed if it is not already known).
+        :param terms: iterable of (process, ref_flow) pairs
+        :param solver: ['factorize'] background solver
+        :param kwargs: passed to the solver
+        :return: LciColumns(terms, exterior, matrix), where matrix is mdim x len(terms)
+        """
+        terms = tuple((process, ref_flow) for process, ref_flow in terms)
+        return LciColumns(terms, self._ex, self._compute_lci_many(terms, solver=solver, **kwargs))
+
     @staticmethod
     def _check_dirn(term_ref, exch):
         if comp_dir(exch.direction) == term_ref.direction:
@@ -618,7 +1338,7 @@ class FlatBackground(BackgroundLayer):
 
         # compute ad_tilde  # csr_matrix(((1,), ((inx,), (0,))), shape=(dim, 1))
         x_dmd = csr_matrix((fg_val, (fg_ind, [0]*len(fg_ind))), shape=(self.pdim, 1))
-        x_tilde = _iterate_a_matrix(self._af, x_dmd, quiet=True, **kwargs)
+        x_tilde = self._solve_fg(x_dmd)
         ad_tilde = self._ad.dot(x_tilde).todense()
         bf_tilde = self._bf.dot(x_tilde).todense()
 
@@ -649,6 +1369,53 @@ class FlatBackground(BackgroundLayer):
         s = char_vector * self._B
         return sf, s
 
+    def _compute_bg_adjoint(self, rhs, solver=None, rtol=1e-8, maxiter=None, quiet=False, **kwargs):
+        """
+        Solves the transposed background system (I - A)^T s = rhs
+        :param rhs: sparse or dense column
+        :param solver: as for _compute_bg_activity
+        :param quiet: [False] suppress convergence reports
+        :return: dense 1-d array
+        """
+        if solver in KRYLOV_SOLVERS:
+            return self._krylov_solve(rhs, solver, rtol, maxiter, quiet, trans=True)
+        self._solve_local.info = None
+        if solver == 'scc':
+            return self.scc_solver().solve(_dense_rhs(rhs), trans=True)
+        if solver == 'factorize':
+            self.factorize()
+        if self._lu is None:
+            s = _iterate_a_matrix(self._view('_A', 'csc').T, rhs, solver=solver, quiet=quiet, **kwargs)
+            return _dense_rhs(s)
+        return self._lu.solve(_dense_rhs(rhs), trans=True)
+
+    def cumulative_scores(self, char_vector, solver='factorize', **kwargs):
+        """
+        Returns the cumulative (i.e. life cycle) impact scores of every foreground and background node, for the
+        supplied characterization vector c, using one adjoint solve:
+          (I - A)^T s = B^T c
+          (I - Af)^T sf = Bf^T c + Ad^T s
+        If the aggregated LCI matrix is present, s = M^T c and no background solve is required.
+        :param char_vector: sparse 1 x mdim characterization vector
+        :param solver: ['factorize'] background solver
+        :param kwargs: passed to the solver
+        :return: sf, s -- dense 1-d arrays of cumulative scores for foreground and background
+        """
+        c = csr_matrix(char_vector).T
+        if self._complete:
+            if self._M is not None:
+                self._solve_local.info = None
+                s = _dense_rhs(self._M.T.dot(c))
+            else:
+                s = self._compute_bg_adjoint(self._B.T.dot(c), solver=solver, **kwargs)
+        else:
+            s = np.zeros(self.ndim)
+        if self.pdim == 0:
+            return np.zeros(0), s
+        rhs = self._bf.T.dot(c).toarray().flatten() + self._ad.T.dot(s)
+        sf = self._solve_fg(csr_matrix(rhs).T, trans=True)
+        return _dense_rhs(sf), s
+
     def activity_levels(self, process, ref_flow, **kwargs):
         """
         Returns the background activity levels resulting from a unit of the designated process.
@@ -660,40 +1427,277 @@ class FlatBackground(BackgroundLayer):
         if self.is_in_background(process, ref_flow):
             ad = _unit_column_vector(self.ndim, self._bg_index[process, ref_flow])
             xf = csr_matrix((1, self.pdim))
-            x = _iterate_a_matrix(self._A, ad, **kwargs)
+            x = self._compute_bg_activity(ad, **kwargs)
             return xf, x.transpose()
         else:
             xf = self._x_tilde(process, ref_flow, **kwargs)
             ad_tilde = self._ad.dot(xf)
-            x = _iterate_a_matrix(self._A, ad_tilde, **kwargs)
+            x = self._compute_bg_activity(ad_tilde, **kwargs)
             return xf.transpose(), x.transpose()
 
-    def _write_ordering(self, filename):
-        if not filename.endswith(ORDERING_SUFFIX):
-            filename += ORDERING_SUFFIX
+    def _traverse_new_nodes(self, be, nodes, multi_term):
+        """
+        Traverse the inventories of new nodes, stopping at nodes already in the flat background and at exterior flows
+        :param be: a BackgroundEngine, used to resolve terminations
+        :param nodes: iterable of processes or (process, ref_flow) tuples; processes may be given by external ref
+        :param multi_term:
+        :return: new ProductFlows in order of discovery, new exterior TermRef params, and lists of [row, col, value]
+         entries for Af among new nodes, Af with rows of existing foreground nodes, Ad and Bf.  Columns are new nodes
+         in order of discovery, and values are not yet divided by inbound_ev.
+        """
+        pfs = []
+        pf_index = dict()
+        queue = []
+        ex_rows = []
+        ex_index = dict()
+        af_new, af_old, ad, bf = [], [], [], []
+
+        def _add_node(flow, process):
+            key = (flow.external_ref, process.external_ref)
+            if key not in pf_index:
+                try:
+                    pf = ProductFlow(len(pfs), flow, process)
+                except NoMatchingReference:
+                    return None
+                pf_index[key] = pf.index
+                pfs.append(pf)
+                queue.append(pf)
+            return pfs[pf_index[key]]
+
+        def _exterior_row(flow, direction, context):
+            cx = '; '.join((context or NullContext).as_list())  # serialize as in from_background_engine
+            key = (cx, flow.external_ref, comp_dir(direction))
+            row = self._ex_index.get(key)
+            if row is None:
+                if key not in ex_index:
+                    ex_index[key] = self.mdim + len(ex_rows)
+                    ex_rows.append((flow.external_ref, comp_dir(direction), cx, 0))
+                row = ex_index[key]
+            return row
+
+        for node in nodes:
+            process, ref_flow = node if isinstance(node, tuple) else (node, None)
+            if isinstance(process, str):
+                process = be.fg.get(process)
+            refs = list(process.references()) if ref_flow is None else [process.reference(ref_flow)]
+            for rx in refs:
+                if (process.external_ref, rx.flow.external_ref) not in self._fg_index and \
+                        not self.is_in_background(process.external_ref, rx.flow.external_ref):
+                    _add_node(rx.flow, process)
+
+        while queue:
+            parent = queue.pop()
+            rx = parent.process.reference(parent.flow)
+            for exch in parent.process.inventory(ref_flow=rx):
+                val = exch.value
+                if exch.is_reference or val is None or val == 0:
+                    continue
+                if exch.flow == parent.flow and exch.direction == comp_dir(parent.direction) and \
+                        val == 1.0 and exch.type == 'cutoff':
+                    continue  # pass-thru flow
+                pval = -val if exch.direction == 'Output' else val
+                term = be.terminate(exch, multi_term)
+                if term is None:
+                    bf.append([_exterior_row(exch.flow, exch.direction, exch.termination), parent.index, val])
+                    continue
+                key = (term.external_ref, exch.flow.external_ref)
+                if key in self._bg_index:
+                    ad.append([self._bg_index[key], parent.index, pval])
+                elif key in self._fg_index:
+                    af_old.append([self._fg_index[key], parent.index, pval])
+                else:
+                    i = _add_node(exch.flow, term)
+                    if i is None:  # missing reference: cut off
+                        bf.append([_exterior_row(exch.flow, exch.direction, None), parent.index, val])
+                    elif i is parent:
+                        parent.adjust_ev(pval)
+                    else:
+                        af_new.append([i.index, parent.index, pval])
 
-        ordr = {'foreground': [tuple(f) for f in self._fg],
-                'background': [tuple(f) for f in self._bg],
-                'exterior': [tuple(f) for f in self._ex]}
-        to_json(ordr, filename, gzip=True)
+        return pfs, ex_rows, af_new, af_old, ad, bf
 
-    def _write_mat(self, filename, complete=True):
+    def add_foreground(self, query, nodes, multi_term='abort', preferred=None):
+        """
+        Add new foreground nodes without rebuilding the background.  Only the new nodes are traversed: each link
+        ends at a node already in the flat background, at an exterior flow, or at another new node, which is added
+        too.  A and any factorization of (I - A) are reused unchanged; B (and the aggregated matrix) only gain empty
+        rows for new exterior flows.
+
+        New nodes are placed ahead of the existing foreground, in topological order, so that Af remains lower
+        triangular.  New exterior flows are appended.  Cached results, views, and stored characterizations are
+        discarded.
+        :param query: an index + exchange interface, as for from_query()
+        :param nodes: iterable of processes (all of whose reference flows are added) or (process, ref_flow) tuples.
+         Processes may be given by external ref.
+        :param multi_term: ['abort'] how to handle ambiguous terminations (see BackgroundEngine.add_ref_product)
+        :param preferred: [None] a preferred-provider dict as specified in BackgroundEngine init
+        :return: list of TermRefs of the new foreground nodes
+        """
+        be = BackgroundEngine(query, preferred=preferred)
+        pfs, ex_rows, af_new, af_old, ad, bf = self._traverse_new_nodes(be, nodes, multi_term)
+        n = len(pfs)
+        if n == 0:
+            return []
+        pdim, ndim, mdim = self.pdim, self.ndim, self.mdim + len(ex_rows)
+        ev = np.array([pf.inbound_ev for pf in pfs])
+
+        def _entries(entries, shape, new_rows=False):
+            e = np.array(entries, dtype=float).reshape(-1, 3)
+            rows, cols = e[:, 0].astype(int), e[:, 1].astype(int)
+            if new_rows:
+                rows = position[rows]
+            return csr_matrix((e[:, 2] / ev[cols], (rows, position[cols])), shape=shape)
+
+        def _pad(m):
+            m = m.tocoo()
+            return csr_matrix((m.data, (m.row, m.col)), shape=(mdim, m.shape[1]))
+
+        position = np.arange(n)
+        blocks = scc_blocks(_entries(af_new, (n, n), new_rows=True))
+        order = sorted(range(n), key=lambda i: (blocks[i], i))  # consumers first, then order of discovery
+        position[order] = np.arange(n)
+
+        _af = self._af if self._af is not None else csr_matrix((pdim, pdim))
+        _ad = self._ad if self._ad is not None else csr_matrix((ndim, pdim))
+        _bf = self._bf if self._bf is not None else csr_matrix((self.mdim, pdim))
+        self._af = bmat([[_entries(af_new, (n, n), new_rows=True), csr_matrix((n, pdim))],
+                         [_entries(af_old, (pdim, n)), _af]], format='csc')
+        self._ad = hstack([_entries(ad, (ndim, n)), _ad], format='csc')
+        self._bf = hstack([_entries(bf, (mdim, n)), _pad(_bf)], format='csc')
+
+        if ex_rows:
+            if self._lci_db is not None:
+                self._lci_db = (self._lci_db[0], _pad(self._lci_db[1]))
+            elif self._lci_loader is not None:
+                loader = self._lci_loader
+
+                def _load_padded():
+                    loaded = loader()
+                    return (loaded[0], _pad(loaded[1])) + tuple(loaded[2:])
+
+                self._lci_loader = _load_padded
+            if self._M is not None:
+                self._M = _pad(self._M).tocsc()
+            self._char_vectors = dict()
+
+        sccs = defaultdict(list)
+        for i in order:
+            sccs[blocks[i]].append(pfs[i])
+        fg_new = []
+        for i in order:
+            peers = sccs[blocks[i]]
+            scc_id = min(peers, key=lambda pf: pf.index).process.external_ref if len(peers) > 1 else 0
+            fg_new.append((pfs[i].flow.external_ref, pfs[i].direction, pfs[i].process.external_ref, scc_id))
+        self._set_terms(fg_new + list(self._fg.rows()), self._bg, list(self._ex.rows()) + ex_rows)
+        if self.context_map is not None:
+            self.map_contexts(query)
+
+        self._fg_solver = None
+        self.drop_views()
+        self.invalidate_cache()
+        return [self._fg[i] for i in range(n)]
+
+    def _write_ordering(self, filename):
+        if not filename.endswith(BINARY_ORDERING_SUFFIX):
+            filename += BINARY_ORDERING_SUFFIX
+        write_ordering(filename, self._fg, self._bg, self._ex)
+
+    def _serialize_matrices(self, complete=True):
         d = {'Af': csr_matrix((self.pdim, self.pdim)) if self._af is None else self._af,
              'Ad': csr_matrix((self.ndim, self.pdim)) if self._ad is None else self._ad,
              'Bf': csr_matrix((self.mdim, self.pdim)) if self._bf is None else self._bf}
         if complete and self._complete:
             d['A'] = self._A
             d['B'] = self._B
-        savemat(filename, d)
+            d['bg_blocks'] = self.bg_blocks
+            if self._lu is not None:
+                d.update(self._lu.to_dict())
+        return d
 
-    def write_to_file(self, filename, complete=True):
-        if filename.endswith(ORDERING_SUFFIX):
-            filename = filename[:-len(ORDERING_SUFFIX)]
+    def _write_mat(self, filename, complete=True):
+        savemat(filename, self._serialize_matrices(complete=complete))
+
+    def _write_mmap(self, dirname, complete=True):
+        written = set()
+        for k, v in self._serialize_matrices(complete=complete).items():
+            if issparse(v):
+                write_sparse_npy(dirname, k, v, fmt='csc' if k.startswith('lu_') else 'csr')
+                if k in MMAP_CSC:
+                    write_sparse_npy(dirname, k + MMAP_CSC_SUFFIX, v, fmt='csc')
+                    written.add(k + MMAP_CSC_SUFFIX)
+                if k in MMAP_CSR:
+                    write_sparse_npy(dirname, k + MMAP_CSR_SUFFIX, v, fmt='csr')
+                    written.add(k + MMAP_CSR_SUFFIX)
+            else:
+                write_array_npy(dirname, k, v)
+            written.add(k)
+        clear_npy(dirname, keep=written)  # members of a previous write, e.g. an outdated factorization
+        self._write_ordering(os.path.join(dirname, MMAP_ORDERING))
+
+    def _write_hdf5(self, filename, complete=True):
+        d = self._serialize_matrices(complete=complete)
+        write_hdf5(filename,
+                   {'foreground': list(self._fg.rows()),
+                    'background': list(self._bg.rows()),
+                    'exterior': list(self._ex.rows())},
+                   {k: v for k, v in d.items() if issparse(v)},
+                   {k: v for k, v in d.items() if not issparse(v)})
+
+    def write_characterizations(self, filename):
+        """
+        Save stored characterization vectors next to the named background file
+        :param filename: the background file
+        :return:
+        """
+        keys = sorted(k for k in self._char_vectors.keys() if k[1] is not None)  # unmapped contexts: not saved
+        if len(keys) == 0:
+            if os.path.exists(filename + CHARACTERIZATION_SUFFIX):
+                os.remove(filename + CHARACTERIZATION_SUFFIX)  # stale from a previous write
+            return
+        c = csr_matrix(vstack([self._char_vectors[k] for k in keys]))
+        with open(filename + CHARACTERIZATION_SUFFIX, 'wb') as fp:
+            np.savez_compressed(fp, quantities=np.array([str(k[0]) for k in keys]),
+                                versions=np.array([str(k[1]) for k in keys]),
+                                data=c.data, indices=c.indices, indptr=c.indptr, shape=np.array(c.shape))
+
+    def _write_aggregated(self, filename):
+        write_sparse_npy(filename + AGGREGATED_SUFFIX, 'M', self._M, fmt='csc')
+
+    def write_to_file(self, filename, complete=True, factorize=False, aggregate=False, drop_tol=1e-10):
+        """
+        Serialize the background to a file, along with its ordering.  Supported file types are '.mat' (with the ordering
+        in a separate file), '.hdf' (self-contained; requires h5py), and '.mmap' (a directory of memory-mappable
+        arrays; see from_mmap()).
+        :param filename:
+        :param complete: [True] whether to include the A and B matrices (and the factorization of (I - A) and the
+         aggregated LCI matrix, if known)
+        :param factorize: [False] compute the factorization of (I - A) before writing, if it is not already known
+        :param aggregate: [False] compute the aggregated LCI matrix before writing, if it is not already known
+        :param drop_tol: [1e-10] relative drop tolerance for the aggregated LCI matrix (see aggregate())
+        :return:
+        """
+        if complete and self._complete:
+            if factorize:
+                self.factorize()
+            if aggregate and self._M is None:
+                self.aggregate(drop_tol=drop_tol)
+        for suffix in (ORDERING_SUFFIX, BINARY_ORDERING_SUFFIX):
+            if filename.endswith(suffix):
+                filename = filename[:-len(suffix)]
         filetype = os.path.splitext(filename)[1]
         if filetype not in SUPPORTED_FILETYPES:
             raise ValueError('Unsupported file type %s' % filetype)
         if filetype == '.mat':
             self._write_mat(filename, complete=complete)
+            self._write_ordering(filename)
+        elif filetype == '.hdf':
+            self._write_hdf5(filename, complete=complete)  # ordering is stored in the file
+        elif filetype == '.mmap':
+            self._write_mmap(filename, complete=complete)  # filename is a directory
         else:
             raise ValueError('Unsupported file type %s' % filetype)
-        self._write_ordering(filename)
+        if complete and self._M is not None:
+            self._write_aggregated(filename)
+        else:
+            shutil.rmtree(filename + AGGREGATED_SUFFIX, ignore_errors=True)  # stale from a previous write
+        self.write_characterizations(filename)
@@ -0,0 +1,125 @@
+"""
+Storage of a flat background in a single HDF5 file.  Sparse matrices are stored as groups of chunked, compressed
+datasets holding their compressed-format arrays; TermRef tables are stored as groups of column datasets.  Members
+are read individually, so a reader can load the foreground matrices without touching A and B.
+
+Requires h5py, which is an optional dependency (pip install antelope_background[hdf5]).
+"""
+
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+_SPARSE_FORMATS = {'csc': csc_matrix, 'csr': csr_matrix}
+_COMPONENTS = ('data', 'indices', 'indptr')
+_TERM_TABLES = ('foreground', 'background', 'exterior')
+
+
+def _check_h5py():
+    if h5py is None:
+        raise ImportError('h5py is required for .hdf backgrounds: pip install antelope_background[hdf5]')
+
+
+def _create_dataset(group, name, arr, compression):
+    """
+    Empty datasets cannot be chunked, so they are stored contiguously
+    """
+    if len(arr) == 0:
+        return group.create_dataset(name, data=arr)
+    return group.create_dataset(name, data=arr, chunks=True, compression=compression, shuffle=True)
+
+
+def _write_sparse(f, name, matrix, compression):
+    fmt = matrix.format if matrix.format in _SPARSE_FORMATS else 'csr'
+    matrix = _SPARSE_FORMATS[fmt](matrix)
+    grp = f.create_group(name)
+    for component in _COMPONENTS:
+        _create_dataset(grp, component, getattr(matrix, component), compression)
+    grp.attrs['format'] = fmt
+    grp.attrs['shape'] = np.array(matrix.shape, dtype=np.int64)
+
+
+def _read_sparse(f, name):
+    grp = f[name]
+    fmt = grp.attrs['format']
+    if isinstance(fmt, bytes):
+        fmt = fmt.decode()
+    shape = tuple(int(k) for k in grp.attrs['shape'])
+    return _SPARSE_FORMATS[fmt](tuple(grp[component][()] for component in _COMPONENTS), shape=shape)
+
+
+def _write_terms(f, name, terms, compression):
+    """
+    :param terms: sequence of TermRef parameter tuples (flow_ref, direction, term_ref, scc_id)
+    """
+    str_dt = h5py.string_dtype()
+    rows = [tuple(t) for t in terms]
+    grp = f.create_group('terms/%s' % name)
+    _create_dataset(grp, 'flow_ref', np.array([str(r[0]) for r in rows], dtype=object).astype(str_dt), compression)
+    _create_dataset(grp, 'direction', np.array([r[1] for r in rows], dtype=np.int8), compression)
+    _create_dataset(grp, 'term_ref', np.array([str(r[2]) for r in rows], dtype=object).astype(str_dt), compression)
+    _create_dataset(grp, 'scc_id', np.array(['' if r[3] in (0, None) else str(r[3]) for r in rows],
+                                            dtype=object).astype(str_dt), compression)
+
+
+def _read_terms(f, name):
+    grp = f['terms/%s' % name]
+    flows, terms, sccs = (grp[k].asstr()[()] for k in ('flow_ref', 'term_ref', 'scc_id'))
+    dirns = grp['direction'][()]
+    return [(fl, int(d), t, s or None) for fl, d, t, s in zip(flows, dirns, terms, sccs)]
+
+
+def write_hdf5(filename, tables, matrices, arrays=None, compression='gzip'):
+    """
+    Write a flat background to an HDF5 file, replacing any existing file
+    :param filename:
+    :param tables: dict of 'foreground', 'background', 'exterior' to sequences of TermRef parameter tuples
+    :param matrices: dict of name to sparse matrix (None values are skipped)
+    :param arrays: [None] dict of name to dense 1-d array (None values are skipped)
+    :param compression: ['gzip'] dataset compression filter
+    :return:
+    """
+    _check_h5py()
+    with h5py.File(filename, 'w') as f:
+        for name in _TERM_TABLES:
+            _write_terms(f, name, tables[name], compression)
+        for name, matrix in matrices.items():
+            if matrix is not None:
+                _write_sparse(f, 'matrices/%s' % name, matrix, compression)
+        for name, arr in (arrays or dict()).items():
+            if arr is not None:
+                _create_dataset(f.require_group('arrays'), name, np.asarray(arr), compression)
+
+
+def hdf5_matrix_names(filename):
+    """
+    Names of the sparse matrices stored in an HDF5 background file
+    """
+    _check_h5py()
+    with h5py.File(filename, 'r') as f:
+        return list(f['matrices'].keys()) if 'matrices' in f else []
+
+
+def read_hdf5(filename, matrix_names, array_names=(), tables=True):
+    """
+    Read TermRef tables and the named members from an HDF5 background file.  Members that are not present in the
+    file are returned as None.
+    :param filename:
+    :param matrix_names: names of sparse matrices to read
+    :param array_names: names of dense arrays to read
+    :param tables: [True] whether to read the TermRef tables
+    :return: tables, matrices, arrays -- three dicts
+    """
+    _check_h5py()
+    with h5py.File(filename, 'r') as f:
+        tables = {name: _read_terms(f, name) for name in _TERM_TABLES} if tables else dict()
+        matrices = {name: _read_sparse(f, 'matrices/%s' % name) if 'matrices/%s' % name in f else None
+                    for name in matrix_names}
+        arrays = {name: f['arrays/%s' % name][()] if 'arrays/%s' % name in f else None
+                  for name in array_names}
+    return tables, matrices, arrays
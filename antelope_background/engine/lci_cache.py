@@ -0,0 +1,104 @@
+"""
+A bounded, size-aware LRU cache for computed sparse result vectors
+"""
+
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+
+CacheInfo = namedtuple('CacheInfo', ('hits', 'misses', 'entries', 'nbytes', 'max_bytes'))
+
+
+def _nbytes(value):
+    """
+    Memory footprint of a sparse (or dense) result
+    """
+    if hasattr(value, 'indptr'):
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    return value.data.nbytes
+
+
+class LciCache(object):
+    """
+    Least-recently-used cache whose capacity is a total number of bytes rather than a number of entries.  Stored
+    results are shared with callers and must not be modified.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """
+        :param max_bytes: [64 MiB] capacity. 0 disables the cache.
+        """
+        self._max_bytes = max_bytes
+        self._d = OrderedDict()
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def make_key(kind, process, ref_flow, options):
+        """
+        :param kind: which computation, e.g. 'lci'
+        :param process:
+        :param ref_flow:
+        :param options: dict of solver keyword arguments.  'quiet' does not affect the result and is ignored.
+        :return: hashable key, or None if the options are not hashable
+        """
+        key = (kind, process, ref_flow, tuple(sorted((k, v) for k, v in options.items() if k != 'quiet')))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        return self.get_with_info(key)[0]
+
+    def get_with_info(self, key):
+        """
+        :param key:
+        :return: the stored result and the solve info stored with it, or (None, None) on a miss
+        """
+        with self._lock:
+            try:
+                value, _, solve_info = self._d[key]
+            except KeyError:
+                self._misses += 1
+                return None, None
+            self._d.move_to_end(key)
+            self._hits += 1
+            return value, solve_info
+
+    def put(self, key, value, solve_info=None):
+        """
+        :param key:
+        :param value: result to store
+        :param solve_info: [None] convergence info of the solve that produced the result, returned with it
+        """
+        size = _nbytes(value)
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._d:
+                self._nbytes -= self._d.pop(key)[1]
+            self._d[key] = (value, size, solve_info)
+            self._nbytes += size
+            while self._nbytes > self._max_bytes:
+                _, (_, old_size, _) = self._d.popitem(last=False)
+                self._nbytes -= old_size
+
+    def invalidate(self):
+        """
+        Drop all stored results.  Hit and miss counters are retained.
+        """
+        with self._lock:
+            self._d.clear()
+            self._nbytes = 0
+
+    @property
+    def info(self):
+        return CacheInfo(self._hits, self._misses, len(self._d), self._nbytes, self._max_bytes)
+
+    def __len__(self):
+        return len(self._d)
@@ -0,0 +1,107 @@
+"""
+Storage of sparse matrices as raw numpy arrays, one .npy file per component, so that they can be opened with
+mmap_mode and shared among processes via the page cache.
+"""
+
+import os
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix
+
+
+_SPARSE_FORMATS = {'csc': csc_matrix, 'csr': csr_matrix}
+_COMPONENTS = ('data', 'indices', 'indptr')
+
+
+def _npy_path(dirname, name, component):
+    return os.path.join(dirname, '%s.%s.npy' % (name, component))
+
+
+def _save_npy(filename, arr):
+    """
+    Write to a temporary file and move it into place, so that any existing memory map of the file stays valid
+    """
+    tmp = filename + '.tmp.npy'
+    np.save(tmp, arr)
+    os.replace(tmp, filename)
+
+
+def has_sparse_npy(dirname, name):
+    return os.path.exists(_npy_path(dirname, name, 'shape'))
+
+
+def write_sparse_npy(dirname, name, matrix, fmt='csc'):
+    """
+    Store a sparse matrix as a set of .npy files in the named directory
+    :param dirname: directory (created if it does not exist)
+    :param name: matrix name, used as a file prefix
+    :param matrix: sparse matrix
+    :param fmt: ['csc'] compressed format to store, 'csc' or 'csr'
+    :return:
+    """
+    os.makedirs(dirname, exist_ok=True)
+    matrix = _SPARSE_FORMATS[fmt](matrix)
+    matrix.sum_duplicates()
+    for component in _COMPONENTS:
+        _save_npy(_npy_path(dirname, name, component), getattr(matrix, component))
+    _save_npy(_npy_path(dirname, name, 'format'), np.array(fmt))
+    _save_npy(_npy_path(dirname, name, 'shape'), np.array(matrix.shape, dtype=np.int64))
+
+
+def read_sparse_npy(dirname, name, mmap_mode='r'):
+    """
+    Restore a sparse matrix stored with write_sparse_npy().  With mmap_mode set, the data and index arrays are
+    memory maps of the stored files and are not read until they are used.
+    :param dirname:
+    :param name:
+    :param mmap_mode: ['r'] passed to numpy.load(); None to read into memory
+    :return: csc_matrix or csr_matrix
+    """
+    fmt = str(np.load(_npy_path(dirname, name, 'format')))
+    shape = tuple(int(k) for k in np.load(_npy_path(dirname, name, 'shape')))
+    data, indices, indptr = (np.load(_npy_path(dirname, name, component), mmap_mode=mmap_mode)
+                             for component in _COMPONENTS)
+    return _SPARSE_FORMATS[fmt]((data, indices, indptr), shape=shape, copy=False)
+
+
+def has_array_npy(dirname, name):
+    return os.path.exists(os.path.join(dirname, '%s.npy' % name))
+
+
+def write_array_npy(dirname, name, arr):
+    """
+    Store a dense array as a .npy file in the named directory
+    """
+    os.makedirs(dirname, exist_ok=True)
+    _save_npy(os.path.join(dirname, '%s.npy' % name), np.asarray(arr))
+
+
+def read_array_npy(dirname, name, mmap_mode='r'):
+    return np.load(os.path.join(dirname, '%s.npy' % name), mmap_mode=mmap_mode)
+
+
+def clear_npy(dirname, keep=()):
+    """
+    Remove the stored matrices and arrays in the named directory, except those named in keep.  Existing memory maps
+    of removed files remain valid.
+    :param dirname:
+    :param keep: names of matrices and arrays to retain
+    :return:
+    """
+    if not os.path.isdir(dirname):
+        return
+    for fn in os.listdir(dirname):
+        if fn.endswith('.npy') and fn.split('.')[0] not in keep:
+            os.remove(os.path.join(dirname, fn))
+
+
+def sparse_column(matrix, index):
+    """
+    Extract a single column from a csc_matrix by slicing its arrays directly
+    :param matrix: csc_matrix
+    :param index: column
+    :return: a sparse (nrows x 1) column
+    """
+    start, stop = matrix.indptr[index], matrix.indptr[index + 1]
+    data = np.array(matrix.data[start:stop])
+    rows = np.array(matrix.indices[start:stop])
+    return csr_matrix((data, (rows, np.zeros(len(rows), dtype=int))), shape=(matrix.shape[0], 1))
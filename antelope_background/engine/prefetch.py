@@ -0,0 +1,75 @@
+"""
+Speculative, bounded prefetching of process inventories for the BackgroundEngine traversal.
+
+The Tarjan traversal itself remains single-threaded: inventories are requested ahead of time on a thread pool, and
+the traversal collects each one when it reaches the node, in the same order as it would without prefetching.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class InventoryPrefetcher(object):
+    def __init__(self, workers=0, max_pending=None):
+        """
+        :param workers: [0] size of the thread pool. 0 disables prefetching: every inventory is fetched on demand.
+        :param max_pending: [4 * workers] maximum number of inventories requested but not yet collected.  Further
+         requests are ignored until some are collected, which bounds the memory held by prefetched inventories.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self._max_pending = max_pending or 4 * workers
+        self._pending = OrderedDict()  # (flow_ref, process_ref) -> Future
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self._executor is not None
+
+    @staticmethod
+    def _fetch(process, flow):
+        rx = process.reference(flow)
+        return rx, list(process.inventory(ref_flow=rx))  # allocated exchanges
+
+    def request(self, process, flow):
+        """
+        Begin fetching the inventory of the named process with respect to the named reference flow, if there is room
+        :param process:
+        :param flow:
+        :return:
+        """
+        if self._executor is None:
+            return
+        key = (flow.external_ref, process.external_ref)
+        if key in self._pending or len(self._pending) >= self._max_pending:
+            return
+        self._pending[key] = self._executor.submit(self._fetch, process, flow)
+
+    def fetch(self, process, flow):
+        """
+        Collect a prefetched inventory, or fetch it now if it was not requested.  Errors raised during a prefetch are
+        raised here.
+        :param process:
+        :param flow:
+        :return: reference exchange, list of allocated exchanges
+        """
+        future = self._pending.pop((flow.external_ref, process.external_ref), None)
+        if future is None:
+            self.misses += 1
+            return self._fetch(process, flow)
+        self.hits += 1
+        return future.result()
+
+    def clear(self):
+        """
+        Discard requested inventories that were never collected
+        """
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+    def shutdown(self):
+        self.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
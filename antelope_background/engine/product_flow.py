@@ -10,7 +10,7 @@ class ProductFlow(object):
     Class for storing foreground-relevant information about a single matched row-and-column in the interior matrix.
 
     """
-    def __init__(self, index, flow, process):
+    def __init__(self, index, flow, process, direction=None, inbound_ev=None):
         """
         Initialize a row+column in the technology matrix.  Each row corresponds to a reference exchange in the database,
         and thus represents a particular process generating / consuming a particular flow.  A ProductFlow entry is
@@ -26,6 +26,9 @@ class ProductFlow(object):
         :param process: the termination of the parent node's exchange (term_node). None is equivalent to a
         cutoff flow or elementary flow (distinction is left to a compartment manager).  If non-null, the process must
         possess a reference exchange with the same flow or the graph traversal may be curtailed.
+        :param direction: [None] direction of the reference exchange, if already known (e.g. when restoring a
+        checkpoint).  If omitted, it is found by querying the process for its reference exchange.
+        :param inbound_ev: [None] inbound exchange value, if already known.  If omitted, it is +/-1 per direction.
         """
         self._index = index
         self._flow = flow
@@ -40,16 +43,20 @@ class ProductFlow(object):
 
         self._hash = (flow.external_ref, process.external_ref)
 
-        try:
-            ref_exch = process.reference(flow)
-        except NoReference:
-            print('##! flow %s - termination %s : no reference found!##' % self._hash)
-            raise NoMatchingReference
+        if direction is None:
+            try:
+                ref_exch = process.reference(flow)
+            except NoReference:
+                print('##! flow %s - termination %s : no reference found!##' % self._hash)
+                raise NoMatchingReference
+            direction = ref_exch.direction
 
-        self._inbound_ev = {'Input': -1.0,
-                            'Output': 1.0}[ref_exch.direction]  # required to account for self-dependency
+        if inbound_ev is None:
+            inbound_ev = {'Input': -1.0,
+                          'Output': 1.0}[direction]  # required to account for self-dependency
+        self._inbound_ev = inbound_ev
 
-        self._direction = ref_exch.direction
+        self._direction = direction
         '''# I don't think this is doing anything
         if ref_exch.value is None:
             print('None RX found! assuming nominal direction\nflow: %s\nterm: %s' % (flow, process))
@@ -0,0 +1,417 @@
+"""
+Sparse solvers for the (I - A) systems that arise in background LCI computations.
+"""
+
+from collections import namedtuple
+
+from collections import deque
+
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix, eye, triu
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import splu, spsolve_triangular, spilu, gmres, bicgstab, LinearOperator
+
+
+"""
+SolveInfo reports the outcome of an iterative solve of one right-hand side:
+.solver = name of the method
+.iterations = number of iterations performed
+.residual = relative residual norm |b - (I - A)x| / |b| of the returned solution
+.converged = bool, whether the method reported convergence to the requested tolerance
+"""
+SolveInfo = namedtuple('SolveInfo', ('solver', 'iterations', 'residual', 'converged'))
+
+
+class LuFactorization(object):
+    """
+    A sparse LU decomposition of (I - A) that can be serialized along with the background and restored later.
+
+    SuperLU computes Pr * (I - A) * Pc = L * U.  A freshly-computed factorization solves with the SuperLU object
+    directly; a restored factorization solves with a pair of triangular solves on the stored L and U factors.
+    Either way, the cost of the factorization itself is only paid once.
+    """
+    @classmethod
+    def from_matrix(cls, a):
+        """
+        Factorize (I - a)
+        :param a: square sparse matrix
+        :return: LuFactorization
+        """
+        ima = eye(a.shape[0], format='csc') - a.tocsc()
+        lu = splu(ima.tocsc())
+        return cls(lu.perm_r, lu.perm_c, superlu=lu)
+
+    @classmethod
+    def from_dict(cls, d, prefix='lu_'):
+        """
+        Restore a factorization from a dict, such as the one returned by loadmat().  CSR copies of the factors, if
+        present as L_csr and U_csr, are used as they are for triangular solves.
+        :param d:
+        :param prefix: ['lu_'] key prefix
+        :return: LuFactorization, or None if the dict does not contain one
+        """
+        if prefix + 'L' not in d:
+            return None
+        if prefix + 'L_csr' in d:
+            csr_factors = d[prefix + 'L_csr'], d[prefix + 'U_csr']
+        else:
+            csr_factors = None
+        return cls(d[prefix + 'perm_r'], d[prefix + 'perm_c'], l_factor=d[prefix + 'L'], u_factor=d[prefix + 'U'],
+                   csr_factors=csr_factors)
+
+    def __init__(self, perm_r, perm_c, l_factor=None, u_factor=None, superlu=None, csr_factors=None):
+        """
+        Must supply either superlu or both l_factor and u_factor
+        :param perm_r: row permutation
+        :param perm_c: column permutation
+        :param l_factor: unit lower-triangular factor L
+        :param u_factor: upper-triangular factor U
+        :param superlu: a scipy SuperLU object
+        :param csr_factors: [None] L and U in CSR form, if already known
+        """
+        if superlu is None and (l_factor is None or u_factor is None):
+            raise ValueError('Must supply either a SuperLU object or L and U factors')
+        self._perm_r = np.asarray(perm_r, dtype=int).flatten()
+        self._perm_c = np.asarray(perm_c, dtype=int).flatten()
+        self._superlu = superlu
+        self._L = None if l_factor is None else csc_matrix(l_factor)
+        self._U = None if u_factor is None else csc_matrix(u_factor)
+        self._factors = dict()  # trans -> (first, second) CSR triangular factors, converted once for spsolve_triangular
+        if csr_factors is not None:
+            self._factors[False] = tuple(csr_matrix(f) for f in csr_factors)
+
+    @property
+    def shape(self):
+        n = len(self._perm_r)
+        return n, n
+
+    @property
+    def L(self):
+        if self._L is None:
+            self._L = self._superlu.L
+        return self._L
+
+    @property
+    def U(self):
+        if self._U is None:
+            self._U = self._superlu.U
+        return self._U
+
+    def to_dict(self, prefix='lu_'):
+        """
+        Serializable form of the factorization, suitable for savemat()
+        :param prefix: ['lu_'] key prefix
+        :return:
+        """
+        return {prefix + 'L': self.L,
+                prefix + 'U': self.U,
+                prefix + 'perm_r': self._perm_r,
+                prefix + 'perm_c': self._perm_c}
+
+    def _csr_factors(self, trans):
+        """
+        The triangular factors in the order they are applied, in the CSR form spsolve_triangular requires: (L, U),
+        or (U^T, L^T) if trans is True
+        :param trans:
+        :return:
+        """
+        if trans not in self._factors:
+            if trans:
+                self._factors[trans] = self.U.T.tocsr(), self.L.T.tocsr()
+            else:
+                self._factors[trans] = self.L.tocsr(), self.U.tocsr()
+        return self._factors[trans]
+
+    def solve(self, b, trans=False):
+        """
+        Solve (I - A) x = b, or (I - A)^T x = b if trans is True
+        :param b: dense 1-d or 2-d array
+        :param trans: [False]
+        :return: dense array with the same shape as b
+        """
+        b = np.asarray(b, dtype=float)
+        if self._superlu is not None:
+            return self._superlu.solve(b, trans='T' if trans else 'N')
+
+        # Pr^T L U Pc^T = (I - A)
+        first, second = self._csr_factors(trans)
+        if trans:
+            y = np.empty_like(b)
+            y[self._perm_c] = b
+            y = spsolve_triangular(first, y, lower=True)
+            y = spsolve_triangular(second, y, lower=False, unit_diagonal=True)
+            return y[self._perm_r]
+        y = np.empty_like(b)
+        y[self._perm_r] = b
+        y = spsolve_triangular(first, y, lower=True, unit_diagonal=True)
+        y = spsolve_triangular(second, y, lower=False)
+        return y[self._perm_c]
+
+    def __call__(self, b):
+        return self.solve(b)
+
+
+class ForegroundSolver(object):
+    """
+    Exact solver for the foreground system (I - Af) x = y.
+
+    Foreground nodes are ordered topologically (consumers before their dependencies), so Af is strictly lower
+    triangular unless the foreground contains strongly connected components.  A triangular (I - Af) is solved by
+    forward substitution; otherwise the solver falls back to a sparse LU factorization.  If the foreground is small
+    enough, the closure (I - Af)^-1 is computed once and stored, so that solutions are matrix products (or column
+    lookups).
+    """
+    def __init__(self, af, closure_max=1000):
+        """
+        :param af: square sparse foreground matrix
+        :param closure_max: [1000] compute and store the closure if af has at most this many rows
+        """
+        n = af.shape[0]
+        self._ima = (eye(n, format='csr') - af.tocsr()).tocsr()
+        self._ima_t = None
+        self._triangular = triu(af).count_nonzero() == 0
+        self._lu = None if self._triangular else splu(self._ima.tocsc())
+        self._closure = None
+        if n <= closure_max:
+            self._closure = csc_matrix(self._solve_dense(np.eye(n)))
+
+    @property
+    def triangular(self):
+        return self._triangular
+
+    @property
+    def closure(self):
+        return self._closure
+
+    def _solve_dense(self, b, trans=False):
+        if self._lu is not None:
+            return self._lu.solve(b, trans='T' if trans else 'N')
+        if trans:
+            if self._ima_t is None:
+                self._ima_t = self._ima.T.tocsr()
+            return spsolve_triangular(self._ima_t, b, lower=False, unit_diagonal=True)
+        return spsolve_triangular(self._ima, b, lower=True, unit_diagonal=True)
+
+    def solve(self, y, trans=False):
+        """
+        Solve (I - Af) x = y, or (I - Af)^T x = y if trans is True
+        :param y: sparse column(s)
+        :param trans: [False]
+        :return: sparse column(s)
+        """
+        if self._closure is not None:
+            if trans:
+                return csc_matrix(self._closure.T.dot(y))
+            return csc_matrix(self._closure.dot(y))
+        b = y.toarray()
+        x = self._solve_dense(b[:, 0] if b.shape[1] == 1 else b, trans=trans)
+        if x.ndim == 1:
+            return csc_matrix(x).T
+        return csc_matrix(x)
+
+
+def scc_blocks(a):
+    """
+    Determine the strongly connected components of the technology matrix and order them topologically, so that
+    every node's consumers come before the node itself.  In that order, (I - A) is block lower triangular.
+    :param a: square sparse matrix, a[i, j] != 0 if j depends on i
+    :return: integer array of block numbers, one per node, numbered in solution order
+    """
+    n_comp, labels = connected_components(a, directed=True, connection='strong')
+    coo = a.tocoo()
+    dep = labels[coo.row]
+    con = labels[coo.col]
+    cross = dep != con
+    edges = np.unique(np.array([con[cross], dep[cross]]), axis=1)  # consumer block -> dependency block
+
+    indegree = np.bincount(edges[1], minlength=n_comp)
+    downstream = [[] for _ in range(n_comp)]
+    for c, d in edges.T:
+        downstream[c].append(d)
+
+    position = np.empty(n_comp, dtype=int)
+    queue = deque(np.flatnonzero(indegree == 0))
+    k = 0
+    while queue:
+        c = queue.popleft()
+        position[c] = k
+        k += 1
+        for d in downstream[c]:
+            indegree[d] -= 1
+            if indegree[d] == 0:
+                queue.append(d)
+    return position[labels]
+
+
+class BlockTriangularSolver(object):
+    """
+    Solves (I - A) x = y by block substitution over the strongly connected components of A.
+
+    When A's nodes are permuted into the topological order of its SCCs, (I - A) is block lower triangular.  Only the
+    nontrivial (cyclic) diagonal blocks are LU-factorized; runs of consecutive singleton blocks make up acyclic
+    stretches which are lower triangular, and are solved by forward substitution.  On databases with a large acyclic
+    remainder this requires much less time and memory than factorizing all of (I - A).
+    """
+    def __init__(self, a, blocks=None):
+        """
+        :param a: square sparse matrix
+        :param blocks: [None] block numbers from scc_blocks(); computed if omitted
+        """
+        if blocks is None:
+            blocks = scc_blocks(a)
+        self._blocks = np.asarray(blocks, dtype=int).flatten()
+        self._order = np.argsort(self._blocks, kind='stable')
+        n = a.shape[0]
+        self._ap = csr_matrix(a)[self._order, :][:, self._order]
+
+        # partition into segments: each nontrivial block is a segment; consecutive singletons are merged
+        sizes = np.bincount(self._blocks)
+        bounds = np.concatenate([[0], np.cumsum(sizes)])
+        self._segments = []  # (start, stop, cyclic)
+        for b in range(len(sizes)):
+            start, stop = bounds[b], bounds[b + 1]
+            cyclic = sizes[b] > 1
+            if not cyclic and self._segments and not self._segments[-1][2]:
+                self._segments[-1] = (self._segments[-1][0], stop, False)
+            else:
+                self._segments.append((start, stop, cyclic))
+
+        self._diag = []
+        self._lower = []
+        self._upper = None
+        for start, stop, cyclic in self._segments:
+            d = eye(stop - start, format='csr') - self._ap[start:stop, start:stop]
+            self._diag.append(splu(d.tocsc()) if cyclic else d.tocsr())
+            self._lower.append(self._ap[start:stop, :start])
+        self._n = n
+
+    @property
+    def blocks(self):
+        return self._blocks
+
+    @property
+    def shape(self):
+        return self._n, self._n
+
+    @property
+    def nontrivial(self):
+        """
+        Number of factorized (cyclic) diagonal blocks
+        """
+        return len([k for k in self._segments if k[2]])
+
+    def _solve_diag(self, i, rhs, trans):
+        start, stop, cyclic = self._segments[i]
+        d = self._diag[i]
+        if cyclic:
+            return d.solve(rhs, trans='T' if trans else 'N')
+        if trans:
+            return spsolve_triangular(d.T.tocsr(), rhs, lower=False)
+        return spsolve_triangular(d, rhs, lower=True)
+
+    def solve(self, b, trans=False):
+        """
+        Solve (I - A) x = b, or (I - A)^T x = b if trans is True
+        :param b: dense 1-d or 2-d array
+        :param trans: [False]
+        :return: dense array with the same shape as b
+        """
+        b = np.asarray(b, dtype=float)
+        bp = b[self._order]
+        xp = np.zeros_like(bp)
+        if trans:
+            if self._upper is None:
+                self._upper = [self._ap[stop:, start:stop].T.tocsr() for start, stop, _ in self._segments]
+            for i in reversed(range(len(self._segments))):
+                start, stop, _ = self._segments[i]
+                rhs = bp[start:stop] + self._upper[i].dot(xp[stop:])
+                xp[start:stop] = self._solve_diag(i, rhs, trans)
+        else:
+            for i, (start, stop, _) in enumerate(self._segments):
+                rhs = bp[start:stop] + self._lower[i].dot(xp[:start])
+                xp[start:stop] = self._solve_diag(i, rhs, trans)
+        x = np.empty_like(xp)
+        x[self._order] = xp
+        return x
+
+
+KRYLOV_SOLVERS = ('gmres', 'bicgstab')
+
+
+def _krylov(method, op, b, x0, rtol, maxiter, precond, callback):
+    kwargs = dict(x0=x0, atol=0.0, maxiter=maxiter, M=precond, callback=callback)
+    if method == 'gmres':
+        kwargs['callback_type'] = 'pr_norm'
+        fcn = gmres
+    elif method == 'bicgstab':
+        fcn = bicgstab
+    else:
+        raise ValueError('Unknown Krylov solver %s' % method)
+    try:
+        return fcn(op, b, rtol=rtol, **kwargs)
+    except TypeError:  # scipy < 1.12
+        return fcn(op, b, tol=rtol, **kwargs)
+
+
+class KrylovSolver(object):
+    """
+    Solves (I - A) x = b with GMRES or BiCGSTAB, preconditioned by an incomplete LU factorization of (I - A).  The
+    preconditioner is computed once, when the solver is created, and reused for every subsequent solve.  This uses
+    much less memory than a complete LU factorization, at the cost of an iterative solve per right-hand side.
+    """
+    def __init__(self, a, drop_tol=1e-4, fill_factor=10):
+        """
+        :param a: square sparse matrix
+        :param drop_tol: [1e-4] passed to spilu
+        :param fill_factor: [10] passed to spilu
+        """
+        self._ima = (eye(a.shape[0], format='csc') - a.tocsc()).tocsc()
+        self._ilu = spilu(self._ima, drop_tol=drop_tol, fill_factor=fill_factor)
+        self._ima_t = None
+
+    @property
+    def shape(self):
+        return self._ima.shape
+
+    def _operators(self, trans):
+        if trans:
+            if self._ima_t is None:
+                self._ima_t = self._ima.T.tocsr()
+            return self._ima_t, LinearOperator(self.shape, lambda v: self._ilu.solve(v, trans='T'))
+        return self._ima, LinearOperator(self.shape, self._ilu.solve)
+
+    def _solve_one(self, b, method, rtol, maxiter, trans):
+        op, precond = self._operators(trans)
+        count = [0]
+
+        def _count(_):
+            count[0] += 1
+
+        bnorm = np.linalg.norm(b)
+        if bnorm == 0:
+            return np.zeros_like(b), SolveInfo(method, 0, 0.0, True)
+        x, info = _krylov(method, op, b, self._ilu.solve(b, trans='T' if trans else 'N'), rtol, maxiter,
+                          precond, _count)
+        residual = float(np.linalg.norm(b - op.dot(x)) / bnorm)
+        return x, SolveInfo(method, count[0], residual, info == 0)
+
+    def solve(self, b, method='gmres', rtol=1e-8, maxiter=None, trans=False):
+        """
+        Solve (I - A) x = b, or (I - A)^T x = b if trans is True.  A 2-d b is solved one column at a time.
+        :param b: dense 1-d or 2-d array
+        :param method: ['gmres'] or 'bicgstab'
+        :param rtol: [1e-8] relative tolerance
+        :param maxiter: [None] maximum iterations (solver default if None)
+        :param trans: [False]
+        :return: x, a tuple of SolveInfo (one per column)
+        """
+        b = np.asarray(b, dtype=float)
+        if b.ndim == 1:
+            x, info = self._solve_one(b, method, rtol, maxiter, trans)
+            return x, (info, )
+        x = np.zeros_like(b)
+        infos = []
+        for j in range(b.shape[1]):
+            x[:, j], info = self._solve_one(b[:, j], method, rtol, maxiter, trans)
+            infos.append(info)
+        return x, tuple(infos)
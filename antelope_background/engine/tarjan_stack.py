@@ -45,6 +45,23 @@ class TarjanStack(object):
         self._stack_hash.remove(pf)
         return pf
 
+    @property
+    def depth(self):
+        return len(self._stack)
+
+    def back_out(self, index):
+        """
+        Remove product flows with the given index or higher from the stack, and forget the SCCs they were assigned
+        to (used to back out a failed traversal)
+        :param index:
+        :return:
+        """
+        while len(self._stack) > 0 and self._stack[-1].index >= index:
+            self.pop_from_stack()
+        for k in [k for k in self._sccs.keys() if k >= index]:
+            for node in self._sccs.pop(k):
+                self._scc_of.pop(node)
+
     def label_scc(self, index, key):
         """
 
@@ -60,6 +77,17 @@ class TarjanStack(object):
             if node.key == key:
                 break
 
+    def add_scc(self, index, nodes):
+        """
+        Record a completed SCC directly, without traversal (used when restoring a checkpoint)
+        :param index: scc ID
+        :param nodes: product flows in the SCC
+        :return:
+        """
+        for node in nodes:
+            self._sccs[index].add(node)
+            self._scc_of[node] = index
+
     def _set_background(self):
         ml = 0
         ind = None
@@ -138,12 +166,12 @@ class TarjanStack(object):
 
     def add_to_graph(self, interiors):
         """
-        take a list of interior exchanges (parent, term, exch) and add them to the component graph
+        take interior exchanges as (term, parent) pairs of product flows and add them to the component graph
         :return:
         """
-        for i in interiors:
-            row = self.scc_id(i.term)
-            col = self.scc_id(i.parent)
+        for term, parent in interiors:
+            row = self.scc_id(term)
+            col = self.scc_id(parent)
             self._component_cols_by_row[row].add(col)
             self._component_rows_by_col[col].add(row)
         self._set_background()
@@ -0,0 +1,219 @@
+"""
+Array-backed tables of TermRefs, and their binary serialization.
+
+A TermTable stores each column as an integer array: flow and term refs as codes into a table of unique strings,
+directions as 0 / 1, and SCC ids as string codes (-1 for none).  TermRef objects are only created when a row is
+accessed.
+"""
+
+import os
+import numpy as np
+
+from .background_layer import TermRef
+
+
+_TABLES = ('foreground', 'background', 'exterior')
+_DIRECTIONS = {'Input': 0, 'Output': 1, 0: 0, 1: 1}
+
+
+class TermIndex(object):
+    """
+    Read-only mapping of (term_ref, flow_ref) -- or (term_ref, flow_ref, direction) -- to row number in a TermTable.
+    Keys are tuples of the table's own string objects, so a lookup is a single dict probe and the index adds no
+    string storage to the table.
+    """
+    def __init__(self, table, with_direction=False):
+        self._with_direction = with_direction
+        if with_direction:
+            keys = ((t, f, d) for (t, f), d in zip(table.keys(), table.directions.tolist()))
+        else:
+            keys = table.keys()
+        self._rows = dict(zip(keys, range(len(table))))
+
+    def get(self, key, default=None):
+        if self._with_direction:
+            key = key[0], key[1], _DIRECTIONS[key[2]]
+        return self._rows.get(key, default)
+
+    def __getitem__(self, key):
+        if self._with_direction:
+            key = key[0], key[1], _DIRECTIONS[key[2]]
+        return self._rows[key]
+
+    def __contains__(self, key):
+        if self._with_direction:
+            key = key[0], key[1], _DIRECTIONS[key[2]]
+        return key in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+
+class TermTable(object):
+    def __init__(self, strings, flow, direction, term, scc, codes=None):
+        """
+        :param strings: sequence of unique strings
+        :param flow: integer array of flow_ref codes
+        :param direction: integer array of directions, 0 for 'Input' and 1 for 'Output'
+        :param term: integer array of term_ref codes
+        :param scc: integer array of scc_id codes, -1 for none
+        :param codes: [None] dict of string to code, the inverse of strings; built when first needed if omitted
+        """
+        self._strings = strings
+        self._codes = codes
+        self._flow = np.asarray(flow, dtype=np.int32)
+        self._dirn = np.asarray(direction, dtype=np.int8)
+        self._term = np.asarray(term, dtype=np.int32)
+        self._scc = np.asarray(scc, dtype=np.int32)
+        self._refs = [None] * len(self._flow)
+
+    @classmethod
+    def from_terms(cls, terms, strings=None):
+        """
+        Build a table from TermRefs or TermRef parameter tuples (flow_ref, direction, term_ref, scc_id)
+        :param terms:
+        :param strings: [None] a dict of string to code to share among several tables; updated in place
+        :return:
+        """
+        if isinstance(terms, TermTable):
+            return terms
+        if strings is None:
+            strings = dict()
+
+        def _code(s):
+            return strings.setdefault(s, len(strings))
+
+        flow, dirn, term, scc = [], [], [], []
+        for t in terms:
+            f, d, r, s = tuple(t)
+            flow.append(_code(str(f)))
+            dirn.append(_DIRECTIONS[d])
+            term.append(_code(str(r)))
+            scc.append(-1 if s in (0, None) else _code(str(s)))
+        return cls(list(strings), flow, dirn, term, scc, codes=strings)  # dicts preserve insertion order
+
+    def __len__(self):
+        return len(self._flow)
+
+    def __getitem__(self, i):
+        ref = self._refs[i]
+        if ref is None:
+            s = self._scc[i]
+            ref = TermRef(self._strings[self._flow[i]], int(self._dirn[i]), self._strings[self._term[i]],
+                          None if s < 0 else self._strings[s])
+            self._refs[i] = ref
+        return ref
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def codes(self):
+        if self._codes is None:
+            self._codes = {k: i for i, k in enumerate(self._strings)}
+        return self._codes
+
+    @property
+    def flow_codes(self):
+        return self._flow
+
+    @property
+    def term_codes(self):
+        return self._term
+
+    def index(self, with_direction=False):
+        """
+        :param with_direction: [False] whether keys include the direction, as (term_ref, flow_ref, direction)
+        :return: a TermIndex of the table's rows
+        """
+        return TermIndex(self, with_direction=with_direction)
+
+    def flow_ref(self, i):
+        return self._strings[self._flow[i]]
+
+    def term_ref(self, i):
+        return self._strings[self._term[i]]
+
+    @property
+    def directions(self):
+        """
+        integer array: 1 where the row's direction is 'Output', 0 where 'Input'
+        """
+        return self._dirn
+
+    def rows(self):
+        """
+        Generate TermRef parameter tuples for each row without creating TermRefs
+        """
+        s = self._strings
+        for f, d, t, c in zip(self._flow, self._dirn, self._term, self._scc):
+            yield s[f], int(d), s[t], 0 if c < 0 else s[c]
+
+    def keys(self):
+        """
+        Generate (term_ref, flow_ref) for each row without creating TermRefs
+        """
+        s = self._strings
+        for t, f in zip(self._term.tolist(), self._flow.tolist()):
+            yield s[t], s[f]
+
+
+def pack_strings(strings):
+    """
+    :param strings: sequence of str
+    :return: uint8 array of concatenated UTF-8 bytes, int64 array of offsets (one longer than strings)
+    """
+    encoded = [k.encode('utf-8') for k in strings]
+    offsets = np.cumsum([0] + [len(k) for k in encoded], dtype=np.int64)
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def unpack_strings(data, offsets):
+    """
+    Inverse of pack_strings
+    :param data:
+    :param offsets:
+    :return: list of str
+    """
+    data = data.tobytes()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def write_ordering(filename, foreground, background, exterior):
+    """
+    Write three TermRef tables to a single .npz file, with one shared table of unique strings stored as UTF-8 bytes
+    plus offsets
+    :param filename:
+    :param foreground: sequence of TermRefs, parameter tuples, or a TermTable
+    :param background:
+    :param exterior:
+    :return:
+    """
+    codes = dict()
+    tables = [TermTable.from_terms(terms.rows() if isinstance(terms, TermTable) else terms, strings=codes)
+              for terms in (foreground, background, exterior)]
+    data, offsets = pack_strings(list(codes))
+    arrays = {'string_data': data, 'string_offsets': offsets}
+    for name, table in zip(_TABLES, tables):
+        arrays[name + '_flow'] = table._flow
+        arrays[name + '_direction'] = table._dirn
+        arrays[name + '_term'] = table._term
+        arrays[name + '_scc'] = table._scc
+    tmp = filename + '.tmp.npz'
+    with open(tmp, 'wb') as fp:
+        np.savez(fp, **arrays)
+    os.replace(tmp, filename)
+
+
+def read_ordering(filename):
+    """
+    :param filename:
+    :return: dict of 'foreground', 'background', 'exterior' to TermTable
+    """
+    with np.load(filename, allow_pickle=False) as d:
+        strings = unpack_strings(d['string_data'], d['string_offsets'])
+        codes = {k: i for i, k in enumerate(strings)}
+        return {name: TermTable(strings, d[name + '_flow'], d[name + '_direction'], d[name + '_term'],
+                                d[name + '_scc'], codes=codes)
+                for name in _TABLES}
@@ -0,0 +1,169 @@
+import os
+import tempfile
+import unittest
+
+from antelope_core.archives import LcArchive
+from antelope_core.entities import LcQuantity, LcFlow, LcProcess
+
+from ..background_engine import BackgroundEngine, TerminationError
+
+
+# process: (reference flow, reference value, [(flow, direction, value), ...])
+# mill, grid and mine form the background SCC (mine depends on its own product); assembly and model are foreground
+test_system = {
+    'mill': ('steel', 1.0, [('power', 'Input', 0.4), ('coal', 'Input', 0.2), ('co2', 'Output', 1.0)]),
+    'grid': ('power', 1.0, [('steel', 'Input', 0.3), ('coal', 'Input', 0.6), ('co2', 'Output', 0.2)]),
+    'mine': ('coal', 1.0, [('power', 'Input', 0.05), ('coal', 'Input', 0.1)]),
+    'assembly': ('part', 2.0, [('steel', 'Input', 0.5), ('co2', 'Output', 0.1)]),
+    'model': ('widget', 1.0, [('part', 'Input', 1.0), ('power', 'Input', 1.5)]),
+}
+
+# a second provider of coal makes every consumer of coal ambiguous
+alt_coal = {'alt_mine': ('coal', 1.0, [('co2', 'Output', 0.5)])}
+
+# a second provider of part fails only the last top-level product, after the others have been traversed
+alt_part = {'alt_assembly': ('part', 1.0, [('power', 'Input', 0.8)])}
+
+
+def _test_archive(system):
+    ar = LcArchive(None, ref='test.background.engine')
+    mass = LcQuantity.new('Mass', 'kg')
+    ar.add(mass)
+    flows = {'co2': LcFlow('co2', Name='co2', ReferenceQuantity=mass, context=('air', ))}
+    for ref_flow, _, _ in system.values():
+        if ref_flow not in flows:
+            flows[ref_flow] = LcFlow(ref_flow, Name=ref_flow, ReferenceQuantity=mass)
+    for f in flows.values():
+        ar.add(f)
+    for name, (ref_flow, ref_value, exchanges) in system.items():
+        p = LcProcess(name, Name=name)
+        ar.add(p)
+        p.add_exchange(flows[ref_flow], 'Output', value=ref_value)
+        p.set_reference(flows[ref_flow], 'Output')
+        for flow, direction, value in exchanges:
+            p.add_exchange(flows[flow], direction, value=value)
+    return ar
+
+
+def _expected_entries(system, providers):
+    """
+    Compute the interior and cutoff entries of the system one exchange at a time, keyed by product flow keys
+    :param system:
+    :param providers: dict of flow to the process that provides it
+    :return: interior dict of (term key, parent key) to value, cutoff dict of (emission flow, parent key) to value
+    """
+    interior, cutoff = dict(), dict()
+    for name, (ref_flow, ref_value, exchanges) in system.items():
+        inbound_ev = ref_value
+        for flow, direction, value in exchanges:
+            if flow == ref_flow and direction == 'Input':
+                inbound_ev -= value  # self-dependency
+        parent = (ref_flow, name)
+        for flow, direction, value in exchanges:
+            if flow == 'co2':
+                cutoff[flow, parent] = value / inbound_ev
+            elif not (flow == ref_flow and direction == 'Input'):
+                interior[(flow, providers[flow]), parent] = value / inbound_ev
+    return interior, cutoff
+
+
+def _keyed_matrices(be):
+    """
+    The engine's A, B, Af, Ad, and Bf as dicts keyed by product flow and emission flow refs, so that engines whose
+    product flows are numbered differently can be compared
+    """
+    fg = [pf.key for pf in be.foreground_flows(outputs=False)]
+    bg = [pf.key for pf in be.background_flows()]
+    em = [e.flow.external_ref for e in be.emissions]
+    af, ad, bf = be.make_foreground()
+    a, b = be.lci_db
+
+    def _keyed(m, rows, cols):
+        m = m.tocoo()
+        return {(rows[i], cols[j]): v for i, j, v in zip(m.row, m.col, m.data)}
+
+    return {'A': _keyed(a, bg, bg), 'B': _keyed(b, em, bg), 'Af': _keyed(af, fg, fg), 'Ad': _keyed(ad, bg, fg),
+            'Bf': _keyed(bf, em, fg)}
+
+
+def _build(system, **kwargs):
+    be = BackgroundEngine(_test_archive(system).query, **kwargs)
+    be.add_all_ref_products()
+    return be
+
+
+class BackgroundEngineTestCase(unittest.TestCase):
+    def assertKeyedEqual(self, first, second):
+        for k in first.keys():
+            self.assertSetEqual(set(first[k]), set(second[k]), k)
+            for key, value in first[k].items():
+                self.assertAlmostEqual(value, second[k][key], msg='%s %s' % (k, key))
+
+    def test_matrix_entries(self):
+        m = _keyed_matrices(_build(test_system))
+        interior, cutoff = _expected_entries(test_system, {'steel': 'mill', 'power': 'grid', 'coal': 'mine',
+                                                           'part': 'assembly'})
+        self.assertKeyedEqual({'interior': {**m['A'], **m['Af'], **m['Ad']}, 'cutoff': {**m['B'], **m['Bf']}},
+                              {'interior': interior, 'cutoff': cutoff})
+        bg = {('steel', 'mill'), ('power', 'grid'), ('coal', 'mine')}
+        self.assertSetEqual({k for key in m['A'] for k in key}, bg)
+        self.assertSetEqual({k for key in m['Af'] for k in key}, {('part', 'assembly'), ('widget', 'model')})
+
+    def test_termination_cache(self):
+        be = BackgroundEngine(_test_archive(test_system).query)
+        power = next(x for x in be.fg.get('model').inventory() if x.flow.external_ref == 'power')
+        self.assertEqual(be.terminate(power, 'abort').external_ref, 'grid')
+        self.assertDictEqual(be.termination_stats, {'resolved': 1, 'hits': 0, 'ambiguous': 0})
+        be.terminate(power, 'abort')
+        be.terminate(power, 'first')  # strategies share the cached targets
+        self.assertDictEqual(be.termination_stats, {'resolved': 1, 'hits': 2, 'ambiguous': 0})
+
+    def test_ambiguous_termination_cache(self):
+        system = dict(test_system, **alt_coal)
+        be = BackgroundEngine(_test_archive(system).query)
+        coal = next(x for x in be.fg.get('mill').inventory() if x.flow.external_ref == 'coal')
+        for _ in range(2):
+            with self.assertRaises(TerminationError):
+                be.terminate(coal, 'abort')
+        self.assertIn(be.terminate(coal, 'first').external_ref, ('mine', 'alt_mine'))
+        self.assertIsNone(be.terminate(coal, 'cutoff'))
+        self.assertDictEqual(be.termination_stats, {'resolved': 1, 'hits': 3, 'ambiguous': 1})
+
+    def test_prefetch(self):
+        be0 = _build(test_system)
+        be2 = _build(test_system, prefetch=2)
+        self.assertKeyedEqual(_keyed_matrices(be0), _keyed_matrices(be2))
+        self.assertDictEqual(be0.termination_stats, be2.termination_stats)
+        self.assertEqual(sum(be0.prefetch_stats), sum(be2.prefetch_stats))
+        self.assertGreater(be2.prefetch_stats[0], 0)
+        self.assertFalse(be2._prefetch.enabled)  # shut down when the traversal finishes
+        with BackgroundEngine(_test_archive(test_system).query, prefetch=2) as be:
+            self.assertTrue(be._prefetch.enabled)
+        self.assertFalse(be._prefetch.enabled)
+
+    def test_checkpoint_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ckpt = os.path.join(tmp, 'engine.npz')
+            be = BackgroundEngine(_test_archive(test_system).query)
+            be.add_all_ref_products(checkpoint=ckpt, checkpoint_interval=0)
+            resumed = BackgroundEngine.resume(_test_archive(test_system).query, ckpt)
+            resumed.add_all_ref_products()
+            self.assertKeyedEqual(_keyed_matrices(be), _keyed_matrices(resumed))
+
+    def test_checkpoint_after_termination_error(self):
+        for alt, preferred in ((alt_coal, {'coal': 'mine'}), (alt_part, {'part': 'assembly'})):
+            system = dict(test_system, **alt)
+            with self.subTest(preferred=preferred), tempfile.TemporaryDirectory() as tmp:
+                ckpt = os.path.join(tmp, 'engine.npz')
+                be = BackgroundEngine(_test_archive(system).query)
+                with self.assertRaises(TerminationError):
+                    be.add_all_ref_products(checkpoint=ckpt, checkpoint_interval=3600)
+                self.assertEqual(be.tstack.depth, 0)
+                resumed = BackgroundEngine.resume(_test_archive(system).query, ckpt, preferred=preferred)
+                resumed.add_all_ref_products()
+                self.assertKeyedEqual(_keyed_matrices(_build(system, preferred=preferred)),
+                                      _keyed_matrices(resumed))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+
+from ..coo_buffer import CooBuffer, RepeatAdjustment
+
+
+def _filled(entries, capacity=1024):
+    buf = CooBuffer(capacity=capacity)
+    for row, col, value in entries:
+        buf.append(row, col, value)
+    return buf
+
+
+class CooBufferTestCase(unittest.TestCase):
+    def test_growth(self):
+        entries = [(i, i % 7, float(i)) for i in range(100)]
+        buf = _filled(entries, capacity=4)
+        self.assertEqual(len(buf), 100)
+        self.assertListEqual(list(zip(buf.row, buf.col, buf.value)), entries)
+        self.assertFalse(buf.adjusted.any())
+
+    def test_truncate(self):
+        buf = _filled([(0, 1, 1.0), (1, 2, 2.0), (2, 3, 3.0)])
+        buf.truncate(5)
+        self.assertEqual(len(buf), 3)
+        buf.truncate(1)
+        self.assertListEqual(list(buf.row), [0])
+
+    def test_adjust(self):
+        buf = _filled([(0, 0, 1.0), (1, 1, 3.0), (2, 1, 6.0)])
+        buf.adjust(np.array([2.0, 3.0]))
+        self.assertListEqual(list(buf.value), [0.5, 1.0, 2.0])
+        self.assertTrue(buf.adjusted.all())
+
+    def test_repeat_adjustment(self):
+        buf = _filled([(0, 0, 1.0)])
+        buf.adjust(np.array([2.0]))
+        with self.assertRaises(RepeatAdjustment):
+            buf.adjust(np.array([2.0]))
+        buf.append(1, 0, 1.0)  # one adjusted entry is enough to refuse
+        with self.assertRaises(RepeatAdjustment):
+            buf.adjust(np.array([2.0]))
+        self.assertListEqual(list(buf.value), [0.5, 1.0])
+
+    def test_extend(self):
+        src = _filled([(0, 0, 1.0), (1, 1, 2.0), (2, 0, 3.0)])
+        src.adjust(np.array([1.0, 2.0]))
+        dst = _filled([(9, 9, 9.0)], capacity=1)
+        dst.extend(src, src.col == 0)
+        self.assertListEqual(list(zip(dst.row, dst.col, dst.value)), [(9, 9, 9.0), (0, 0, 1.0), (2, 0, 3.0)])
+        self.assertListEqual(list(dst.adjusted), [False, True, True])
+        dst.extend(src)
+        self.assertEqual(len(dst), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
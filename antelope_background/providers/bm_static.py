@@ -7,7 +7,7 @@ import time
 from abc import ABC
 
 from antelope_core.archives import LcArchive, InterfaceError
-from ..engine.flat_background import FlatBackground, SUPPORTED_FILETYPES, ORDERING_SUFFIX
+from ..engine.flat_background import FlatBackground, SUPPORTED_FILETYPES, ORDERING_SUFFIX, BINARY_ORDERING_SUFFIX
 from ..background.implementation import TarjanBackgroundImplementation, TarjanConfigureImplementation
 from .check_terms import termination_test
 
@@ -26,8 +26,9 @@ class TarjanBackground(LcArchive, ABC):
         self._save_after = save_after
         self._prefer = {None: []}
         if source:
-            if source.endswith(ORDERING_SUFFIX):
-                source = source[:-len(ORDERING_SUFFIX)]  # prevent us from trying to instantiate from the ordering file
+            for suffix in (ORDERING_SUFFIX, BINARY_ORDERING_SUFFIX):
+                if source.endswith(suffix):
+                    source = source[:-len(suffix)]  # prevent us from trying to instantiate from the ordering file
 
             filetype = os.path.splitext(source)[1]
             if filetype not in SUPPORTED_FILETYPES:
@@ -138,16 +139,28 @@ class TarjanBackground(LcArchive, ABC):
     def reset(self):
         self._flat = None
 
-    def write_to_file(self, filename=None, gzip=False, complete=True, domesticate=None, **kwargs):
+    def write_to_file(self, filename=None, gzip=False, complete=True, domesticate=None, aggregate=False, **kwargs):
         """
 
         :param filename:
         :param gzip: not used
         :param complete:
         :param domesticate: not used
-        :param kwargs:
+        :param aggregate: [False] compute and store the aggregated LCI matrix B(I - A)^-1, so that background LCIs
+         can be answered by lookup
+        :param kwargs: passed to FlatBackground.write_to_file() (e.g. factorize=True to store the LU factorization)
         :return:
         """
         if filename is None:
             filename = self.source
-        self._flat.write_to_file(filename, complete=complete, **kwargs)
+        self._flat.write_to_file(filename, complete=complete, aggregate=aggregate, **kwargs)
+
+    def write_characterizations(self, filename=None):
+        """
+        Save the flat background's stored characterization vectors without rewriting the background itself
+        :param filename: [self.source] the background file
+        :return:
+        """
+        if filename is None:
+            filename = self.source
+        self._flat.write_characterizations(filename)
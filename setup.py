@@ -55,6 +55,7 @@ setup(
     author_email="bkuczenski@ucsb.edu",
     license="BSD 3-clause",
     install_requires=requires,
+    extras_require={'hdf5': ['h5py']},
     url="https://github.com/AntelopeLCA/background",
     summary="A background LCI implementation that performs a partial ordering of LCI databases",
     long_description_content_type='text/markdown',